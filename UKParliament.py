@@ -1,10 +1,18 @@
 import requests
 import json
 import pandas as pd
-import glob
 from tqdm import tqdm
 import os
 
+from sweep import sweep_ids, refresh_ids, ResponseCollector
+from id_index import IdIndex
+from checkpoint import Checkpoint
+from constituencies import download_constituencies
+from http_client import get_session
+from civicrm import CIVI_URL, find_contacts, upsert_parliamentarians
+from members import get_member_table
+import metrics
+
 
 class UKParliament:
     """
@@ -14,10 +22,16 @@ class UKParliament:
 
     """
 
-    def __init__(self, path_to_tmp):
+    def __init__(self, path_to_tmp, civi_url=CIVI_URL):
+        """
+        :param path_to_tmp: str, the folder where downloaded files are kept.
+        :param civi_url: str, default civicrm.CIVI_URL. The CiviCRM REST endpoint used by get_details and create_parliamentarian. Point it at a local server for testing.
+        """
         self.path_to_tmp = path_to_tmp
+        self.civi_url = civi_url
 
-    def download_mps(self):
+    @metrics.instrumented('download_mps')
+    def download_mps(self, full_sweep=False, max_workers=16, rate_limit=20, stop_after_misses=None, spill=False, resume=True):
         """
         This method performs an initial sweep of the database to obtain current and former MP and Peer info. 
         In the tmp folder, it saves four files:
@@ -26,6 +40,14 @@ class UKParliament:
         * active_commons.csv - a json file of all active members of the House of Commons
         * active_lords.csv - a json file of all former members of the House of Commons
 
+        The ids known to be real are kept in members_index.json in the tmp folder. After the first run, only those ids are re-fetched (with conditional requests where the API supports them), and new ids are looked for above the highest known id.
+
+        :param full_sweep: bool, default False. If True, poll every possible id again rather than refreshing the known ids.
+        :param max_workers: int, default 16. The number of requests sent to the API at once.
+        :param rate_limit: float, default 20. The maximum number of requests per second sent to the API. None switches rate limiting off.
+        :param stop_after_misses: int, default None. If set, a full sweep stops once this many consecutive ids after the last real member have returned 404, rather than trying every id up to 5000.
+        :param spill: bool, default False. If True, responses are also written to members_sweep.jsonl in the tmp folder as they arrive, so they can be recovered with sweep.ResponseCollector.recover if the sweep crashes. The file is removed once the sweep succeeds.
+        :param resume: bool, default True. Every id is journalled in members_checkpoint.jsonl in the tmp folder as it completes. If a previous run died part way through, carry on from its journal rather than starting again from id 1. If False, the journal is discarded.
         :return: Two DataFrames: active_members_df, former_members_df
         """
         ########################
@@ -35,52 +57,39 @@ class UKParliament:
         # This section of code polls Parliament's Members API with every possible MP id. It has been determined that MPs have an id no higher than 5000.
 
         # First we determine which id numbers are real and which do not refer
-        possible_numbers = [x for x in range(1, 5001)]
-        actual_numbers = []
+        possible_numbers = range(1, 5001)
+        index = IdIndex(self.path_to_tmp+'/members_index.json')
 
-        # We iterate through the possible numbers and append those with response code 200 (success) to the actual numbers
-        print('Getting new list of MP id numbers + info. This can take about 15 minutes...')
+        # We sweep through the possible numbers (or just the known ones) and keep those with response code 200 (success)
+        if full_sweep or len(index) == 0:
+            print('Getting new list of MP id numbers + info. This can take a few minutes...')
+        else:
+            print('Refreshing MP info...')
 
-        active_members = []
-        former_members = []
+        # Each successful response goes straight into an in-memory collector, sorted into active and former members. 
+        # With spill=True, responses are also appended to a single JSONL file in the tmp folder as they arrive, in case the sweep dies part way through.
+        collector = ResponseCollector(spill_path=self.path_to_tmp+'/members_sweep.jsonl' if spill else None)
 
-        # Go through each possible MP id and download the response, if successful, and save as a json file. 
-        for mp in tqdm(possible_numbers):
-            url = 'https://members-api.parliament.uk/api/Members/{mp}'.format(mp=mp)
-            headers = {'accept': 'text/plain'}
-            response = requests.get(url, headers=headers)
-            if response.status_code == 200:
-                data = response.json()
-                if data['value']['latestHouseMembership']['membershipEndDate'] is None:
-                    with open(self.path_to_tmp+'/{}_active_info.json'.format(mp), 'w') as outfile:
-                        json.dump(data['value'], outfile)
-                    active_members.append(mp)
-                else:
-                    with open(self.path_to_tmp+'/{}_former_info.json'.format(mp), 'w') as outfile:
-                        json.dump(data['value'], outfile)
-                    former_members.append(mp)
+        def collect_member(mp, data):
+            if data['value']['latestHouseMembership']['membershipEndDate'] is None:
+                collector.add('active', mp, data['value'])
             else:
-                pass
-        
-        # We iterate through the downloaded json and add it into the big bit of json
+                collector.add('former', mp, data['value'])
 
-        combined_json = []
-        combined_former_json = []
+        checkpoint_path = self.path_to_tmp+'/members_checkpoint.jsonl'
+        if not resume and os.path.exists(checkpoint_path):
+            os.remove(checkpoint_path)
+        checkpoint = Checkpoint(checkpoint_path)
 
-        for f in tqdm(glob.glob(self.path_to_tmp+'/*_active_info.json')):
-            with open(f, 'rb') as infile:
-                combined_json.append(json.load(infile))
-
-        for f in tqdm(glob.glob(self.path_to_tmp+'/*_former_info.json')):
-            with open(f, 'rb') as infile:
-                combined_former_json.append(json.load(infile))
+        refresh_ids('https://members-api.parliament.uk/api/Members/{id}', possible_numbers, index, collect_member, full_sweep=full_sweep, stop_after_misses=stop_after_misses, max_workers=max_workers, rate_limit=rate_limit, checkpoint=checkpoint)
 
         ######################
         # IMPORT INTO PANDAS #
         ######################
 
-        active_members_df = pd.json_normalize(combined_json)
-        former_members_df = pd.json_normalize(combined_former_json)
+        active_members_df = collector.frame('active')
+        former_members_df = collector.frame('former')
+        collector.close()
 
         ##################
         # DATA WRANGLING #
@@ -101,30 +110,6 @@ class UKParliament:
         active_members_df['firstname'] = active_members_df.firstname.apply(lambda x: x.replace('Mr ', '').replace('Mrs ', '').replace('Ms ', '').replace('Sir ', '').replace('Dr ', '').replace('Miss ', '').replace('Dame ', ''))
         active_members_df['firstname'] = active_members_df.firstname.apply(lambda x: x.split(' ')[0])
 
-        ##################
-        # CLEAN UP FILES #
-        ##################
-
-        # Get a list of all the file paths that ends with .txt from in specified directory
-        fileList = glob.glob(self.path_to_tmp+'/*_active_info.json')
-        # Iterate over the list of filepaths & remove each file.
-        print('Cleaning up... active_info.json files...')
-        for filePath in tqdm(fileList):
-            try:
-                os.remove(filePath)
-            except:
-                print("Error while deleting file : ", filePath)
-
-        # Get a list of all the file paths that ends with .txt from in specified directory
-        fileList = glob.glob(self.path_to_tmp+'/*_former_info.json')
-
-        # Iterate over the list of filepaths & remove each file.
-        print('Cleaning up... former_info.json files...')
-        for filePath in tqdm(fileList):
-            try:
-                os.remove(filePath)
-            except:
-                print("Error while deleting file : ", filePath)
         print('All done updating the Parliamentarians with latest data! Be on your merry way.')
 
         ##################
@@ -135,110 +120,31 @@ class UKParliament:
         self.state_of_parties = active_members_df.groupby(['latestPartyid', 'latestPartyname']).count().iloc[:, :1].reset_index().rename(columns={'id': 'number'})
         self.active_commons_df = active_members_df[active_members_df.latestHouseMembershiphouse == 'Commons']
         self.active_lords_df = active_members_df[active_members_df.latestHouseMembershiphouse == 'Lords']
-        active_members_df.to_csv(self.path_to_tmp+'/active_members.csv', index=False)
-        former_members_df.to_csv(self.path_to_tmp+'/former_members.csv', index=False)
-        self.active_commons_df.to_csv(self.path_to_tmp+'/active_commons.csv', index=False)
-        self.active_lords_df.to_csv(self.path_to_tmp+'/active_lords.csv', index=False)
+        with metrics.timer('csv_write'):
+            active_members_df.to_csv(self.path_to_tmp+'/active_members.csv', index=False)
+            former_members_df.to_csv(self.path_to_tmp+'/former_members.csv', index=False)
+            self.active_commons_df.to_csv(self.path_to_tmp+'/active_commons.csv', index=False)
+            self.active_lords_df.to_csv(self.path_to_tmp+'/active_lords.csv', index=False)
+        metrics.increment('rows', len(active_members_df) + len(former_members_df))
+        checkpoint.finish()
 
         return active_members_df, former_members_df
     
-    def download_constituencies(self):
+    def download_constituencies(self, full_sweep=False, max_workers=16, rate_limit=20, spill=False, resume=True):
         """
-        This method sweeps and downloads the latest data on constituencies. 
+        This method sweeps and downloads the latest data on constituencies. See constituencies.download_constituencies for the parameters.
         :return: Two DataFrames, active_c_df, former_c_df
         """
-        ########################
-        # START API SWEEP      #
-        ########################
-
-        # First we determine which id numbers are real and which do not refer
-        possible_numbers = [x for x in range(0, 5001)]
-
-        # We iterate through the possible numbers and append those with response code 200 (success) to the actual numbers
-        print('Getting new list of Constituency id numbers + info. This can take about 15 minutes...')
-
-        for constituency_id in tqdm(possible_numbers):
-            url = 'https://members-api.parliament.uk/api/Location/Constituency/{p}'.format(p=constituency_id)
-            headers = {'accept': 'text/plain'}
-            response = requests.get(url, headers=headers)
-            # If the response is valid (i.e. there's an MP) save the info to the 
-            if response.status_code == 200:
-                data = response.json()
-                if data['value']['endDate'] is None:
-                    with open(self.path_to_tmp+'/{}_active_info.json'.format(constituency_id), 'w') as outfile:
-                        json.dump(data['value'], outfile)
-                else:
-                    with open(self.path_to_tmp+'/{}_former_info.json'.format(constituency_id), 'w') as outfile:
-                        json.dump(data['value'], outfile)
-            else:
-                pass
-
-        # We'll combine the current constituencies into one big bit of json
-        combined_json = []
-        combined_former_json = []
-        # Here we iterate through the downloaded json and add it into the big bit of json
-        for f in tqdm(glob.glob(self.path_to_tmp+'/*_active_info.json')):
-            with open(f, 'rb') as infile:
-                combined_json.append(json.load(infile))
-        # Iterating through more globs of json
-        for f in tqdm(glob.glob(self.path_to_tmp+'/*_former_info.json')):
-            with open(f, 'rb') as infile:
-                combined_former_json.append(json.load(infile))
-
-        active_constituencies_df = pd.json_normalize(combined_json)
-        former_constituencies_df = pd.json_normalize(combined_former_json)
-
-        ########################
-        # START DATA WRANGLING #
-        ########################
-
-        # Cleaning up column names
-        active_constituencies_df.columns = [x.replace('.', '') for x in active_constituencies_df.columns]
-        former_constituencies_df.columns = [x.replace('.', '') for x in former_constituencies_df.columns]
-
-        active_constituencies_df[active_constituencies_df.name.notna()]
-        former_constituencies_df[former_constituencies_df.name.notna()]
-
-        active_constituencies_df.columns = [x.replace('.', '_') for x in active_constituencies_df.columns]
-        former_constituencies_df.columns = [x.replace('.', '_') for x in former_constituencies_df.columns]
-        
-
-        ######################
-        # END DATA WRANGLING #
-        ######################
-
-        #######################
-        # START FILE CLEAN-UP #
-        #######################
-
-        # Get a list of all the file paths that ends with .txt from in specified directory
-        fileList = glob.glob(self.path_to_tmp+'/*_active_info.json')
-        # Iterate over the list of filepaths & remove each file.
-        print('Cleaning up... active_info.json files...')
-        for filePath in tqdm(fileList):
-            try:
-                os.remove(filePath)
-            except:
-                print("Error while deleting file : ", filePath)
-
-        # Get a list of all the file paths that ends with .txt from in specified directory
-        fileList = glob.glob(self.path_to_tmp+'/*_former_info.json')
-        # Iterate over the list of filepaths & remove each file.
-        print('Cleaning up... former_info.json files...')
-        for filePath in tqdm(fileList):
-            try:
-                os.remove(filePath)
-            except:
-                print("Error while deleting file : ", filePath)
-        print('All done updating the Parliamentarians with latest data! Be on your merry way.')
-
-        #######################
-        # END FILE CLEAN-UP   #
-        #######################
-        active_constituencies_df.to_csv(self.path_to_tmp+'/active_constituencies.csv', index=False)
-        former_constituencies_df.to_csv(self.path_to_tmp+'/former_constituencies.csv', index=False)
-        return active_constituencies_df, former_constituencies_df
+        return download_constituencies(self.path_to_tmp, full_sweep=full_sweep, max_workers=max_workers, rate_limit=rate_limit, spill=spill, resume=resume)
     
+    def member_table(self):
+        """
+        The members (and constituencies) saved in the tmp folder by download_mps and download_constituencies, as a shared members.MemberTable, loaded once per process.
+        Use this rather than re-reading active_members.csv: it has the same state_of_parties and active Commons/Lords members as download_mps sets up, without having to download them again.
+        :return: a members.MemberTable
+        """
+        return get_member_table(self.path_to_tmp)
+
     def get_job_history(self, api_number, create_id_col = False):
         """
         This method is designed to be used iteratively, on a list of API numbers to generate MP job history info. It returns a DataFrame with job history information.
@@ -250,70 +156,106 @@ class UKParliament:
         headers = {
             'accept': 'text/plain',
         }
-        response = requests.get('https://members-api.parliament.uk/api/Members/{n}/Biography'.format(n=api_number), headers=headers)
+        response = get_session().get('https://members-api.parliament.uk/api/Members/{n}/Biography'.format(n=api_number), headers=headers)
         if response.status_code == 200:
-            data = response.json()
+            return self.job_table(response.json(), api_number, create_id_col=create_id_col)
+        else:
+            pass
 
-            # From the response, we obtain the nested data, which is sorted into three kinds of jobs
-            if len(data['value']['governmentPosts']) > 0:
-                govt_jobs = pd.DataFrame(data['value']['governmentPosts'])
-            else:
-                govt_jobs = pd.DataFrame(columns=['house', 'name', 'id', 'startDate', 'endDate', 'additionalInfo', 'additionalInfoLink'])
+    def job_table(self, data, api_number, create_id_col = False):
+        """
+        Turn a single Biography payload from Parliament's API into a DataFrame of job history, joined onto self.mps. See get_job_history.
+        :param data: dict, the decoded response, i.e. {'value': {...}}
+        :param api_number: Int, the member's id in Parliament's database.
+        :param create_id_col: bool, default False. See get_job_history.
+        :return: a DataFrame, or None if the member couldn't be matched up with the CRM.
+        """
+        # From the response, we obtain the nested data, which is sorted into three kinds of jobs
+        if len(data['value']['governmentPosts']) > 0:
+            govt_jobs = pd.DataFrame(data['value']['governmentPosts'])
+        else:
+            govt_jobs = pd.DataFrame(columns=['house', 'name', 'id', 'startDate', 'endDate', 'additionalInfo', 'additionalInfoLink'])
 
-            if len(data['value']['oppositionPosts']) > 0:
-                oppo_jobs = pd.DataFrame(data['value']['oppositionPosts'])
-            else:
-                oppo_jobs = pd.DataFrame(columns=['house', 'name', 'id', 'startDate', 'endDate', 'additionalInfo', 'additionalInfoLink'])
-            
-            if len(data['value']['committeeMemberships']) > 0:
-                cttee_jobs = pd.DataFrame(data['value']['committeeMemberships'])
-            else:
-                cttee_jobs = pd.DataFrame(columns=['house', 'name', 'id', 'startDate', 'endDate', 'additionalInfo', 'additionalInfoLink'])
-            # The committee jobs dataframe needs some tidying to distinguish between membership and chairmanship of the committee. 
-            # BELOW WAS TIDIED UP DUE TO AN ERROR WHEN THERE WERE NO COMMITTEE MEMBERSHIPS
+        if len(data['value']['oppositionPosts']) > 0:
+            oppo_jobs = pd.DataFrame(data['value']['oppositionPosts'])
+        else:
+            oppo_jobs = pd.DataFrame(columns=['house', 'name', 'id', 'startDate', 'endDate', 'additionalInfo', 'additionalInfoLink'])
+        
+        if len(data['value']['committeeMemberships']) > 0:
+            cttee_jobs = pd.DataFrame(data['value']['committeeMemberships'])
+        else:
+            cttee_jobs = pd.DataFrame(columns=['house', 'name', 'id', 'startDate', 'endDate', 'additionalInfo', 'additionalInfoLink'])
+        # The committee jobs dataframe needs some tidying to distinguish between membership and chairmanship of the committee. 
+        # BELOW WAS TIDIED UP DUE TO AN ERROR WHEN THERE WERE NO COMMITTEE MEMBERSHIPS
+        # Add 'Member of' in front of committee jobs
+        # print(govt_jobs.columns.tolist())
+        # cttee_jobs['name'] = cttee_jobs['name'].apply(lambda x: 'Member of ' + x if 'Committee' in x else x)
+        # print(cttee_jobs.columns.tolist())
+
+        # Replace 'Member of' with 'Chair of' if additionalInfo column indicates that they were a chair of the committee
+        # cttee_jobs['name'] = cttee_jobs.apply(lambda row: row['name'].replace('Member of ', 'Chair of ') if (row['additionalInfo'] == 'Chaired') else row['name'], axis=1)
+
+        # Now we concatenate the three dataframes into one big one. They all have the same columns, so this is easy. 
+        jobs_df = pd.concat([govt_jobs, oppo_jobs, cttee_jobs])
+        if jobs_df.shape[0] > 0:
             # Add 'Member of' in front of committee jobs
-            # print(govt_jobs.columns.tolist())
-            # cttee_jobs['name'] = cttee_jobs['name'].apply(lambda x: 'Member of ' + x if 'Committee' in x else x)
-            # print(cttee_jobs.columns.tolist())
-
+            jobs_df['name'] = jobs_df['name'].apply(lambda x: 'Member of ' + x if 'Committee' in x else x)
             # Replace 'Member of' with 'Chair of' if additionalInfo column indicates that they were a chair of the committee
-            # cttee_jobs['name'] = cttee_jobs.apply(lambda row: row['name'].replace('Member of ', 'Chair of ') if (row['additionalInfo'] == 'Chaired') else row['name'], axis=1)
-
-            # Now we concatenate the three dataframes into one big one. They all have the same columns, so this is easy. 
-            jobs_df = pd.concat([govt_jobs, oppo_jobs, cttee_jobs])
-            if jobs_df.shape[0] > 0:
-                # Add 'Member of' in front of committee jobs
-                jobs_df['name'] = jobs_df['name'].apply(lambda x: 'Member of ' + x if 'Committee' in x else x)
-                # Replace 'Member of' with 'Chair of' if additionalInfo column indicates that they were a chair of the committee
-                jobs_df['name'] = jobs_df.apply(lambda row: row['name'].replace('Member of ', 'Chair of ') if (row['additionalInfo'] == 'Chaired') else row['name'], axis=1)
-
-                # Make a column that specifies the MPs' Parliament API number so we have some reference back to the MP
-                jobs_df['mp_id'] = api_number
-                # Now we merge them with self.mps, which has API number + contact_id number from CiviCRM
-                jobs_df = jobs_df.merge(self.mps, how='inner', left_on='mp_id', right_on='parliament_api_number_68')
-                # Drop a few unecessary columns - we need to start making this DataFrame look like our target SQL table.
-                jobs_df.drop(columns = ['id_x', 'id_y', 'parliament_api_number_68', 'house', 'mp_id', 'additionalInfoLink'], inplace=True, errors='ignore')
-                # In this try and except clause, we try to obtain the necessary columns for our target table. Of course, it's possible that MPs  have no job info, if they've never had a parliamentary job. 
-                # In these cases, there will be an error, and we simple pass and return no data, since there's no job info to be found. That's why the except passes on a 'keyerror'. 
-                # 
-                try:
-                    jobs_df = jobs_df[['entity_id', 'name', 'startDate', 'endDate', 'additionalInfo']]
-                    jobs_df.columns = ['entity_id', 'job_title_11', 'start_date_12', 'end_date_13', 'employer_govt_dept_committee_etc_14']
-                    jobs_df.drop_duplicates(inplace=True)
-                    # This provisions some functionality around an id column. Not useful when doing mass scrapes. 
-                    if create_id_col:
-                        jobs_df['id'] = jobs_df.index + 1
-                        jobs_df = jobs_df[['id', 'entity_id', 'job_title_11', 'start_date_12', 'end_date_13', 'employer_govt_dept_committee_etc_14']]
-                    else:
-                        pass
-                    return jobs_df
-                except KeyError:
+            jobs_df['name'] = jobs_df.apply(lambda row: row['name'].replace('Member of ', 'Chair of ') if (row['additionalInfo'] == 'Chaired') else row['name'], axis=1)
+
+            # Make a column that specifies the MPs' Parliament API number so we have some reference back to the MP
+            jobs_df['mp_id'] = api_number
+            # Now we merge them with self.mps, which has API number + contact_id number from CiviCRM
+            jobs_df = jobs_df.merge(self.mps, how='inner', left_on='mp_id', right_on='parliament_api_number_68')
+            # Drop a few unecessary columns - we need to start making this DataFrame look like our target SQL table.
+            jobs_df.drop(columns = ['id_x', 'id_y', 'parliament_api_number_68', 'house', 'mp_id', 'additionalInfoLink'], inplace=True, errors='ignore')
+            # In this try and except clause, we try to obtain the necessary columns for our target table. Of course, it's possible that MPs  have no job info, if they've never had a parliamentary job. 
+            # In these cases, there will be an error, and we simple pass and return no data, since there's no job info to be found. That's why the except passes on a 'keyerror'. 
+            # 
+            try:
+                jobs_df = jobs_df[['entity_id', 'name', 'startDate', 'endDate', 'additionalInfo']]
+                jobs_df.columns = ['entity_id', 'job_title_11', 'start_date_12', 'end_date_13', 'employer_govt_dept_committee_etc_14']
+                jobs_df.drop_duplicates(inplace=True)
+                # This provisions some functionality around an id column. Not useful when doing mass scrapes. 
+                if create_id_col:
+                    jobs_df['id'] = jobs_df.index + 1
+                    jobs_df = jobs_df[['id', 'entity_id', 'job_title_11', 'start_date_12', 'end_date_13', 'employer_govt_dept_committee_etc_14']]
+                else:
                     pass
-            else:
-                jobs_df = pd.DataFrame(columns=['house', 'name', 'id', 'startDate', 'endDate', 'additionalInfo', 'additionalInfoLink'])
                 return jobs_df
+            except KeyError:
+                pass
         else:
-            pass
+            jobs_df = pd.DataFrame(columns=['house', 'name', 'id', 'startDate', 'endDate', 'additionalInfo', 'additionalInfoLink'])
+            return jobs_df
+
+    def job_tables(self, biographies):
+        """
+        Build the job history of many members at once from their Biography payloads. This gives the same rows as calling job_table on each payload in turn, but the payloads are flattened into a single list of jobs, the committee titles are rewritten with vectorised string methods, and self.mps is merged in once.
+        :param biographies: dict of {api_number: biography}, where each biography is shaped like the API's response, i.e. {'value': {...}}. As returned by get_biographies.
+        :return: a DataFrame with columns entity_id, job_title_11, start_date_12, end_date_13, employer_govt_dept_committee_etc_14
+        """
+        # Flatten every job of every member into one list, in the same order as job_table: government, then opposition, then committee jobs
+        records = []
+        for mp in sorted(biographies):
+            value = biographies[mp]['value']
+            for kind in ('governmentPosts', 'oppositionPosts', 'committeeMemberships'):
+                for post in value[kind]:
+                    records.append((mp, post.get('name'), post.get('startDate'), post.get('endDate'), post.get('additionalInfo')))
+        jobs_df = pd.DataFrame.from_records(records, columns=['mp_id', 'name', 'startDate', 'endDate', 'additionalInfo'])
+
+        # Add 'Member of' in front of committee jobs
+        is_committee = jobs_df['name'].str.contains('Committee', regex=False, na=False)
+        jobs_df.loc[is_committee, 'name'] = 'Member of ' + jobs_df.loc[is_committee, 'name']
+        # Replace 'Member of' with 'Chair of' if additionalInfo column indicates that they were a chair of the committee
+        chaired = jobs_df['additionalInfo'] == 'Chaired'
+        jobs_df.loc[chaired, 'name'] = jobs_df.loc[chaired, 'name'].str.replace('Member of ', 'Chair of ', regex=False)
+
+        # One merge with self.mps, which has API number + contact_id number from CiviCRM
+        jobs_df = jobs_df.merge(self.mps, how='inner', left_on='mp_id', right_on='parliament_api_number_68')
+        jobs_df = jobs_df[['entity_id', 'name', 'startDate', 'endDate', 'additionalInfo']]
+        jobs_df.columns = ['entity_id', 'job_title_11', 'start_date_12', 'end_date_13', 'employer_govt_dept_committee_etc_14']
+        return jobs_df.drop_duplicates().reset_index(drop=True)
 
     def get_party(self):
         list_of_api_nos = self.mps_ids
@@ -327,7 +269,7 @@ class UKParliament:
             headers = {
             'accept': 'text/plain',
             }
-            response = requests.get(url, headers=headers)
+            response = get_session().get(url, headers=headers)
             if response.status_code == 200:
                 data = response.json()
                 data['value']['latestParty']['mpId'] = mp
@@ -339,23 +281,69 @@ class UKParliament:
         return df
 
 
-    def update_mp_job_info(self, path_to_tmp_folder):
+    def get_biographies(self, api_numbers, max_workers=16, rate_limit=20, cache=False, max_age_hours=24):
+        """
+        Fetch the Biography of many members at once, over a pool of worker threads sharing one keep-alive session. Requests which fail are retried with backoff.
+        :param api_numbers: list of Ints, the members' ids in Parliament's database.
+        :param max_workers: int, default 16. The number of requests sent to the API at once.
+        :param rate_limit: float, default 20. The maximum number of requests per second sent to the API. None switches rate limiting off.
+        :param cache: bool, default False. If True, biographies are kept in biographies_index.json in the tmp folder. Those fetched less than max_age_hours ago are not requested again, and older ones are re-fetched with conditional requests where the API supports them.
+        :param max_age_hours: float, default 24. How long a cached biography is used without asking the API again.
+        :return: a dict of {api_number: biography}, where each biography is shaped like the API's response, i.e. {'value': ...}, and a list of the api numbers whose biographies couldn't be fetched.
+        """
+        api_numbers = sorted(set(int(x) for x in api_numbers))
+        biographies = {}
+        index = IdIndex(self.path_to_tmp+'/biographies_index.json') if cache else None
+
+        if index is not None:
+            for mp in api_numbers:
+                age = index.age(mp)
+                if age is not None and age < max_age_hours * 3600:
+                    biographies[mp] = {'value': index.value(mp)}
+            if len(biographies) > 0:
+                print('Using cached biographies for {n} members.'.format(n=len(biographies)))
+        to_fetch = [mp for mp in api_numbers if mp not in biographies]
+
+        def record_hit(mp, data, headers):
+            biographies[mp] = data
+            if index is not None:
+                index.update(mp, data['value'], headers)
+
+        def record_not_modified(mp):
+            index.touch(mp)
+            biographies[mp] = {'value': index.value(mp)}
+
+        sweep_ids('https://members-api.parliament.uk/api/Members/{id}/Biography', to_fetch, record_hit, max_workers=max_workers, rate_limit=rate_limit,
+                  conditional_headers=index.conditional_headers if index is not None else None, on_not_modified=record_not_modified if index is not None else None)
+        if index is not None:
+            index.save()
+
+        failed = [mp for mp in to_fetch if mp not in biographies]
+        if len(failed) > 0:
+            print('Could not get the biographies of {n} members: {ids}'.format(n=len(failed), ids=failed))
+        return biographies, failed
+
+    def update_mp_job_info(self, path_to_tmp_folder=None, max_workers=16, rate_limit=20, cache=False, max_age_hours=24):
         """
         This function returns a DataFrame containing all MP job information.
+        The biographies of everyone in self.mps_ids are fetched concurrently (see get_biographies) and the job history is built from them in one go (see job_tables). Members whose biography couldn't be fetched, or who couldn't be matched up with the CRM, are left out and reported.
+        :param path_to_tmp_folder: no longer used, since nothing is written to disk. Kept so that existing calls still work.
+        :param max_workers: int, default 16. The number of requests sent to the API at once.
+        :param rate_limit: float, default 20. The maximum number of requests per second sent to the API. None switches rate limiting off.
+        :param cache: bool, default False. If True, unchanged biographies are taken from biographies_index.json in the tmp folder rather than fetched again. See get_biographies.
+        :param max_age_hours: float, default 24. See get_biographies.
+        :return: a DataFrame with columns id, entity_id, job_title_11, start_date_12, end_date_13, employer_govt_dept_committee_etc_14, is_current_job_67, frontbench_job_69
         """
 
         # mps_list = self.mps.parliament_api_number_10.tolist()
         print('Got preliminary info, now updating job history. This will take a while. ')
-        for mp in tqdm(self.mps_ids):
-            # try:
-            df = self.get_job_history(mp)
-            df.to_csv(path_to_tmp_folder+'/mp_{}.csv'.format(mp))
-            # except:
-            #     print('excepted')
-            #     pass
-            
-        df = pd.concat([pd.read_csv(file, index_col=0) for file in glob.glob(path_to_tmp_folder+'/mp_*.csv')], ignore_index=True)
-        df.drop_duplicates(inplace=True)
+        biographies, failed = self.get_biographies(self.mps_ids, max_workers=max_workers, rate_limit=rate_limit, cache=cache, max_age_hours=max_age_hours)
+
+        unmatched = sorted(set(biographies) - set(self.mps['parliament_api_number_68']))
+        if len(unmatched) > 0:
+            print('Could not match {n} members with the CRM: {ids}'.format(n=len(unmatched), ids=unmatched))
+
+        df = self.job_tables(biographies)
         df['id'] = df.index + 1
         df = df[['id', 'entity_id', 'job_title_11', 'start_date_12', 'end_date_13', 'employer_govt_dept_committee_etc_14']]
         df['is_current_job_67'] = None
@@ -363,11 +351,15 @@ class UKParliament:
         return df
 
 
-    def get_details(self, site_key, user_key):
+    def get_details(self, site_key, user_key, chunk_size=100, max_workers=4):
         """
         This function takes a list of Parliamentary API numbers and checks whether there is a contact present in the CiviCRM database. 
 
         It is intended to be used on the list of 
+
+        The ids are looked up in chunks of chunk_size, with calls sent concurrently (see civicrm.find_contacts), rather than one call per id.
+        :param chunk_size: int, default 100. How many ids are looked up in each call to the CRM.
+        :param max_workers: int, default 4. How many calls are sent to the CRM at once.
         :return: A dataframe of the latest active parliamentarians (taken from the last download from UKParliament.download_mps(), and a json object with the details of Parliamentarians who are present in the Civi database.)
         """
 
@@ -378,49 +370,33 @@ class UKParliament:
         active_p = active_commons.copy() #pd.concat([active_commons, active_lords])
         mp_id_lst = active_p.id.tolist()
 
+        # Look up every Parliamentary API number in our CRM
+        contacts = find_contacts(mp_id_lst, site_key, user_key, url=self.civi_url, chunk_size=chunk_size, max_workers=max_workers)
+
         # Blank list which will be populated and then returned. 
         active_members_in_civi = []
-
-        # Our CRM endpoint
-        url = 'https://civi.newautomotive.org/wp-content/plugins/civicrm/civicrm/extern/rest.php'
-
-        # Iterate through the list of Parliamentary API numbers. 
-        for id in tqdm(mp_id_lst):
-                params = {
-                'entity': 'Contact',
-                'action': 'get',
-                'json': 1, 
-                "debug":1,
-                "sequential":1,
-                "return":"custom_68,sort_name,first_name,last_name",
-                # "custom_64":"Active",
-                # "custom_65":"Lords",
-                "custom_68" : id,
-                'api_key' : user_key,
-                'key': site_key
-                }
-                r = requests.get(url=url, params=params)
-                if r.json()['count'] == 1:
-                    data = r.json()['values'][0]
-                    active_members_in_civi.append(data)
-                elif r.json()['count'] > 1:
-                    print('Problem with id #{mpid}'.format(mpid=id))
-                else:
-                    pass
+        for id in mp_id_lst:
+            found = contacts.get(int(id), [])
+            if len(found) == 1:
+                active_members_in_civi.append(found[0])
+            elif len(found) > 1:
+                print('Problem with id #{mpid}'.format(mpid=id))
+            else:
+                pass
                 
         not_upload_ids = [int(x['custom_68']) for x in active_members_in_civi]
         active_members_not_in_civi = active_p[~active_p.id.isin(not_upload_ids)]
 
         return active_p, active_members_not_in_civi
 
-    def create_parliamentarian(site_key, user_key, mp_id, sort_name, party, last_name, display_name, legal_name, house, first_name):
+    def create_parliamentarian(self, site_key, user_key, mp_id, sort_name, party, last_name, display_name, legal_name, house, first_name):
         """
         Create a new parliamentarian in our CiviCRM database. NB this will not work unless you configure it for your own CiviCRM install. The custom field names will be different. 
         :return: Nothing. 
         """
         mp_id = str(mp_id)
 
-        url = 'https://civi.newautomotive.org/wp-content/plugins/civicrm/civicrm/extern/rest.php'
+        url = self.civi_url
 
         params = {
         'entity': 'Contact',
@@ -444,4 +420,12 @@ class UKParliament:
         "display_name":display_name,
         "legal_name":legal_name
         }
-        requests.post(url=url, params=params)
\ No newline at end of file
+        requests.post(url=url, params=params)
+
+    def upsert_parliamentarians(self, members, site_key, user_key, batch_size=25, max_workers=4, update_existing=True):
+        """
+        Create many parliamentarians in our CiviCRM database at once, e.g. after an election. Members who are already in the database (matched on custom_68) are updated instead, so this is safe to re-run. See civicrm.upsert_parliamentarians for the parameters.
+        :param members: a DataFrame with the same columns as the arguments of create_parliamentarian: mp_id, sort_name, party, last_name, display_name, legal_name, house, first_name.
+        :return: a DataFrame with the result for each row of members: mp_id, status, contact_id and error.
+        """
+        return upsert_parliamentarians(members, site_key, user_key, url=self.civi_url, batch_size=batch_size, max_workers=max_workers, update_existing=update_existing)
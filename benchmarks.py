@@ -0,0 +1,344 @@
+"""
+Benchmarks for the slow parts of the pipelines. Run with `python benchmarks.py`.
+"""
+import multiprocessing
+import os
+import random
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows, where peak memory isn't reported
+    resource = None
+
+from wpqs import clean_questions, QUESTION_REPLACEMENTS, load_cleaned_archive, update_answered_pqs, download_ua_pqs
+from UKParliament import UKParliament
+from search import SearchIndex, keyword_query
+from http_client import disable_cache, override_hosts
+from stub_api import StubAPI
+from test_wpqs import baseline_question_cleaner
+import metrics
+
+
+def synthetic_questions(n, seed=0):
+    """
+    Make a corpus of lower case questions which look like the real thing: a preamble addressed to a department, then the question, with plenty of the commas and colons that question_cleaner has to deal with.
+    Preambles are built from the cleaner's own rewrite rules, so that every rule gets exercised.
+    :param n: int, the number of questions.
+    :param seed: int, default 0. The random seed, so that runs are comparable.
+    :return: a list of n strings.
+    """
+    rng = random.Random(seed)
+    preambles = [old for old, new in QUESTION_REPLACEMENTS] + [
+        'to ask the secretary of state for transport, ',
+        'to ask the secretary of state for health and social care, ',
+        'to ask the secretary of state for the home department,',
+        ]
+    words = ('what steps his department is taking to increase the number of electric vehicle charging points in rural areas '
+             'and what assessment she has made of the effect of that policy on emissions housing food business energy').split()
+    endings = ['?', ', with reference to the answer of 5 may 2022 to question 1234,', ': what plans they have?', ',and when.', ', and why?']
+    questions = []
+    for _ in range(n):
+        body = ' '.join(rng.choice(words) for _ in range(rng.randint(15, 60)))
+        questions.append(rng.choice(preambles) + body + rng.choice(endings))
+    return questions
+
+
+def bench_question_cleaner(n=200000):
+    """
+    Compare cleaning questions one at a time with the original question_cleaner (the frozen copy in test_wpqs, as the pipelines used to) against clean_questions, and check that they give identical output.
+    The gain is modest, around 1.2x on the synthetic corpus, and varies with the mix of ASCII and non-ASCII questions.
+    :return: a dict of timings in seconds and throughput in questions per second.
+    """
+    questions = pd.Series(synthetic_questions(n))
+
+    started = time.perf_counter()
+    expected = questions.apply(baseline_question_cleaner)
+    row_seconds = time.perf_counter() - started
+
+    started = time.perf_counter()
+    cleaned = clean_questions(questions)
+    batch_seconds = time.perf_counter() - started
+
+    if not cleaned.equals(expected):
+        mismatched = (cleaned != expected).sum()
+        raise AssertionError('clean_questions disagrees with the original question_cleaner on {m} of {n} questions'.format(m=mismatched, n=n))
+
+    result = {
+        'questions': n,
+        'row_seconds': row_seconds,
+        'batch_seconds': batch_seconds,
+        'row_per_second': n / row_seconds,
+        'batch_per_second': n / batch_seconds,
+        }
+    print('question_cleaner: {r:,.0f} questions/s with the original, {b:,.0f} questions/s with clean_questions ({x:.2f}x), identical output on {n:,} questions.'.format(
+        r=result['row_per_second'], b=result['batch_per_second'], x=row_seconds / batch_seconds, n=n))
+    return result
+
+
+def synthetic_biographies(n, seed=0):
+    """
+    Make Biography payloads shaped like the Members API's, with a mix of government, opposition and committee jobs (some of them chaired), and some members with no jobs at all.
+    :param n: int, the number of members, with ids 1 to n.
+    :param seed: int, default 0. The random seed, so that runs are comparable.
+    :return: a dict of {id: {'value': {...}}}
+    """
+    rng = random.Random(seed)
+    titles = {
+        'governmentPosts': ['Secretary of State for Transport', 'Minister of State (Department for Transport)', 'Parliamentary Under-Secretary (Department for Education)'],
+        'oppositionPosts': ['Shadow Secretary of State for Transport', 'Shadow Minister (Energy)'],
+        'committeeMemberships': ['Transport Committee', 'Environmental Audit Committee', 'Panel of Chairs', 'Business, Energy and Industrial Strategy Committee'],
+        }
+    biographies = {}
+    for mp in range(1, n + 1):
+        value = {}
+        for kind, names in titles.items():
+            value[kind] = [{
+                'house': 1,
+                'name': rng.choice(names),
+                'id': rng.randint(1, 500),
+                'startDate': '20{y:02d}-01-01T00:00:00'.format(y=rng.randint(0, 22)),
+                'endDate': rng.choice([None, '2023-01-01T00:00:00']),
+                'additionalInfo': rng.choice([None, None, 'Chaired']) if kind == 'committeeMemberships' else None,
+                'additionalInfoLink': None,
+                } for _ in range(rng.choice([0, 0, 1, 2, 4]))]
+        biographies[mp] = {'value': value}
+    return biographies
+
+
+def bench_job_tables(n=2000):
+    """
+    Compare building job history one member at a time with UKParliament.job_table against UKParliament.job_tables, and check that they give the same rows.
+    :return: a dict of timings in seconds.
+    """
+    biographies = synthetic_biographies(n)
+    parliament = UKParliament('.')
+    # Leave some members out of the CRM table, as happens for real
+    parliament.mps = pd.DataFrame({'parliament_api_number_68': [mp for mp in biographies if mp % 10], 'entity_id': [mp + 10000 for mp in biographies if mp % 10]})
+
+    started = time.perf_counter()
+    tables = [parliament.job_table(biographies[mp], mp) for mp in sorted(biographies)]
+    expected = pd.concat([df for df in tables if df is not None and 'entity_id' in df.columns], ignore_index=True).drop_duplicates().reset_index(drop=True)
+    member_seconds = time.perf_counter() - started
+
+    started = time.perf_counter()
+    bulk = parliament.job_tables(biographies)
+    bulk_seconds = time.perf_counter() - started
+
+    pd.testing.assert_frame_equal(bulk, expected, check_dtype=False)
+
+    result = {'members': n, 'member_seconds': member_seconds, 'bulk_seconds': bulk_seconds}
+    print('job tables: {m:.2f}s one member at a time, {b:.2f}s in bulk ({x:.0f}x), same {r:,} rows for {n:,} members.'.format(
+        m=member_seconds, b=bulk_seconds, x=member_seconds / bulk_seconds, r=len(bulk), n=n))
+    return result
+
+
+def synthetic_cleaned_wpqs(n, seed=0):
+    """
+    Make a DataFrame shaped like the cleaned archive, with questions from synthetic_questions spread over eight years, four parties and 650 members.
+    :return: a DataFrame
+    """
+    rng = random.Random(seed)
+    questions = synthetic_questions(n, seed=seed)
+    members = [rng.randint(1, 650) for _ in range(n)]
+    bodies = ['Department for Transport', 'Treasury', 'Home Office', 'Department for Education', 'Department of Health and Social Care']
+    tabled = pd.to_datetime('2014-05-01') + pd.to_timedelta([rng.randint(0, 2900) for _ in range(n)], unit='D')
+    return pd.DataFrame({
+        'id': range(1, n + 1),
+        'askingMemberId': members,
+        'askingMember': ['Member {m}'.format(m=m) for m in members],
+        'house': [rng.choice(['Commons', 'Lords']) for _ in range(n)],
+        'memberHasInterest': [rng.random() < 0.05 for _ in range(n)],
+        'dateTabled': tabled,
+        'dateForAnswer': tabled + pd.Timedelta(days=7),
+        'uin': [str(rng.randint(1, 999999)) for _ in range(n)],
+        'questionText': [q.capitalize() for q in questions],
+        'answeringBodyId': [rng.randint(1, 40) for _ in range(n)],
+        'answeringBodyName': [rng.choice(bodies) for _ in range(n)],
+        'isWithdrawn': False,
+        'isNamedDay': [rng.random() < 0.1 for _ in range(n)],
+        'answerIsHolding': False,
+        'answerIsCorrection': False,
+        'answeringMemberId': [rng.randint(1, 650) for _ in range(n)],
+        'answerText': ['<p>' + ' '.join(questions[rng.randrange(n)] for _ in range(3)) + '</p>' for _ in range(n)],
+        'dateAnswered': tabled + pd.Timedelta(days=10),
+        'attachmentCount': 0,
+        'heading': [rng.choice(['Electric Vehicles: Charging Points', 'Roads', 'Housing', 'Schools', 'NHS: Staff']) for _ in range(n)],
+        'latestPartyabbreviation': [rng.choice(['Con', 'Lab', 'LD', 'SNP']) for _ in range(n)],
+        'topic': [rng.choice(['transport', 'treasury', 'home department', 'education', 'health and social care']) for _ in range(n)],
+        'year_month': tabled.to_period('M').astype(str),
+        'cleanedQuestion': questions,
+        'contentHash': [rng.getrandbits(63) for _ in range(n)],
+        })
+
+
+def bench_search(n=200000, keyword='charging points'):
+    """
+    Compare counting the members asking about a keyword each month with str.contains over the whole frame (as the notebooks do) against a SearchIndex, and check that they agree.
+    The index matches words from their start, so the scan uses a word boundary to be comparable.
+    :return: a dict of timings in seconds.
+    """
+    wpqs = synthetic_cleaned_wpqs(n)
+    with tempfile.TemporaryDirectory() as tmp:
+        index = SearchIndex(Path(tmp) / 'search.sqlite')
+        started = time.perf_counter()
+        index.rebuild(wpqs)
+        build_seconds = time.perf_counter() - started
+
+        started = time.perf_counter()
+        sel = wpqs[wpqs.cleanedQuestion.str.contains(r'\b' + keyword)]
+        expected = sel.groupby(sel.dateTabled.dt.to_period('M')).askingMemberId.nunique()
+        scan_seconds = time.perf_counter() - started
+
+        started = time.perf_counter()
+        counts = index.counts(query=keyword_query(keyword, columns=['cleanedQuestion']), by='month')
+        query_seconds = time.perf_counter() - started
+        index.close()
+
+    if not (counts['members'].values == expected.values).all():
+        raise AssertionError('SearchIndex.counts disagrees with str.contains for {k!r}'.format(k=keyword))
+
+    result = {'questions': n, 'build_seconds': build_seconds, 'scan_seconds': scan_seconds, 'query_seconds': query_seconds}
+    print('search: {s:.0f}ms with str.contains, {q:.0f}ms with the index ({x:.0f}x), after {b:.1f}s to build it for {n:,} questions.'.format(
+        s=scan_seconds * 1000, q=query_seconds * 1000, x=scan_seconds / query_seconds, b=build_seconds, n=n))
+    return result
+
+
+def measure(load):
+    """
+    :return: the DataFrame returned by load(), the memory it takes up in bytes, the peak memory allocated while loading it, and the time it took in seconds.
+    """
+    tracemalloc.start()
+    started = time.perf_counter()
+    df = load()
+    seconds = time.perf_counter() - started
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return df, int(df.memory_usage(deep=True).sum()), peak, seconds
+
+
+def bench_cleaned_loader(n=200000):
+    """
+    Compare the memory taken by loading a cleaned archive with pd.read_csv (as the pipelines and notebooks do) against load_cleaned_archive, with and without cleanedQuestion.
+    :return: a dict of frame sizes and peak allocations in bytes, and load times in seconds.
+    """
+    with tempfile.TemporaryDirectory() as tmp:
+        cwd = os.getcwd()
+        # Cleaned CSV archives live in the working directory
+        os.chdir(tmp)
+        try:
+            synthetic_cleaned_wpqs(n).to_csv('pqs_cleaned.csv', index=False)
+            result = {'questions': n}
+            for label, load in [
+                    ('read_csv', lambda: pd.read_csv('pqs_cleaned.csv')),
+                    ('compact', lambda: load_cleaned_archive(tmp)),
+                    ('compact+cleanedQuestion', lambda: load_cleaned_archive(tmp, text=['cleanedQuestion'])),
+                    ]:
+                df, size, peak, seconds = measure(load)
+                result[label] = {'bytes': size, 'peak_bytes': peak, 'seconds': seconds}
+                print('{l:>24}: {s:7.1f}MB in memory, {p:7.1f}MB peak while loading, {t:.1f}s, {c} columns.'.format(l=label, s=size / 1e6, p=peak / 1e6, t=seconds, c=df.shape[1]))
+        finally:
+            os.chdir(cwd)
+    return result
+
+
+def peak_rss():
+    """
+    :return: the peak resident memory of this process so far in bytes, or None if it can't be measured.
+    """
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return peak if os.uname().sysname == 'Darwin' else peak * 1024
+
+
+def run_pipeline(stage, tmp, overrides):
+    """
+    Run one pipeline stage against the stub APIs, in the tmp folder. bench_pipelines runs each stage in a fresh process, so that its peak memory is its own.
+    :return: a dict of the stage's time in seconds, rows processed, the duration of each request, the process' peak memory in bytes, and the breakdown of its time recorded by the metrics module.
+    """
+    os.chdir(tmp)
+    # The stub's responses mustn't end up in (or come from) the real response cache
+    disable_cache()
+    with override_hosts(overrides) as timings, metrics.instrument() as recorded:
+        started = time.perf_counter()
+        if stage == 'download_mps':
+            active, former = UKParliament(tmp).download_mps(full_sweep=True, rate_limit=None)
+            rows = len(active) + len(former)
+        elif stage == 'refresh_mps':
+            active, former = UKParliament(tmp).download_mps(rate_limit=None)
+            rows = len(active) + len(former)
+        elif stage == 'update_answered_pqs':
+            rows = len(update_answered_pqs(tmp=tmp))
+        elif stage == 'download_ua_pqs':
+            rows = len(download_ua_pqs(tmp=tmp))
+        elif stage == 'clean_questions':
+            # The cleaning step of the pipelines on its own, over the raw archive update_answered_pqs downloaded
+            questions = pd.read_csv(Path(tmp) / 'pqs.csv', usecols=['questionText'])['questionText'].str.lower()
+            rows = len(clean_questions(questions))
+        else:
+            raise ValueError('Unknown stage {s!r}. Choose from {c}.'.format(s=stage, c=PIPELINE_STAGES))
+        seconds = time.perf_counter() - started
+    return {'seconds': seconds, 'rows': rows, 'timings': list(timings), 'peak_rss': peak_rss(), 'metrics': recorded.snapshot()}
+
+
+# The stages bench_pipelines runs, in order. The second update_answered_pqs is the daily incremental update, as the first downloads the full archive.
+PIPELINE_STAGES = ['download_mps', 'refresh_mps', 'update_answered_pqs', 'update_answered_pqs', 'download_ua_pqs', 'clean_questions']
+
+
+def bench_pipelines(stages=PIPELINE_STAGES, latency=0.02, questions_per_day=3, max_member_id=5000):
+    """
+    Run the download pipelines end to end against a local stand-in for the members and written questions APIs (see stub_api.StubAPI), so that changes to them can be measured without touching Parliament's servers.
+    Each stage runs in a fresh process in the same tmp folder, so later stages see the files earlier ones saved, as they would for real.
+    :param stages: list, default PIPELINE_STAGES.
+    :param latency: float, default 0.02. The stub's mean response time in seconds.
+    :param questions_per_day: int, default 3. The stub's WPQs per day since May 2014.
+    :param max_member_id: int, default 5000. The stub's highest member id.
+    :return: a list of dicts, one per stage, with its time, throughput in requests and rows per second, p50/p99 request latency in seconds, peak memory in bytes, and its metrics (see metrics.Metrics.snapshot).
+    """
+    results = []
+    # Spawned rather than forked, so that the children don't start out with the parent's memory (or the stub's threads)
+    context = multiprocessing.get_context('spawn')
+    with StubAPI(latency=latency, max_member_id=max_member_id, questions_per_day=questions_per_day) as stub, tempfile.TemporaryDirectory() as tmp:
+        for stage in stages:
+            with context.Pool(1) as pool:
+                run = pool.apply(run_pipeline, (stage, tmp, stub.overrides()))
+            timings = np.array(run['timings'])
+            result = {
+                'stage': stage,
+                'seconds': run['seconds'],
+                'requests': len(timings),
+                'rows': run['rows'],
+                'requests_per_second': len(timings) / run['seconds'],
+                'rows_per_second': run['rows'] / run['seconds'],
+                'p50': float(np.percentile(timings, 50)) if len(timings) > 0 else None,
+                'p99': float(np.percentile(timings, 99)) if len(timings) > 0 else None,
+                'peak_rss': run['peak_rss'],
+                'metrics': run['metrics'],
+                }
+            results.append(result)
+
+        print('\n{s:>20} {t:>8} {r:>8} {rps:>8} {n:>9} {nps:>9} {p50:>8} {p99:>8} {m:>8}'.format(
+            s='stage', t='seconds', r='requests', rps='req/s', n='rows', nps='rows/s', p50='p50 ms', p99='p99 ms', m='peak MB'))
+        for r in results:
+            print('{s:>20} {t:8.1f} {r:8d} {rps:8.0f} {n:9,d} {nps:9,.0f} {p50:>8} {p99:>8} {m:>8}'.format(
+                s=r['stage'], t=r['seconds'], r=r['requests'], rps=r['requests_per_second'], n=r['rows'], nps=r['rows_per_second'],
+                p50='-' if r['p50'] is None else '{x:.0f}'.format(x=r['p50'] * 1000), p99='-' if r['p99'] is None else '{x:.0f}'.format(x=r['p99'] * 1000),
+                m='-' if r['peak_rss'] is None else '{x:.0f}'.format(x=r['peak_rss'] / 1e6)))
+    return results
+
+
+if __name__ == '__main__':
+    bench_question_cleaner()
+    bench_job_tables()
+    bench_search()
+    bench_cleaned_loader()
+    bench_pipelines()
@@ -0,0 +1,89 @@
+import json
+import os
+import threading
+import time
+
+
+class Checkpoint:
+    """
+    A journal of the units of work (ids, date windows...) which a long download has finished, with their results, appended to a JSONL file in the tmp folder as each one completes.
+
+    If the download dies part way through, the next run opens the same journal, skips every unit in it, and reuses the results already fetched. Once a download succeeds, call finish() to remove the journal, so that the next run starts afresh.
+    """
+
+    def __init__(self, path, max_age_hours=24):
+        """
+        :param path: str, the journal file, e.g. 'tmp/members_checkpoint.jsonl'.
+        :param max_age_hours: float, default 24. A journal which hasn't been written to for longer than this is assumed to be stale, and is discarded rather than resumed. None always resumes.
+        """
+        self.path = path
+        self.completed = {}
+        self._lock = threading.Lock()
+        if os.path.exists(path) and max_age_hours is not None and time.time() - os.path.getmtime(path) > max_age_hours * 3600:
+            print('Discarding the checkpoint in {p}, which is more than {h} hours old.'.format(p=path, h=max_age_hours))
+            os.remove(path)
+        if os.path.exists(path):
+            with open(path) as infile:
+                for line in infile:
+                    # The last line may have been cut off by the crash
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue
+                    self.completed[self.key(record['unit'])] = record['result']
+            if len(self.completed) > 0:
+                print('Resuming from checkpoint: {n} units were already done.'.format(n=len(self.completed)))
+            # Start on a fresh line, in case the last record was only partly written
+            with open(path, 'rb') as infile:
+                infile.seek(0, os.SEEK_END)
+                if infile.tell() > 0:
+                    infile.seek(-1, os.SEEK_END)
+                    partial = infile.read(1) != b'\n'
+                else:
+                    partial = False
+            if partial:
+                with open(path, 'a') as outfile:
+                    outfile.write('\n')
+        self._journal = open(path, 'a')
+
+    @staticmethod
+    def key(unit):
+        # Units can be ints, strings or tuples/lists, e.g. a (from, to) window, which come back from json as lists
+        return json.dumps(list(unit) if isinstance(unit, tuple) else unit)
+
+    def __len__(self):
+        return len(self.completed)
+
+    def __contains__(self, unit):
+        return self.key(unit) in self.completed
+
+    def result(self, unit):
+        """
+        :return: the result recorded for a unit.
+        """
+        return self.completed[self.key(unit)]
+
+    def record(self, unit, result=None):
+        """
+        Record that a unit is done. Safe to call from worker threads.
+        :param unit: an int, str or tuple identifying the unit.
+        :param result: anything json-serialisable, default None. What the unit produced, to be reused on a resumed run.
+        """
+        line = json.dumps({'unit': list(unit) if isinstance(unit, tuple) else unit, 'result': result}) + '\n'
+        with self._lock:
+            self.completed[self.key(unit)] = result
+            self._journal.write(line)
+            self._journal.flush()
+
+    def close(self):
+        if self._journal is not None:
+            self._journal.close()
+            self._journal = None
+
+    def finish(self):
+        """
+        The download succeeded: close and remove the journal.
+        """
+        self.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
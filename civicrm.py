@@ -0,0 +1,188 @@
+import json
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import pandas as pd
+import requests
+from tqdm import tqdm
+
+from http_client import make_session
+
+
+# Our CRM endpoint. NB the custom field names used below (custom_68 etc.) are specific to our CiviCRM install.
+CIVI_URL = 'https://civi.newautomotive.org/wp-content/plugins/civicrm/civicrm/extern/rest.php'
+
+
+def civi_call(session, url, entity, action, params, site_key, user_key, method='get'):
+    """
+    Make a single call to CiviCRM's REST API (v3). The call's parameters are sent json-encoded, which allows nested filters like {'custom_68': {'IN': [...]}} and chained calls.
+    :param session: a requests.Session
+    :param url: str, the CRM's rest.php endpoint.
+    :param entity: str, e.g. 'Contact'
+    :param action: str, e.g. 'get' or 'create'
+    :param params: dict, the parameters of the call.
+    :param site_key: str, the CRM's site key.
+    :param user_key: str, the API key of the CRM user.
+    :param method: str, default 'get'. Calls which change anything should be sent with 'post'.
+    :return: the decoded json response.
+    :raises RuntimeError: if the CRM reports an error.
+    """
+    query = {'entity': entity, 'action': action, 'api_key': user_key, 'key': site_key, 'json': json.dumps(params)}
+    if method == 'post':
+        r = session.post(url=url, data=query)
+    else:
+        r = session.get(url=url, params=query)
+    r.raise_for_status()
+    data = r.json()
+    if data.get('is_error'):
+        raise RuntimeError('CiviCRM {e}.{a} failed: {m}'.format(e=entity, a=action, m=data.get('error_message')))
+    return data
+
+
+def find_contacts(mp_ids, site_key, user_key, url=CIVI_URL, chunk_size=100, max_workers=4, session=None):
+    """
+    Look up the CRM contacts for many Parliamentary API numbers at once. The ids are sent in chunks, using an IN filter on custom_68, and the chunks are sent concurrently over one pooled session.
+    :param mp_ids: list of Ints, Parliamentary API numbers.
+    :param site_key: str, the CRM's site key.
+    :param user_key: str, the API key of the CRM user.
+    :param url: str, default CIVI_URL. The CRM's rest.php endpoint.
+    :param chunk_size: int, default 100. How many ids are looked up in each call.
+    :param max_workers: int, default 4. How many calls are sent at once.
+    :param session: a requests.Session, default None. If None, a pooled session with retries is created.
+    :return: a dict of {api number: list of contacts with that custom_68}. Ids without a contact are left out.
+    """
+    if session is None:
+        session = make_session(pool_size=max_workers, cache=False)
+    mp_ids = sorted(set(int(x) for x in mp_ids))
+    chunks = [mp_ids[i:i + chunk_size] for i in range(0, len(mp_ids), chunk_size)]
+
+    def lookup(chunk):
+        params = {
+            'sequential': 1,
+            'return': 'custom_68,sort_name,first_name,last_name',
+            'custom_68': {'IN': chunk},
+            # The API only returns 25 contacts unless told otherwise
+            'options': {'limit': 0},
+            }
+        return civi_call(session, url, 'Contact', 'get', params, site_key, user_key)['values']
+
+    contacts = {}
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(lookup, chunk) for chunk in chunks]
+        for future in tqdm(as_completed(futures), total=len(futures)):
+            for contact in future.result():
+                contacts.setdefault(int(contact['custom_68']), []).append(contact)
+    return contacts
+
+
+# The columns of a DataFrame of parliamentarians, as taken by UKParliament.create_parliamentarian, and the CRM fields they are stored in
+PARLIAMENTARIAN_FIELDS = {
+    'mp_id': 'custom_68',
+    'sort_name': 'sort_name',
+    'party': 'custom_70',
+    'house': 'custom_65',
+    'last_name': 'last_name',
+    'first_name': 'first_name',
+    'display_name': 'display_name',
+    'legal_name': 'legal_name',
+    }
+
+
+def parliamentarian_params(row):
+    """
+    :param row: a dict or Series with some of the columns in PARLIAMENTARIAN_FIELDS.
+    :return: a dict of parameters for a Contact.create call.
+    """
+    params = {
+        'contact_type': 'Individual',
+        'contact_sub_type': 'Member_of_UK_Parliament',
+        'custom_64': 'Active',
+        }
+    for column, field in PARLIAMENTARIAN_FIELDS.items():
+        if column in row and not pd.isna(row[column]):
+            params[field] = str(row[column])
+    return params
+
+
+def upsert_parliamentarians(members, site_key, user_key, url=CIVI_URL, batch_size=25, max_workers=4, update_existing=True, session=None):
+    """
+    Create (or update) many parliamentarians in the CRM at once. This is idempotent on custom_68 (the Parliamentary API number): members who already have a contact are updated rather than created again, so it is safe to re-run after a partial failure.
+
+    Creates and updates are sent in batches of batch_size, as chained calls (api.Contact.create) on a single Domain.get, with up to max_workers batches in flight. If a batch fails, its rows are retried one at a time, so that the error can be pinned on the right row.
+
+    :param members: a DataFrame with an mp_id column, and any of the other columns in PARLIAMENTARIAN_FIELDS.
+    :param site_key: str, the CRM's site key.
+    :param user_key: str, the API key of the CRM user.
+    :param url: str, default CIVI_URL. The CRM's rest.php endpoint.
+    :param batch_size: int, default 25. How many contacts are sent in each call. 1 sends a plain Contact.create per member.
+    :param max_workers: int, default 4. How many calls are sent at once.
+    :param update_existing: bool, default True. If False, members who already have a contact are left alone.
+    :param session: a requests.Session, default None. If None, a pooled session with retries is created.
+    :return: a DataFrame with the same index as members, and columns mp_id, status ('created', 'updated', 'exists', 'duplicate' or 'error'), contact_id and error.
+    """
+    if session is None:
+        session = make_session(pool_size=max_workers, cache=False)
+    results = pd.DataFrame({'mp_id': members['mp_id'].astype(int), 'status': None, 'contact_id': None, 'error': None}, index=members.index)
+
+    existing = find_contacts(results['mp_id'], site_key, user_key, url=url, max_workers=max_workers, session=session)
+
+    # Work out what to do with each row
+    queue = []
+    seen = set()
+    for index, row in members.iterrows():
+        mp = int(row['mp_id'])
+        found = existing.get(mp, [])
+        if mp in seen:
+            results.loc[index, ['status', 'error']] = ['duplicate', 'mp_id {m} appears more than once in members'.format(m=mp)]
+        elif len(found) > 1:
+            results.loc[index, ['status', 'error']] = ['duplicate', '{n} contacts in the CRM already have custom_68 = {m}'.format(n=len(found), m=mp)]
+        elif len(found) == 1 and not update_existing:
+            results.loc[index, ['status', 'contact_id']] = ['exists', found[0]['id']]
+        else:
+            params = parliamentarian_params(row)
+            if len(found) == 1:
+                params['id'] = found[0]['id']
+            queue.append((index, params, 'updated' if len(found) == 1 else 'created'))
+        seen.add(mp)
+
+    def create_one(index, params, status):
+        try:
+            data = civi_call(session, url, 'Contact', 'create', params, site_key, user_key, method='post')
+            return index, status, data['id'], None
+        except (RuntimeError, requests.RequestException) as e:
+            return index, 'error', None, str(e)
+
+    def create_batch(batch):
+        if len(batch) == 1:
+            return [create_one(*batch[0])]
+        try:
+            # is_transactional asks the CRM to roll back the whole batch if any of it fails
+            params = {'current_domain': 1, 'sequential': 1, 'is_transactional': 1, 'api.Contact.create': [p for _, p, _ in batch]}
+            created = civi_call(session, url, 'Domain', 'get', params, site_key, user_key, method='post')['values'][0]['api.Contact.create']
+            if len(created) != len(batch) or any(r.get('is_error') for r in created):
+                raise RuntimeError('chained Contact.create failed')
+            return [(index, status, r['id'], None) for (index, _, status), r in zip(batch, created)]
+        except (RuntimeError, requests.RequestException, KeyError, IndexError):
+            pass
+        # Some of the batch may have been created before it failed, so check again before retrying each row
+        try:
+            done = find_contacts([p['custom_68'] for _, p, _ in batch], site_key, user_key, url=url, max_workers=1, session=session)
+        except (RuntimeError, requests.RequestException) as e:
+            return [(index, 'error', None, str(e)) for index, _, _ in batch]
+        retried = []
+        for index, params, status in batch:
+            found = done.get(int(params['custom_68']), [])
+            if status == 'created' and len(found) == 1:
+                retried.append((index, status, found[0]['id'], None))
+            else:
+                retried.append(create_one(index, params, status))
+        return retried
+
+    batches = [queue[i:i + batch_size] for i in range(0, len(queue), batch_size)]
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(create_batch, batch) for batch in batches]
+        for future in tqdm(as_completed(futures), total=len(futures)):
+            for index, status, contact_id, error in future.result():
+                results.loc[index, ['status', 'contact_id', 'error']] = [status, contact_id, error]
+
+    print(', '.join('{n} {s}'.format(n=n, s=s) for s, n in results['status'].value_counts().items()))
+    return results
@@ -6,11 +6,30 @@ import pandas as pd
 import glob
 import os
 from pathlib import Path
-import geojson
+import hashlib
 
-def download_constituencies(path_to_tmp):
+from sweep import refresh_ids, ResponseCollector
+from http_client import make_session
+from id_index import IdIndex
+from checkpoint import Checkpoint
+import metrics
+from mapping import RESOLUTIONS, build_boundary_caches
+
+# Parliamentary constituency boundaries, December 2020, from the ONS
+BOUNDARIES_URL = 'https://opendata.arcgis.com/datasets/19841da5f8f6403e9fdcfb35c16e11e9_0.geojson'
+
+@metrics.instrumented('download_constituencies')
+def download_constituencies(path_to_tmp, full_sweep=False, max_workers=16, rate_limit=20, spill=False, resume=True):
     """
     This method sweeps and downloads the latest data on constituencies. 
+    The ids known to be real are kept in constituencies_index.json in the tmp folder. After the first run, only those ids are re-fetched (with conditional requests where the API supports them), and new ids are looked for above the highest known id.
+
+    :param path_to_tmp: str, the folder in which to save active_constituencies.csv and former_constituencies.csv
+    :param full_sweep: bool, default False. If True, poll every possible id again rather than refreshing the known ids.
+    :param max_workers: int, default 16. The number of requests sent to the API at once.
+    :param rate_limit: float, default 20. The maximum number of requests per second sent to the API. None switches rate limiting off.
+    :param spill: bool, default False. If True, responses are also written to constituencies_sweep.jsonl in the tmp folder as they arrive, so they can be recovered with sweep.ResponseCollector.recover if the sweep crashes. The file is removed once the sweep succeeds.
+    :param resume: bool, default True. Every id is journalled in constituencies_checkpoint.jsonl in the tmp folder as it completes. If a previous run died part way through, carry on from its journal rather than starting again. If False, the journal is discarded.
     :return: Two DataFrames, active_c_df, former_c_df
     """
     ########################
@@ -18,41 +37,34 @@ def download_constituencies(path_to_tmp):
     ########################
 
     # First we determine which id numbers are real and which do not refer
-    possible_numbers = [x for x in range(0, 5001)]
-
-    # We iterate through the possible numbers and append those with response code 200 (success) to the actual numbers
-    print('Getting new list of Constituency id numbers + info. This can take about 15 minutes...')
-
-    for constituency_id in tqdm(possible_numbers):
-        url = 'https://members-api.parliament.uk/api/Location/Constituency/{p}'.format(p=constituency_id)
-        headers = {'accept': 'text/plain'}
-        response = requests.get(url, headers=headers)
-        # If the response is valid (i.e. there's an MP) save the info to the 
-        if response.status_code == 200:
-            data = response.json()
-            if data['value']['endDate'] is None:
-                with open(path_to_tmp+'/{}_active_info.json'.format(constituency_id), 'w') as outfile:
-                    json.dump(data['value'], outfile)
-            else:
-                with open(path_to_tmp+'/{}_former_info.json'.format(constituency_id), 'w') as outfile:
-                    json.dump(data['value'], outfile)
+    possible_numbers = range(0, 5001)
+    index = IdIndex(path_to_tmp+'/constituencies_index.json')
+
+    # We sweep through the possible numbers (or just the known ones) and keep those with response code 200 (success)
+    if full_sweep or len(index) == 0:
+        print('Getting new list of Constituency id numbers + info. This can take a few minutes...')
+    else:
+        print('Refreshing constituency info...')
+
+    # Each valid response (i.e. there's a constituency) goes straight into an in-memory collector, sorted into active and former constituencies
+    collector = ResponseCollector(spill_path=path_to_tmp+'/constituencies_sweep.jsonl' if spill else None)
+
+    def collect_constituency(constituency_id, data):
+        if data['value']['endDate'] is None:
+            collector.add('active', constituency_id, data['value'])
         else:
-            pass
-
-    # We'll combine the current constituencies into one big bit of json
-    combined_json = []
-    combined_former_json = []
-    # Here we iterate through the downloaded json and add it into the big bit of json
-    for f in tqdm(glob.glob(path_to_tmp+'/*_active_info.json')):
-        with open(f, 'rb') as infile:
-            combined_json.append(json.load(infile))
-    # Iterating through more globs of json
-    for f in tqdm(glob.glob(path_to_tmp+'/*_former_info.json')):
-        with open(f, 'rb') as infile:
-            combined_former_json.append(json.load(infile))
-
-    active_constituencies_df = pd.json_normalize(combined_json)
-    former_constituencies_df = pd.json_normalize(combined_former_json)
+            collector.add('former', constituency_id, data['value'])
+
+    checkpoint_path = path_to_tmp+'/constituencies_checkpoint.jsonl'
+    if not resume and os.path.exists(checkpoint_path):
+        os.remove(checkpoint_path)
+    checkpoint = Checkpoint(checkpoint_path)
+
+    refresh_ids('https://members-api.parliament.uk/api/Location/Constituency/{id}', possible_numbers, index, collect_constituency, full_sweep=full_sweep, max_workers=max_workers, rate_limit=rate_limit, checkpoint=checkpoint)
+
+    active_constituencies_df = collector.frame('active')
+    former_constituencies_df = collector.frame('former')
+    collector.close()
 
     ########################
     # START DATA WRANGLING #
@@ -73,44 +85,66 @@ def download_constituencies(path_to_tmp):
     # END DATA WRANGLING #
     ######################
 
-    #######################
-    # START FILE CLEAN-UP #
-    #######################
+    print('All done updating the constituencies with latest data! Be on your merry way.')
 
-    # Get a list of all the file paths that ends with .txt from in specified directory
-    fileList = glob.glob(path_to_tmp+'/*_active_info.json')
-    # Iterate over the list of filepaths & remove each file.
-    print('Cleaning up... active_info.json files...')
-    for filePath in tqdm(fileList):
-        try:
-            os.remove(filePath)
-        except:
-            print("Error while deleting file : ", filePath)
-
-    # Get a list of all the file paths that ends with .txt from in specified directory
-    fileList = glob.glob(path_to_tmp+'/*_former_info.json')
-    # Iterate over the list of filepaths & remove each file.
-    print('Cleaning up... former_info.json files...')
-    for filePath in tqdm(fileList):
-        try:
-            os.remove(filePath)
-        except:
-            print("Error while deleting file : ", filePath)
-    print('All done updating the Parliamentarians with latest data! Be on your merry way.')
-
-    #######################
-    # END FILE CLEAN-UP   #
-    #######################
-    active_constituencies_df.to_csv(path_to_tmp+'/active_constituencies.csv', index=False)
-    former_constituencies_df.to_csv(path_to_tmp+'/former_constituencies.csv', index=False)
+    with metrics.timer('csv_write'):
+        active_constituencies_df.to_csv(path_to_tmp+'/active_constituencies.csv', index=False)
+        former_constituencies_df.to_csv(path_to_tmp+'/former_constituencies.csv', index=False)
+    metrics.increment('rows', len(active_constituencies_df) + len(former_constituencies_df))
+    checkpoint.finish()
     return active_constituencies_df, former_constituencies_df
 
-def download_shapefiles(path_to_tmp):
+def download_shapefiles(path_to_tmp, url=BOUNDARIES_URL, checksum=None, chunk_size=1 << 20, tolerances=RESOLUTIONS):
+    """
+    Download the constituency boundaries to pcon_boundaries.geojson in the tmp folder, and build the simplified boundary caches used for mapping (see mapping.build_boundary_caches).
+    The file is streamed straight to disk a chunk at a time, so memory use doesn't grow with the size of the file, and it only replaces the previous download once it has been checked.
+    Its SHA-256 is saved next to it, in pcon_boundaries.geojson.sha256.
+
+    :param path_to_tmp: str, the tmp folder.
+    :param url: str, default BOUNDARIES_URL.
+    :param checksum: str, default None. The SHA-256 the download should have, in hex. If None, only its length is checked.
+    :param chunk_size: int, default 1MB. How much is read from the connection and written to disk at a time.
+    :param tolerances: list, default mapping.RESOLUTIONS. The resolution levels to build. An empty list builds none.
+    :return: str, the SHA-256 of the download.
+    :raises IOError: if the download is cut short, or its checksum doesn't match.
+    """
     print('Downloading Parliamentary constituency shapefiles, December 2020 versions. \nUpdate link in constituencies.download_shapefiles to get more recent boundaries. ')
-    r = requests.get('https://opendata.arcgis.com/datasets/19841da5f8f6403e9fdcfb35c16e11e9_0.geojson')
-    gj = geojson.loads(r.content)
-    with open(path_to_tmp+'/pcon_boundaries.geojson', 'w') as f:
-        geojson.dump(gj, f)
+    path = Path(path_to_tmp) / 'pcon_boundaries.geojson'
+    part = Path(path_to_tmp) / 'pcon_boundaries.geojson.part'
+    digest = hashlib.sha256()
+    size = 0
+    # The file is far too big for the response cache
+    session = make_session(pool_size=1, cache=False)
+    with session.get(url, stream=True) as r:
+        r.raise_for_status()
+        # Content-Length counts the bytes sent, which only match the bytes written if they weren't compressed
+        expected_size = int(r.headers['Content-Length']) if 'Content-Length' in r.headers and 'Content-Encoding' not in r.headers else None
+        with open(part, 'wb') as outfile:
+            with tqdm(total=expected_size, unit='B', unit_scale=True) as progress:
+                for chunk in r.iter_content(chunk_size=chunk_size):
+                    outfile.write(chunk)
+                    digest.update(chunk)
+                    size += len(chunk)
+                    progress.update(len(chunk))
+
+    sha256 = digest.hexdigest()
+    if expected_size is not None and size != expected_size:
+        os.remove(part)
+        raise IOError('The boundaries download was cut short: got {s} of {e} bytes.'.format(s=size, e=expected_size))
+    if checksum is not None and sha256 != checksum.lower():
+        os.remove(part)
+        raise IOError('The boundaries download has SHA-256 {d}, not {c}.'.format(d=sha256, c=checksum))
+    os.replace(part, path)
+    with open(str(path) + '.sha256', 'w') as outfile:
+        outfile.write(sha256 + '\n')
+
+    if len(tolerances) > 0:
+        try:
+            build_boundary_caches(path_to_tmp, tolerances)
+        except ImportError as e:
+            # The download itself doesn't need geopandas, and the caches are built again the first time mapping.ConstituencyMap is used
+            print('Skipping the boundary caches: {e}'.format(e=e))
+    return sha256
 
 if __name__ == '__main__':
     
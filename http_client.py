@@ -0,0 +1,323 @@
+import hashlib
+import json
+import re
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from datetime import date
+from urllib.parse import parse_qs, urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests.structures import CaseInsensitiveDict
+from urllib3.util.retry import Retry
+
+import metrics
+
+
+# Parliament's APIs return JSON, but advertise it as text/plain
+HEADERS = {'accept': 'text/plain'}
+
+# Status codes which are worth retrying: rate limiting and transient server errors
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+# A date in a query parameter, e.g. answeredWhenTo=2022-05-06
+DATE_RE = re.compile(r'^\d{4}-\d{2}-\d{2}')
+
+
+def is_open_window(url):
+    """
+    :return: True if any of the url's query parameters is a date of today or later, e.g. a WPQ date window which runs up to tomorrow. Questions are still being tabled and answered in such a window, so its responses mustn't be cached.
+    """
+    today = date.today().isoformat()
+    for values in parse_qs(urlsplit(url).query).values():
+        for value in values:
+            if DATE_RE.match(value) and value[:10] >= today:
+                return True
+    return False
+
+
+class ResponseCache:
+    """
+    An on-disk cache of successful GET responses, kept in a single SQLite file and keyed by the full URL (including the query string).
+
+    Entries older than `ttl` seconds are treated as missing. Once the cached bodies add up to more than `max_bytes`, the least recently used entries are evicted.
+    If `bypass` is True, the cache is never read from, but fresh responses are still written to it, which forces a refresh.
+    The cache can be shared between threads.
+    """
+
+    def __init__(self, path, ttl=24 * 3600, max_bytes=512 * 1024 ** 2, bypass=False):
+        """
+        :param path: str, the SQLite file, e.g. 'tmp/http_cache.sqlite'. It is created if it doesn't exist.
+        :param ttl: float, default 1 day. How many seconds a response is served from the cache. None keeps responses until they are evicted.
+        :param max_bytes: int, default 512MB. The most response data kept in the cache.
+        :param bypass: bool, default False. If True, always fetch a fresh response (and cache it).
+        """
+        self.path = path
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.bypass = bypass
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute('CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, url TEXT, status INTEGER, headers TEXT, body BLOB, size INTEGER, created REAL, last_access REAL)')
+        self._db.execute('CREATE INDEX IF NOT EXISTS responses_last_access ON responses (last_access)')
+        self._db.commit()
+
+    @staticmethod
+    def key(url):
+        return hashlib.sha1(url.encode()).hexdigest()
+
+    def get(self, url):
+        """
+        :param url: str, the full URL of the request, including the query string.
+        :return: a requests.Response rebuilt from the cache, or None if there is no fresh entry for the url.
+        """
+        if self.bypass:
+            return None
+        key = self.key(url)
+        now = time.time()
+        with self._lock:
+            row = self._db.execute('SELECT status, headers, body, created FROM responses WHERE key = ?', (key,)).fetchone()
+            if row is not None and self.ttl is not None and now - row[3] > self.ttl:
+                self._db.execute('DELETE FROM responses WHERE key = ?', (key,))
+                self._db.commit()
+                row = None
+            if row is None:
+                self.misses += 1
+                return None
+            self._db.execute('UPDATE responses SET last_access = ? WHERE key = ?', (now, key))
+            self._db.commit()
+            self.hits += 1
+        response = requests.Response()
+        response.status_code = row[0]
+        response.headers = CaseInsensitiveDict(json.loads(row[1]))
+        response._content = row[2]
+        response.url = url
+        response.encoding = requests.utils.get_encoding_from_headers(response.headers)
+        response.from_cache = True
+        return response
+
+    def put(self, url, response):
+        """
+        Cache a response, then evict the least recently used entries until the cache is back under max_bytes.
+        """
+        body = response.content
+        now = time.time()
+        with self._lock:
+            self._db.execute('INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                             (self.key(url), url, response.status_code, json.dumps(dict(response.headers)), body, len(body), now, now))
+            total = self._db.execute('SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()[0]
+            if total > self.max_bytes:
+                for key, size in self._db.execute('SELECT key, size FROM responses ORDER BY last_access').fetchall():
+                    if total <= self.max_bytes:
+                        break
+                    self._db.execute('DELETE FROM responses WHERE key = ?', (key,))
+                    total -= size
+            self._db.commit()
+
+    def stats(self):
+        """
+        :return: a dict with the number of cache 'hits' and 'misses' since the cache was opened, and the number of 'entries' and 'bytes' in it.
+        """
+        with self._lock:
+            entries, size = self._db.execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses').fetchone()
+        return {'hits': self.hits, 'misses': self.misses, 'entries': entries, 'bytes': size}
+
+    def clear(self):
+        with self._lock:
+            self._db.execute('DELETE FROM responses')
+            self._db.commit()
+
+    def close(self):
+        self._db.close()
+
+
+# The response cache shared by every session made with make_session. None until use_cache is called.
+_cache = None
+
+
+def use_cache(path, ttl=24 * 3600, max_bytes=512 * 1024 ** 2, bypass=False):
+    """
+    Switch on the shared response cache, so that every request made to Parliament's APIs (by UKParliament, wpqs and constituencies) is served from it where possible.
+    Call it again with bypass=True to force a refresh of everything that's fetched.
+    :param path: str, the SQLite file for the cache, e.g. 'tmp/http_cache.sqlite'.
+    :return: the ResponseCache
+    """
+    global _cache
+    if _cache is not None:
+        _cache.close()
+    _cache = ResponseCache(path, ttl=ttl, max_bytes=max_bytes, bypass=bypass)
+    return _cache
+
+
+def get_cache():
+    """
+    :return: the shared ResponseCache, or None if caching is switched off.
+    """
+    return _cache
+
+
+def disable_cache():
+    global _cache
+    if _cache is not None:
+        _cache.close()
+    _cache = None
+
+
+class CachedSession(requests.Session):
+    """
+    A requests Session which serves GET requests from a ResponseCache, and caches successful (200) responses.
+    Responses served from the cache have `from_cache = True`. Without a cache of its own, the session uses the shared cache set up by use_cache, if there is one.
+    Requests for a date window which reaches today (see is_open_window) always go to the API and are never cached, so a daily update can't miss PQs tabled or answered since the first fetch of the day. Closed historical windows and the member and constituency lookups are cached.
+    With metrics on, every GET which could have come from the cache counts towards one of the cache_hits, cache_misses and cache_bypassed (open windows) counters, so the hit rate is hits over all three.
+    """
+
+    def __init__(self, cache=None):
+        super().__init__()
+        self.cache = cache
+
+    def request(self, method, url, params=None, **kwargs):
+        cache = self.cache if self.cache is not None else _cache
+        if cache is None or method.upper() != 'GET':
+            return super().request(method, url, params=params, **kwargs)
+        full_url = requests.Request('GET', url, params=params).prepare().url
+        if is_open_window(full_url):
+            metrics.increment('cache_bypassed')
+            return super().request(method, url, params=params, **kwargs)
+        response = cache.get(full_url)
+        if response is not None:
+            metrics.increment('cache_hits')
+            return response
+        metrics.increment('cache_misses')
+        response = super().request(method, url, params=params, **kwargs)
+        if response.status_code == 200:
+            cache.put(full_url, response)
+        return response
+
+
+# Base URLs whose requests are sent somewhere else, and a list their durations are recorded in. See override_hosts.
+_overrides = {}
+_override_timings = None
+
+
+class OverridableAdapter(HTTPAdapter):
+    """
+    An HTTPAdapter which sends requests for an overridden base URL (see override_hosts) to its replacement instead.
+    While instrumentation is on (see metrics.instrument), it also counts the requests it sends, the bytes it downloads and the retries urllib3 made, and times the wait for each response.
+    """
+
+    def send(self, request, **kwargs):
+        timings = None
+        for base, replacement in _overrides.items():
+            if request.url.startswith(base):
+                timings = _override_timings
+                request.url = replacement + request.url[len(base):]
+                break
+        if timings is None and not metrics.enabled():
+            return super().send(request, **kwargs)
+
+        started = time.perf_counter()
+        response = super().send(request, **kwargs)
+        if timings is not None:
+            timings.append(time.perf_counter() - started)
+        if metrics.enabled():
+            if kwargs.get('stream'):
+                size = int(response.headers.get('Content-Length', 0))
+            else:
+                # requests reads the body straight after this anyway, so reading it here costs nothing extra and counts the wait for it
+                size = len(response.content)
+            metrics.observe('http', time.perf_counter() - started)
+            metrics.increment('requests')
+            metrics.increment('bytes_downloaded', size)
+            retries = getattr(response.raw, 'retries', None)
+            if retries is not None and len(retries.history) > 0:
+                metrics.increment('retries', len(retries.history))
+        return response
+
+
+@contextmanager
+def override_hosts(overrides):
+    """
+    While in the with block, send the requests for some base URLs somewhere else, e.g. to a local stand-in for an API in benchmarks. Every session made by make_session is affected, including those made before the block.
+    Responses are still cached under their original URLs, so switch the cache off (disable_cache) while overriding.
+    :param overrides: dict of {base URL: replacement}, e.g. {'https://members-api.parliament.uk': 'http://127.0.0.1:8000'}
+    :return: a list, to which the time in seconds each overridden request took (including any retries) is appended as it completes.
+    """
+    global _overrides, _override_timings
+    timings = []
+    _overrides, _override_timings = dict(overrides), timings
+    try:
+        yield timings
+    finally:
+        _overrides, _override_timings = {}, None
+
+
+def make_session(pool_size=16, retries=5, backoff_factor=0.5, cache=True):
+    """
+    Build a requests Session with a pool of keep-alive connections, which retries rate limited (429) and 5xx responses with exponential backoff.
+    :param pool_size: int, default 16. The number of connections kept open per host. Should be at least the number of threads sharing the session.
+    :param retries: int, default 5. How many times a failed request is retried before giving up.
+    :param backoff_factor: float, default 0.5. Retries sleep for backoff_factor * 2 ** (retry number - 1) seconds. A Retry-After header from the server takes precedence.
+    :param cache: default True. True serves GET requests from the shared cache whenever use_cache has switched it on, a ResponseCache uses that cache instead, and False never caches.
+    :return: a requests.Session
+    """
+    retry = Retry(
+        total=retries,
+        backoff_factor=backoff_factor,
+        status_forcelist=RETRY_STATUSES,
+        respect_retry_after_header=True,
+        raise_on_status=False,
+        )
+    adapter = OverridableAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+    if cache is False:
+        session = requests.Session()
+    else:
+        session = CachedSession(cache if isinstance(cache, ResponseCache) else None)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    session.headers.update(HEADERS)
+    return session
+
+
+# A session for the one-off requests made outside of sweeps
+_session = None
+
+
+def get_session():
+    """
+    :return: a pooled session with retries, shared by every caller, which uses the shared response cache.
+    """
+    global _session
+    if _session is None:
+        _session = make_session()
+    return _session
+
+
+class RateLimiter:
+    """
+    A thread-safe limiter which spaces out requests to each host, so that no host receives more than `rate` requests per second across all threads.
+    A rate of None or 0 switches the limiter off.
+    """
+
+    def __init__(self, rate=None):
+        self.rate = rate
+        self._next_slot = {}
+        self._lock = threading.Lock()
+
+    def wait(self, url):
+        """
+        Block until a request to the host in `url` is allowed.
+        """
+        if not self.rate:
+            return
+        host = urlsplit(url).netloc
+        with self._lock:
+            now = time.monotonic()
+            slot = max(now, self._next_slot.get(host, now))
+            self._next_slot[host] = slot + 1.0 / self.rate
+        delay = slot - now
+        if delay > 0:
+            time.sleep(delay)
@@ -0,0 +1,98 @@
+import hashlib
+import json
+import os
+from datetime import datetime
+
+
+class IdIndex:
+    """
+    A persistent index of the ids which are known to exist on an API endpoint, saved as a json file in the tmp folder.
+
+    For every known id it keeps the last payload, a hash of that payload, when it was last seen, and the ETag/Last-Modified headers (if the API sent any) so that later refreshes can make conditional requests.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.entries = {}
+        if os.path.exists(path):
+            with open(path) as infile:
+                self.entries = {int(k): v for k, v in json.load(infile).items()}
+
+    def __len__(self):
+        return len(self.entries)
+
+    def known_ids(self):
+        """
+        :return: a sorted list of every known id.
+        """
+        return sorted(self.entries)
+
+    def max_id(self):
+        """
+        :return: the highest known id, or None if the index is empty.
+        """
+        return max(self.entries) if self.entries else None
+
+    def value(self, id_number):
+        """
+        :return: the last payload seen for an id.
+        """
+        return self.entries[id_number]['value']
+
+    def age(self, id_number):
+        """
+        :return: the number of seconds since an id was last seen, or None if it isn't in the index.
+        """
+        entry = self.entries.get(id_number)
+        if entry is None:
+            return None
+        return (datetime.utcnow() - datetime.fromisoformat(entry['last_seen'])).total_seconds()
+
+    def conditional_headers(self, id_number):
+        """
+        :return: a dict of If-None-Match/If-Modified-Since headers for an id, empty if the API never sent an ETag or Last-Modified for it.
+        """
+        entry = self.entries.get(id_number)
+        headers = {}
+        if entry is None:
+            return headers
+        if entry.get('etag'):
+            headers['If-None-Match'] = entry['etag']
+        if entry.get('last_modified'):
+            headers['If-Modified-Since'] = entry['last_modified']
+        return headers
+
+    def update(self, id_number, value, headers=None):
+        """
+        Record the latest payload for an id.
+        :return: True if the payload is new or has changed since it was last seen, else False.
+        """
+        headers = headers or {}
+        digest = hashlib.sha1(json.dumps(value, sort_keys=True).encode()).hexdigest()
+        previous = self.entries.get(id_number)
+        self.entries[id_number] = {
+            'value': value,
+            'hash': digest,
+            'last_seen': datetime.utcnow().isoformat(timespec='seconds'),
+            'etag': headers.get('ETag'),
+            'last_modified': headers.get('Last-Modified'),
+            }
+        return previous is None or previous['hash'] != digest
+
+    def touch(self, id_number):
+        """
+        Mark an id as seen without its payload having changed (i.e. the API answered 304 Not Modified).
+        """
+        self.entries[id_number]['last_seen'] = datetime.utcnow().isoformat(timespec='seconds')
+
+    def remove(self, id_number):
+        self.entries.pop(id_number, None)
+
+    def save(self):
+        """
+        Write the index to disk. The file is replaced atomically, so a crash while saving can't leave a half-written index behind.
+        """
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as outfile:
+            json.dump({str(k): v for k, v in self.entries.items()}, outfile)
+        os.replace(tmp_path, self.path)
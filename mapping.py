@@ -0,0 +1,197 @@
+import json
+import re
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from members import get_member_table
+
+try:
+    import geopandas as gpd
+    import shapely
+    from shapely.geometry import shape
+except ImportError:
+    gpd = None
+
+
+# The boundaries' name and code columns (ONS, December 2020)
+BOUNDARY_COLUMNS = ['PCON20CD', 'PCON20NM']
+
+# Constituency names which the ONS boundaries spell differently from the Parliament API
+BOUNDARY_NAME_FIXES = {'Weston-Super-Mare': 'Weston-super-Mare'}
+
+# The default simplification tolerance, in the boundaries' units (degrees of longitude/latitude), i.e. roughly 10m
+DEFAULT_TOLERANCE = 0.0001
+
+# The resolution levels built when the boundaries are downloaded: roughly 10m (for maps of a region), 100m (the whole country) and 500m (thumbnails)
+RESOLUTIONS = [0.0001, 0.001, 0.005]
+
+FEATURES_RE = re.compile(r'"features"\s*:\s*\[')
+
+
+def boundary_cache_path(tmp, tolerance=DEFAULT_TOLERANCE):
+    """
+    :return: the path of the boundary cache for a tolerance, e.g. tmp/pcon_boundaries_0.0001.parquet. A tolerance of 0 is the full resolution boundaries.
+    """
+    return Path(tmp) / 'pcon_boundaries_{t:g}.parquet'.format(t=tolerance)
+
+
+def iter_features(path, buffer_size=1 << 20):
+    """
+    Read the features of a GeoJSON FeatureCollection one at a time, without loading the whole file, so memory use is bounded by the largest single feature rather than the size of the file.
+    :param path: str, the GeoJSON file.
+    :param buffer_size: int, default 1MB. How much of the file is read at a time.
+    :return: an iterator of features, as dicts.
+    :raises ValueError: if the file has no features array, or ends part way through it.
+    """
+    decoder = json.JSONDecoder()
+    with open(path, encoding='utf-8') as infile:
+        buffer = ''
+        match = None
+        while match is None:
+            chunk = infile.read(buffer_size)
+            if not chunk:
+                raise ValueError('{p} is not a GeoJSON FeatureCollection.'.format(p=path))
+            buffer += chunk
+            match = FEATURES_RE.search(buffer)
+        buffer = buffer[match.end():]
+        while True:
+            buffer = buffer.lstrip(', \t\r\n')
+            if buffer.startswith(']'):
+                return
+            try:
+                feature, end = decoder.raw_decode(buffer)
+            except ValueError:
+                # The next feature runs past the end of the buffer
+                chunk = infile.read(buffer_size)
+                if not chunk:
+                    raise ValueError('{p} ends part way through its features. Download it again.'.format(p=path))
+                buffer += chunk
+                continue
+            yield feature
+            buffer = buffer[end:]
+
+
+def build_boundary_caches(tmp, tolerances=RESOLUTIONS):
+    """
+    Convert the constituency boundaries downloaded by constituencies.download_shapefiles (pcon_boundaries.geojson in the tmp folder) into compact GeoParquet files, one per resolution level, so that maps don't have to parse the GeoJSON every time.
+    Only the constituency code, name and geometry are kept, and the names are fixed to match the Parliament API.
+    The GeoJSON is read a feature at a time, and each one is simplified to every level before the next is read, so only one full resolution boundary is held in memory at once.
+    :param tmp: str, the tmp folder.
+    :param tolerances: list, default RESOLUTIONS. How far (in degrees) the simplified boundaries of each level may stray from the originals. 0 keeps them at full resolution.
+    :return: a list of the paths of the caches.
+    """
+    if gpd is None:
+        raise ImportError('Mapping needs geopandas. Install it with `pip install geopandas pyarrow`.')
+    source = Path(tmp) / 'pcon_boundaries.geojson'
+    if not source.is_file():
+        raise FileNotFoundError('{p} not found. Run constituencies.download_shapefiles to download the boundaries.'.format(p=source))
+    print('Building the boundary caches from {p}...'.format(p=source))
+    codes = []
+    names = []
+    geometries = {tolerance: [] for tolerance in tolerances}
+    for feature in iter_features(source):
+        codes.append(feature['properties']['PCON20CD'])
+        name = feature['properties']['PCON20NM']
+        names.append(BOUNDARY_NAME_FIXES.get(name, name))
+        geometry = shape(feature['geometry'])
+        for tolerance in tolerances:
+            geometries[tolerance].append(geometry.simplify(tolerance, preserve_topology=True) if tolerance > 0 else geometry)
+
+    paths = []
+    for tolerance in tolerances:
+        # GeoJSON coordinates are always longitude/latitude
+        boundaries = gpd.GeoDataFrame({'PCON20CD': codes, 'PCON20NM': names}, geometry=geometries[tolerance], crs='EPSG:4326')
+        boundaries = boundaries.sort_values('PCON20CD').reset_index(drop=True)
+        path = boundary_cache_path(tmp, tolerance)
+        boundaries.to_parquet(path, index=False)
+        paths.append(path)
+    return paths
+
+
+def build_boundary_cache(tmp, tolerance=DEFAULT_TOLERANCE):
+    """
+    Build the boundary cache for a single resolution level. See build_boundary_caches.
+    :return: the path of the cache.
+    """
+    return build_boundary_caches(tmp, [tolerance])[0]
+
+
+class ConstituencyMap:
+    """
+    The constituency boundaries, loaded from the GeoParquet cache written by build_boundary_cache (which is built, or rebuilt, whenever pcon_boundaries.geojson is newer than it), with an STR-tree spatial index over them.
+
+    Use it to join per-constituency counts (e.g. of PQs) onto the boundaries for a choropleth, or to find the constituencies of many points at once.
+    """
+
+    def __init__(self, tmp, tolerance=DEFAULT_TOLERANCE):
+        """
+        :param tmp: str, the tmp folder.
+        :param tolerance: float, default DEFAULT_TOLERANCE. The simplification tolerance of the boundaries to load. See build_boundary_cache.
+        """
+        if gpd is None:
+            raise ImportError('Mapping needs geopandas. Install it with `pip install geopandas pyarrow`.')
+        self.tmp = tmp
+        path = boundary_cache_path(tmp, tolerance)
+        source = Path(tmp) / 'pcon_boundaries.geojson'
+        if not path.is_file() or (source.is_file() and source.stat().st_mtime > path.stat().st_mtime):
+            build_boundary_cache(tmp, tolerance)
+        self.boundaries = gpd.read_parquet(path)
+        self._tree = None
+
+    def __len__(self):
+        return len(self.boundaries)
+
+    @property
+    def tree(self):
+        """
+        An STR-tree of the boundaries, built the first time it's needed. This takes milliseconds for the ~650 constituencies, so it isn't worth saving.
+        """
+        if self._tree is None:
+            self._tree = shapely.STRtree(self.boundaries.geometry.values)
+        return self._tree
+
+    def locate(self, x, y):
+        """
+        Find the constituencies which many points fall in, in one vectorised query of the spatial index.
+        :param x: array-like of longitudes.
+        :param y: array-like of latitudes.
+        :return: a DataFrame with a row for each point, in the same order, and columns PCON20CD and PCON20NM. Points outside every constituency get missing values, and points on the line between two constituencies get one of them.
+        """
+        points = shapely.points(np.asarray(x, dtype=float), np.asarray(y, dtype=float))
+        # 'intersects' is tested against prepared boundaries, which is several times quicker than 'within'
+        point_positions, boundary_positions = self.tree.query(points, predicate='intersects')
+        # A point exactly on the line between two constituencies intersects both, so keep its first match
+        first = np.unique(point_positions, return_index=True)[1]
+        point_positions, boundary_positions = point_positions[first], boundary_positions[first]
+        located = pd.DataFrame(index=pd.RangeIndex(len(points)), columns=BOUNDARY_COLUMNS, dtype=object)
+        located.iloc[point_positions] = self.boundaries[BOUNDARY_COLUMNS].to_numpy()[boundary_positions]
+        return located
+
+    def join_counts(self, counts, on='PCON20NM', name='count', fill_value=None):
+        """
+        Join counts onto the boundaries, ready to plot, e.g. ConstituencyMap('tmp').join_counts(counts).plot(column='count').
+        :param counts: a Series of counts indexed by constituency name (or code).
+        :param on: str, default 'PCON20NM'. What counts is indexed by: 'PCON20NM' for names or 'PCON20CD' for ONS codes.
+        :param name: str, default 'count'. The name of the new column.
+        :param fill_value: default None. The value given to constituencies without a count. None leaves them missing, so they can be greyed out with missing_kwds.
+        :return: a copy of the boundaries GeoDataFrame with the counts column added.
+        """
+        joined = self.boundaries.copy()
+        joined[name] = joined[on].map(counts)
+        if fill_value is not None:
+            joined[name] = joined[name].fillna(fill_value)
+        return joined
+
+    def member_counts(self, wpqs, name='totalPQs', fill_value=None):
+        """
+        Count PQs by the constituency of the member who asked them, and join the counts onto the boundaries. Only MPs who currently represent a constituency are counted, as in the mapping notebook.
+        :param wpqs: a DataFrame of WPQs with an askingMemberId column, e.g. from wpqs.load_cleaned_archive.
+        :param name: str, default 'totalPQs'. The name of the new column.
+        :param fill_value: default None. See join_counts.
+        :return: a copy of the boundaries GeoDataFrame with the counts column added.
+        """
+        per_member = wpqs['askingMemberId'].value_counts()
+        members = get_member_table(self.tmp).constituency_members()
+        return self.join_counts(members.map(per_member), on='PCON20NM', name=name, fill_value=fill_value)
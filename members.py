@@ -0,0 +1,228 @@
+import os
+import threading
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+
+# Friendly names for the member attributes which can be joined onto other tables, and the columns they come from in active_members.csv/former_members.csv
+MEMBER_ATTRIBUTES = {
+    'party': 'latestPartyabbreviation',
+    'party_name': 'latestPartyname',
+    'party_id': 'latestPartyid',
+    'gender': 'gender',
+    'house': 'latestHouseMembershiphouse',
+    'constituency': 'latestHouseMembershipmembershipFrom',
+    'constituency_id': 'latestHouseMembershipmembershipFromId',
+    'name': 'nameListAs',
+    }
+
+# Low-cardinality attributes, which are stored as categoricals
+CATEGORICAL_ATTRIBUTES = ['latestPartyabbreviation', 'latestPartyname', 'gender', 'latestHouseMembershiphouse', 'latestHouseMembershipmembershipFrom']
+
+# The files the table is loaded from, in the tmp folder. The constituencies are optional.
+MEMBER_FILES = ['active_members.csv', 'former_members.csv']
+CONSTITUENCY_FILE = 'active_constituencies.csv'
+
+# The columns kept from active_constituencies.csv, as saved by constituencies.download_constituencies
+CONSTITUENCY_COLUMNS = ['id', 'name', 'currentRepresentationmembervalueid', 'currentRepresentationmembervaluelatestPartyabbreviation', 'currentRepresentationmembervaluenameListAs']
+
+
+def _positions(ids):
+    """
+    :return: an array mapping each id to its row, so that rows can be looked up by indexing rather than hashing. Ids which aren't in the table map to -1.
+    """
+    ids = np.asarray(ids, dtype='int64')
+    positions = np.full(ids.max() + 1 if len(ids) > 0 else 1, -1, dtype='int32')
+    positions[ids] = np.arange(len(ids), dtype='int32')
+    return positions
+
+
+def _lookup(positions, ids):
+    """
+    :return: the rows of ids in a table indexed by _positions, with -1 for missing or unknown ids.
+    """
+    ids = pd.Series(ids)
+    values = pd.to_numeric(ids, errors='coerce').to_numpy(dtype='float64', na_value=np.nan)
+    known = ~np.isnan(values) & (values >= 0) & (values < len(positions))
+    rows = np.full(len(values), -1, dtype='int32')
+    rows[known] = positions[values[known].astype('int64')]
+    return rows
+
+
+class MemberTable:
+    """
+    A table of every current and former member of both Houses, loaded once from the active_members.csv and former_members.csv files saved by UKParliament.download_mps, and indexed by member id.
+    If active_constituencies.csv (saved by constituencies.download_constituencies) is there too, the constituencies and their current members are loaded alongside.
+
+    Use it to join member attributes (party, gender, house, constituency...) onto anything with a member id column, e.g. the askingMemberId of WPQs. Lookups index arrays by id rather than hashing, so they cost the same however many ids are looked up at once.
+    Rather than loading a new table, use get_member_table, which shares one table per tmp folder for as long as the files stay the same.
+    """
+
+    def __init__(self, tmp):
+        """
+        :param tmp: str, the tmp folder holding active_members.csv and former_members.csv
+        :raises FileNotFoundError: if either file is missing. Run UKParliament.download_mps first.
+        """
+        paths = [Path(tmp) / name for name in MEMBER_FILES]
+        for path in paths:
+            if not path.is_file():
+                raise FileNotFoundError('{p} not found. Run UKParliament.download_mps to download the latest members.'.format(p=path))
+
+        columns = set(MEMBER_ATTRIBUTES.values()) | {'id'}
+        frames = [pd.read_csv(path, usecols=lambda c: c in columns) for path in paths]
+        for frame, active in zip(frames, [True, False]):
+            frame['active'] = active
+        members = pd.concat(frames, ignore_index=True)
+        # A member is either active or former, but keep the active record if a stale file disagrees
+        members = members.drop_duplicates(subset='id', keep='first').set_index('id')
+        for column in CATEGORICAL_ATTRIBUTES:
+            if column in members.columns:
+                members[column] = members[column].astype('category')
+        for column in ['latestPartyid', 'latestHouseMembershipmembershipFromId']:
+            if column in members.columns:
+                members[column] = pd.to_numeric(members[column].astype('Int64'), downcast='integer')
+        self.members = members
+        self._member_positions = _positions(members.index)
+
+        self.constituencies = None
+        path = Path(tmp) / CONSTITUENCY_FILE
+        if path.is_file():
+            constituencies = pd.read_csv(path, usecols=lambda c: c in CONSTITUENCY_COLUMNS).set_index('id')
+            constituencies['currentRepresentationmembervalueid'] = pd.to_numeric(constituencies['currentRepresentationmembervalueid'].astype('Int64'), downcast='integer')
+            if 'currentRepresentationmembervaluelatestPartyabbreviation' in constituencies.columns:
+                constituencies['currentRepresentationmembervaluelatestPartyabbreviation'] = constituencies['currentRepresentationmembervaluelatestPartyabbreviation'].astype('category')
+            self.constituencies = constituencies
+            self._constituency_positions = _positions(constituencies.index)
+
+    def __len__(self):
+        return len(self.members)
+
+    def lookup(self, ids, attribute='party'):
+        """
+        Look up one attribute for many member ids at once.
+        :param ids: a Series or list of member ids. Missing and unknown ids give missing values.
+        :param attribute: str, default 'party'. An attribute's name in MEMBER_ATTRIBUTES, its column name, or 'active'.
+        :return: a Series of the attribute, with the same index as ids (if it's a Series).
+        """
+        column = MEMBER_ATTRIBUTES.get(attribute, attribute)
+        rows = _lookup(self._member_positions, ids)
+        values = self.members[column]
+        if not isinstance(values.dtype, pd.CategoricalDtype) and values.dtype.kind in 'iub':
+            # Plain ints and bools can't hold missing values
+            values = values.astype('Int64' if values.dtype.kind in 'iu' else 'boolean')
+        result = values.iloc[np.where(rows >= 0, rows, 0)].reset_index(drop=True)
+        result[rows < 0] = None
+        result.index = ids.index if isinstance(ids, pd.Series) else pd.RangeIndex(len(rows))
+        return result
+
+    def enrich(self, df, on='askingMemberId', attributes=('party',), missing='n/a', errors='warn'):
+        """
+        Join member attributes onto a DataFrame in one vectorised pass.
+        :param df: a DataFrame with a column of member ids.
+        :param on: str, default 'askingMemberId'. The column holding the member ids.
+        :param attributes: list, default ('party',). Which attributes to join, by their names in MEMBER_ATTRIBUTES (or their column names). Each is added under its column name, e.g. 'party' becomes 'latestPartyabbreviation'.
+        :param missing: default 'n/a'. The value given to rows whose member id isn't in the table.
+        :param errors: str, default 'warn'. What to do about ids that aren't in the table: 'warn' prints how many there are, 'raise' raises a KeyError, and 'ignore' does neither.
+        :return: a copy of df with the attribute columns added.
+        """
+        df = df.copy()
+        ids = df[on]
+        rows = _lookup(self._member_positions, ids)
+        known = rows >= 0
+        unknown = ids[~known & ids.notna().to_numpy()].unique()
+        if len(unknown) > 0:
+            message = '{n} member ids in {c} were not found in the member table (e.g. {e}), and have been given the value {m!r}. Re-running UKParliament.download_mps may fix this.'.format(
+                n=len(unknown), c=on, e=list(unknown[:5]), m=missing)
+            if errors == 'raise':
+                raise KeyError(message)
+            elif errors == 'warn':
+                print(message)
+
+        for attribute in attributes:
+            column = MEMBER_ATTRIBUTES.get(attribute, attribute)
+            values = self.members[column].iloc[np.where(known, rows, 0)].reset_index(drop=True)
+            if isinstance(values.dtype, pd.CategoricalDtype):
+                if missing not in values.cat.categories:
+                    values = values.cat.add_categories([missing])
+            else:
+                values = values.astype(object)
+            values[~known] = missing
+            values.index = df.index
+            df[column] = values
+        return df
+
+    def _require_constituencies(self):
+        if self.constituencies is None:
+            raise FileNotFoundError('{f} not found. Run constituencies.download_constituencies to download the latest constituencies.'.format(f=CONSTITUENCY_FILE))
+
+    def current_members(self, constituency_ids):
+        """
+        :param constituency_ids: a Series or list of constituency ids.
+        :return: a Series of the id of each constituency's current member, with missing values for unknown or vacant constituencies.
+        """
+        self._require_constituencies()
+        rows = _lookup(self._constituency_positions, constituency_ids)
+        members = self.constituencies['currentRepresentationmembervalueid'].astype('Int64').iloc[np.where(rows >= 0, rows, 0)].reset_index(drop=True)
+        members[rows < 0] = None
+        members.index = constituency_ids.index if isinstance(constituency_ids, pd.Series) else pd.RangeIndex(len(rows))
+        return members
+
+    def constituency_members(self):
+        """
+        :return: a Series of the id of each active constituency's current member, indexed by constituency name.
+        """
+        self._require_constituencies()
+        return self.constituencies.set_index('name')['currentRepresentationmembervalueid']
+
+    def active(self, house=None):
+        """
+        :param house: str, default None. 'Commons' or 'Lords' for just one House, as in UKParliament's active_commons_df and active_lords_df.
+        :return: the active members.
+        """
+        active = self.members[self.members['active']]
+        if house is not None:
+            active = active[active['latestHouseMembershiphouse'] == house]
+        return active
+
+    def state_of_parties(self):
+        """
+        :return: a DataFrame of the number of active members of each party, as in UKParliament's state_of_parties.
+        """
+        return self.active().groupby(['latestPartyid', 'latestPartyname'], observed=True).size().reset_index(name='number')
+
+
+def _fingerprint(tmp):
+    """
+    :return: the modification time and size of each of the files a MemberTable is loaded from, or None for missing files.
+    """
+    fingerprint = []
+    for name in MEMBER_FILES + [CONSTITUENCY_FILE]:
+        try:
+            stat = os.stat(Path(tmp) / name)
+            fingerprint.append((stat.st_mtime_ns, stat.st_size))
+        except FileNotFoundError:
+            fingerprint.append(None)
+    return tuple(fingerprint)
+
+
+_tables = {}
+_tables_lock = threading.Lock()
+
+
+def get_member_table(tmp):
+    """
+    The member table of a tmp folder, loaded at most once per process: later calls return the same table, unless any of its files have changed since it was loaded (e.g. because UKParliament.download_mps has run), in which case it is loaded again.
+    :param tmp: str, the tmp folder.
+    :return: a MemberTable. Treat it as read-only, as it is shared.
+    :raises FileNotFoundError: if the member files are missing.
+    """
+    key = str(Path(tmp).resolve())
+    fingerprint = _fingerprint(tmp)
+    with _tables_lock:
+        cached = _tables.get(key)
+        if cached is None or cached[0] != fingerprint:
+            cached = (fingerprint, MemberTable(tmp))
+            _tables[key] = cached
+        return cached[1]
@@ -0,0 +1,350 @@
+"""
+Named timers and counters for the stages of the pipelines (download_mps, update_answered_pqs...), to see where their time goes: waiting on HTTP, decoding JSON, json_normalize, drop_duplicates, writing CSVs or cleaning.
+
+Instrumentation is off unless switched on, and while it's off every timer and counter is a single check of a global, so the pipelines run as fast as they did without it. Switch it on around a run with:
+
+    with metrics.instrument([metrics.LogSink(), metrics.PrometheusSink('tmp/pqs.prom')]):
+        update_answered_pqs(tmp='tmp')
+
+When the block exits, the metrics are handed to each sink. A sink is anything callable which takes the dict returned by Metrics.snapshot.
+"""
+import cProfile
+import functools
+import json
+import os
+import re
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+
+
+# The Metrics being recorded into, or None while instrumentation is off
+_active = None
+
+
+class _NullTimer:
+    """
+    What timer and stage return while instrumentation is off: a context manager which does nothing.
+    """
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NULL_TIMER = _NullTimer()
+
+
+class _Timer:
+    __slots__ = ('metrics', 'name', 'started')
+
+    def __init__(self, metrics, name):
+        self.metrics = metrics
+        self.name = name
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.metrics.observe(self.name, time.perf_counter() - self.started)
+        return False
+
+
+class _Stage:
+    def __init__(self, metrics, name):
+        self.metrics = metrics
+        self.name = name
+        self.profiler = None
+
+    def __enter__(self):
+        metrics = self.metrics
+        metrics._stack().append(self.name)
+        with metrics._lock:
+            # cProfile can't nest, so a stage inside a profiled stage is profiled as part of it
+            if metrics.profile_dir is not None and not metrics._profiling:
+                metrics._profiling = True
+                self.profiler = cProfile.Profile()
+        if self.profiler is not None:
+            self.profiler.enable()
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        seconds = time.perf_counter() - self.started
+        metrics = self.metrics
+        metrics.observe('stage', seconds)
+        if self.profiler is not None:
+            self.profiler.disable()
+            path = Path(metrics.profile_dir) / '{s}.prof'.format(s=self.name)
+            path.parent.mkdir(parents=True, exist_ok=True)
+            self.profiler.dump_stats(str(path))
+            metrics.profiles[self.name] = str(path)
+        metrics._stack().pop()
+        if self.profiler is not None:
+            with metrics._lock:
+                metrics._profiling = False
+        return False
+
+
+class Metrics:
+    """
+    The timers and counters recorded while instrumentation is on, grouped by the stage that was running when they were recorded.
+
+    Stages nest (update_cleaned_archive runs inside update_answered_pqs), and everything is recorded against the innermost running stage. Anything recorded outside every stage goes under the stage ''.
+    Each thread has its own stack of stages, so stages running at once on different threads can't pop each other's names. A thread which hasn't entered a stage of its own, such as a worker of a ThreadPoolExecutor, records against the innermost stage of the thread which switched instrumentation on, so the requests of fetch_date_windows' workers count towards the stage that started them.
+    Timers add up across threads, so the http timer of a stage which sends 16 requests at once can come to more than the stage itself took.
+    """
+
+    def __init__(self, profile_dir=None):
+        """
+        :param profile_dir: str, default None. If set, each outermost stage is run under cProfile, and its profile saved as {stage}.prof in this folder, to be read with pstats or snakeviz. cProfile only sees the stage's own thread, not its workers.
+        """
+        self.profile_dir = profile_dir
+        self.counters = {}
+        self.timers = {}
+        self.profiles = {}
+        self._profiling = False
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        # The stages of the thread which switched instrumentation on, which threads with none of their own inherit
+        self._parent_stages = self._stack()
+
+    def _stack(self):
+        """
+        :return: the list of stages entered by the current thread, innermost last.
+        """
+        stages = getattr(self._local, 'stages', None)
+        if stages is None:
+            stages = self._local.stages = []
+        return stages
+
+    def current_stage(self):
+        # Sliced rather than indexed, as the parent thread may leave its last stage in between
+        innermost = self._stack()[-1:] or self._parent_stages[-1:]
+        return innermost[0] if innermost else ''
+
+    def increment(self, name, value=1):
+        key = (self.current_stage(), name)
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, seconds):
+        key = (self.current_stage(), name)
+        with self._lock:
+            timer = self.timers.get(key)
+            if timer is None:
+                self.timers[key] = [1, seconds]
+            else:
+                timer[0] += 1
+                timer[1] += seconds
+
+    def timer(self, name):
+        return _Timer(self, name)
+
+    def stage(self, name):
+        return _Stage(self, name)
+
+    def snapshot(self):
+        """
+        :return: a dict of {'stages': {stage: {'counters': {name: value}, 'timers': {name: {'calls': n, 'seconds': s}}}}, 'profiles': {stage: path}}. Each stage's own duration is its 'stage' timer.
+        """
+        stages = {}
+        with self._lock:
+            for (stage, name), value in self.counters.items():
+                stages.setdefault(stage, {'counters': {}, 'timers': {}})['counters'][name] = value
+            for (stage, name), (calls, seconds) in self.timers.items():
+                stages.setdefault(stage, {'counters': {}, 'timers': {}})['timers'][name] = {'calls': calls, 'seconds': seconds}
+        return {'stages': stages, 'profiles': dict(self.profiles)}
+
+
+def enabled():
+    return _active is not None
+
+
+def timer(name):
+    """
+    Time a block of code, e.g. `with metrics.timer('csv_write'): df.to_csv(...)`. Repeated blocks with the same name add up.
+    """
+    if _active is None:
+        return _NULL_TIMER
+    return _active.timer(name)
+
+
+def stage(name):
+    """
+    Time a pipeline stage, and record the timers and counters inside it against it. See also instrumented.
+    """
+    if _active is None:
+        return _NULL_TIMER
+    return _active.stage(name)
+
+
+def increment(name, value=1):
+    """
+    Add to a counter, e.g. metrics.increment('rows', len(df)).
+    """
+    if _active is not None:
+        _active.increment(name, value)
+
+
+def observe(name, seconds):
+    """
+    Add a duration measured elsewhere to a timer.
+    """
+    if _active is not None:
+        _active.observe(name, seconds)
+
+
+def instrumented(name):
+    """
+    A decorator which runs a function as a stage. See stage.
+    """
+    def decorate(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if _active is None:
+                return func(*args, **kwargs)
+            with _active.stage(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorate
+
+
+def enable(profile_dir=None):
+    """
+    Switch instrumentation on, with a fresh set of metrics. Prefer instrument, which also switches it off again and writes the metrics to sinks.
+    :param profile_dir: str, default None. See Metrics.
+    :return: the Metrics being recorded into.
+    """
+    global _active
+    _active = Metrics(profile_dir=profile_dir)
+    return _active
+
+
+def disable():
+    """
+    Switch instrumentation off.
+    :return: the Metrics that were recorded, or None if it wasn't on.
+    """
+    global _active
+    metrics, _active = _active, None
+    return metrics
+
+
+@contextmanager
+def instrument(sinks=(), profile_dir=None):
+    """
+    Record metrics while in the with block, and write them to each sink when it exits, even if it exits with an error.
+    :param sinks: list, default (). Callables which take a Metrics.snapshot dict, e.g. LogSink(), JsonSink(path) or PrometheusSink(path).
+    :param profile_dir: str, default None. Save a cProfile profile of each stage in this folder. See Metrics.
+    :return: the Metrics being recorded into.
+    """
+    metrics = enable(profile_dir=profile_dir)
+    try:
+        yield metrics
+    finally:
+        disable()
+        snapshot = metrics.snapshot()
+        for sink in sinks:
+            sink(snapshot)
+
+
+class LogSink:
+    """
+    Writes a structured log line per stage, of key=value pairs (logfmt), e.g.
+    metrics stage=update_answered_pqs seconds=4.021 requests=150 bytes_downloaded=20512044 retries=0 rows=13641 http_seconds=3.410 http_calls=150
+    """
+
+    def __init__(self, logger=None):
+        """
+        :param logger: a logging.Logger, default None. The lines are logged at INFO level. If None, they are printed.
+        """
+        self.logger = logger
+
+    def __call__(self, snapshot):
+        for stage, values in snapshot['stages'].items():
+            fields = ['metrics', 'stage={s}'.format(s=stage or '-')]
+            if 'stage' in values['timers']:
+                fields.append('seconds={t:.3f}'.format(t=values['timers']['stage']['seconds']))
+            fields += ['{n}={v}'.format(n=name, v=_format(value)) for name, value in sorted(values['counters'].items())]
+            for name, timer in sorted(values['timers'].items()):
+                if name != 'stage':
+                    fields += ['{n}_seconds={t:.3f}'.format(n=name, t=timer['seconds']), '{n}_calls={c}'.format(n=name, c=timer['calls'])]
+            line = ' '.join(fields)
+            if self.logger is None:
+                print(line)
+            else:
+                self.logger.info(line)
+
+
+class JsonSink:
+    """
+    Appends the metrics of each run to a JSON lines file, one object per run with the time it finished.
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def __call__(self, snapshot):
+        record = dict(snapshot, time=time.strftime('%Y-%m-%dT%H:%M:%S'))
+        with open(self.path, 'a') as outfile:
+            outfile.write(json.dumps(record) + '\n')
+
+
+def _format(value):
+    """
+    :return: a counter or timer's value as text: ints in full, and floats to the microsecond.
+    """
+    if isinstance(value, int):
+        return str(value)
+    return '{v:.6f}'.format(v=value)
+
+
+def _prometheus_name(name):
+    return re.sub(r'[^a-zA-Z0-9_]', '_', name)
+
+
+class PrometheusSink:
+    """
+    Writes the metrics in Prometheus' text format, for node_exporter's textfile collector to pick up, e.g.
+    pqs_requests_total{stage="update_answered_pqs"} 150
+    pqs_timer_seconds_total{stage="update_answered_pqs",timer="http"} 3.41
+    The file is replaced after every run, rather than added to.
+    """
+
+    def __init__(self, path, prefix='pqs'):
+        """
+        :param path: str, the file to write, which should end in .prom for the textfile collector.
+        :param prefix: str, default 'pqs'. The prefix of every metric's name.
+        """
+        self.path = path
+        self.prefix = prefix
+
+    def __call__(self, snapshot):
+        counters = {}
+        timers = []
+        for stage, values in snapshot['stages'].items():
+            for name, value in values['counters'].items():
+                counters.setdefault(_prometheus_name(name), []).append((stage, value))
+            for name, timer in values['timers'].items():
+                timers.append((stage, name, timer))
+
+        lines = []
+        for name, samples in sorted(counters.items()):
+            metric = '{p}_{n}_total'.format(p=self.prefix, n=name)
+            lines.append('# TYPE {m} counter'.format(m=metric))
+            lines += ['{m}{{stage="{s}"}} {v}'.format(m=metric, s=stage, v=_format(value)) for stage, value in samples]
+        for suffix, field in [('seconds', 'seconds'), ('calls', 'calls')]:
+            metric = '{p}_timer_{s}_total'.format(p=self.prefix, s=suffix)
+            lines.append('# TYPE {m} counter'.format(m=metric))
+            lines += ['{m}{{stage="{s}",timer="{t}"}} {v}'.format(m=metric, s=stage, t=name, v=_format(timer[field])) for stage, name, timer in timers]
+
+        # Write to a temporary file first, so the collector never reads half a file
+        tmp_path = '{p}.tmp'.format(p=self.path)
+        with open(tmp_path, 'w') as outfile:
+            outfile.write('\n'.join(lines) + '\n')
+        os.replace(tmp_path, self.path)
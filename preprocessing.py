@@ -0,0 +1,336 @@
+import hashlib
+import json
+import os
+import sqlite3
+from multiprocessing import Pool
+from pathlib import Path
+
+from tqdm import tqdm
+
+from wpqs import open_cleaned_store
+
+try:
+    from gensim.corpora import Dictionary, MmCorpus
+    from gensim.parsing.preprocessing import STOPWORDS
+    from gensim.utils import simple_preprocess
+except ImportError:
+    Dictionary = None
+
+
+# Words which turn up in so many PQs that they say nothing about a question's topic, on top of nltk's English stopwords
+PQS_STOP_WORDS = ['from', 'subject', 're', 'edu', 'use', 'assessment', 'department', 'made', 'make', 'whether', 'government', 'estimate', 'steps', 'taking', 'discussions', 'regarding',
+                  'february', 'january', 'march', 'april', 'may', 'june', 'july', 'august', 'september', 'october', 'november', 'december', 'plan', 'ensure',
+                  'proportion', 'implication', 'policies', 'year', 'help', 'finding', 'number', 'guidance', 'reference', 'potential', 'report', 'applications']
+
+# Fewer new questions than this are tokenised in this process, as starting a pool of workers takes longer than tokenising them
+POOL_THRESHOLD = 5000
+
+
+def _nltk(resource, path):
+    """
+    Import nltk, downloading one of its data packages (e.g. 'stopwords') the first time it's needed.
+    """
+    try:
+        import nltk
+    except ImportError:
+        raise ImportError('Text preprocessing needs nltk and gensim. Install them with `pip install nltk gensim`.')
+    try:
+        nltk.data.find(path)
+    except LookupError:
+        nltk.download(resource, quiet=True)
+    return nltk
+
+
+def stop_words(extra=None, stem=False, pqs=True):
+    """
+    :param extra: list, default None. Any more words to drop.
+    :param stem: bool, default False. If True, the stop words of the stemmed tokens: gensim's STOPWORDS, as preprocess() in the tf-idf notebook used, and PQS_STOP_WORDS both as they are and stemmed, since tokenise drops stop words both before and after stemming.
+    :param pqs: bool, default True. If False, leave out PQS_STOP_WORDS, e.g. stop_words(stem=True, pqs=False) for gensim's STOPWORDS alone.
+    :return: a sorted list of nltk's English stopwords (or gensim's STOPWORDS if stem is True), PQS_STOP_WORDS (as the topic modelling notebook used) and extra.
+    """
+    words = set(extra or [])
+    if pqs:
+        words |= set(PQS_STOP_WORDS)
+    if stem:
+        if Dictionary is None:
+            raise ImportError('Text preprocessing needs nltk and gensim. Install them with `pip install nltk gensim`.')
+        if pqs:
+            words |= set(lemmatize_stemming(word) for word in PQS_STOP_WORDS)
+        return sorted(set(STOPWORDS) | words)
+    _nltk('stopwords', 'corpora/stopwords')
+    from nltk.corpus import stopwords
+    return sorted(set(stopwords.words('english')) | words)
+
+
+_lemmatizer = None
+_stemmer = None
+
+
+def lemmatize_stemming(token):
+    global _lemmatizer, _stemmer
+    if _lemmatizer is None:
+        _nltk('wordnet', 'corpora/wordnet')
+        _nltk('omw-1.4', 'corpora/omw-1.4')
+        from nltk.stem import SnowballStemmer, WordNetLemmatizer
+        _lemmatizer = WordNetLemmatizer()
+        _stemmer = SnowballStemmer('english')
+    return _stemmer.stem(_lemmatizer.lemmatize(token, pos='v'))
+
+
+def tokenise(text, stop_words, stem=False):
+    """
+    Tokenise one question, as the topic modelling and tf-idf notebooks do: lower case words with the punctuation and accents stripped, less the stop words.
+    :param text: str, e.g. a cleanedQuestion. Missing values give no tokens.
+    :param stop_words: a set of words to drop.
+    :param stem: bool, default False. If True, also drop words of 3 letters or fewer, and lemmatise and stem the rest, as preprocess() in the tf-idf notebook does. Stems which are stop words are dropped too, so that e.g. 'assessed' goes along with 'assessment'.
+    :return: a list of tokens.
+    """
+    if not isinstance(text, str):
+        return []
+    tokens = simple_preprocess(text, deacc=True)
+    if stem:
+        stems = [lemmatize_stemming(t) for t in tokens if t not in stop_words and len(t) > 3]
+        return [t for t in stems if t not in stop_words]
+    return [t for t in tokens if t not in stop_words]
+
+
+# Each worker process keeps its own copy of the settings, so they aren't pickled with every chunk
+_worker_stop_words = None
+_worker_stem = False
+
+
+def _init_worker(words, stem):
+    global _worker_stop_words, _worker_stem
+    _worker_stop_words = set(words)
+    _worker_stem = stem
+
+
+def _tokenise_chunk(chunk):
+    ids, hashes, texts = chunk
+    return ids, hashes, [tokenise(text, _worker_stop_words, _worker_stem) for text in texts]
+
+
+def text_hash(text):
+    return hashlib.md5(text.encode('utf-8')).hexdigest() if isinstance(text, str) else ''
+
+
+class TokenCache:
+    """
+    The tokens of every question in a cleaned archive, kept in a SQLite file keyed on the WPQ id along with a hash of the text they came from, so that only new or changed questions need tokenising again.
+
+    The settings the tokens were made with (the text column and the stop words) are stored too. If they change, the cache is emptied.
+    """
+
+    def __init__(self, path, settings):
+        """
+        :param path: str, the SQLite file, e.g. 'tmp/pqs_cleaned_tokens.sqlite'. It is created if it doesn't exist.
+        :param settings: dict, anything json-serialisable which affects the tokens. None opens the cache as it is, to read its tokens.
+        """
+        self.path = str(path)
+        self.db = sqlite3.connect(self.path)
+        self.db.execute('CREATE TABLE IF NOT EXISTS tokens (id INTEGER PRIMARY KEY, hash TEXT, tokens TEXT)')
+        self.db.execute('CREATE TABLE IF NOT EXISTS settings (key TEXT PRIMARY KEY, value TEXT)')
+        if settings is None:
+            return
+        settings = json.dumps(settings, sort_keys=True)
+        stored = self.db.execute("SELECT value FROM settings WHERE key = 'settings'").fetchone()
+        with self.db:
+            if stored is not None and stored[0] != settings:
+                print('The preprocessing settings have changed since the tokens in {p} were cached, so every question will be tokenised again.'.format(p=self.path))
+                self.db.execute('DELETE FROM tokens')
+            self.db.execute("INSERT OR REPLACE INTO settings VALUES ('settings', ?)", (settings,))
+
+    def __len__(self):
+        return self.db.execute('SELECT COUNT(*) FROM tokens').fetchone()[0]
+
+    def hashes(self, ids=None):
+        """
+        :param ids: list, default None. Only these ids. If None, every cached question.
+        :return: a dict of {id: text hash} for the cached questions.
+        """
+        if ids is None:
+            return dict(self.db.execute('SELECT id, hash FROM tokens'))
+        found = {}
+        ids = [int(i) for i in ids]
+        for k in range(0, len(ids), 500):
+            batch = ids[k:k + 500]
+            found.update(self.db.execute('SELECT id, hash FROM tokens WHERE id IN ({p})'.format(p=', '.join('?' * len(batch))), batch))
+        return found
+
+    def tokens(self, ids):
+        """
+        :return: a list of the tokens of each of ids, in the same order. Ids which aren't cached get no tokens.
+        """
+        found = {}
+        ids = [int(i) for i in ids]
+        # SQLite limits the number of parameters in a query
+        for k in range(0, len(ids), 500):
+            batch = ids[k:k + 500]
+            query = 'SELECT id, tokens FROM tokens WHERE id IN ({p})'.format(p=', '.join('?' * len(batch)))
+            found.update((i, tokens.split()) for i, tokens in self.db.execute(query, batch))
+        return [found.get(i, []) for i in ids]
+
+    def put(self, ids, hashes, tokens):
+        with self.db:
+            self.db.executemany('INSERT OR REPLACE INTO tokens VALUES (?, ?, ?)', ((i, h, ' '.join(t)) for i, h, t in zip(ids, hashes, tokens)))
+
+    def remove(self, ids):
+        with self.db:
+            self.db.executemany('DELETE FROM tokens WHERE id = ?', ((i,) for i in ids))
+
+    def __iter__(self):
+        """
+        :return: an iterator of (id, list of tokens), in id order.
+        """
+        for i, tokens in self.db.execute('SELECT id, tokens FROM tokens ORDER BY id'):
+            yield i, tokens.split()
+
+    def close(self):
+        self.db.close()
+
+
+def token_cache_path(tmp, name, stem=False):
+    return Path(tmp) / '{n}{s}_tokens.sqlite'.format(n=name, s='_stemmed' if stem else '')
+
+
+def _corpus_paths(tmp, name, stem=False):
+    base = Path(tmp) / '{n}{s}_corpus'.format(n=name, s='_stemmed' if stem else '')
+    return {'corpus': str(base) + '.mm', 'dictionary': str(base) + '.dict', 'ids': str(base) + '_ids.json'}
+
+
+def update_tokens(tmp, name='pqs_cleaned', backend='csv', column='cleanedQuestion', stem=False, extra_stop_words=None, processes=None, chunk_size=20000, rows=None):
+    """
+    Bring the token cache of a cleaned archive ({name}_tokens.sqlite in the tmp folder, or {name}_stemmed_tokens.sqlite for stemmed tokens) up to date.
+    The archive is streamed a chunk at a time, and the questions which aren't cached yet (or whose text has changed) are tokenised in a pool of worker processes, while the next chunk is read.
+    Alternatively, pass just the rows which have been cleaned since the last update, and the archive isn't read at all.
+    :param tmp: str, the tmp folder.
+    :param name: str, default 'pqs_cleaned'. Which cleaned archive to tokenise: 'pqs_cleaned' or 'ua_pqs_cleaned'.
+    :param backend: str, default 'csv'. The cleaned archive's backend, 'csv' or 'parquet'.
+    :param column: str, default 'cleanedQuestion'. The text column to tokenise.
+    :param stem: bool, default False. Lemmatise and stem the tokens. See tokenise.
+    :param extra_stop_words: list, default None. Words to drop on top of stop_words(stem=stem).
+    :param processes: int, default None. The number of worker processes. None uses every CPU, or tokenises in this process if rows holds fewer than POOL_THRESHOLD new questions, and 1 always tokenises in this process.
+    :param chunk_size: int, default 20000. The number of rows read from a CSV archive at a time, and the most questions sent to a worker at once.
+    :param rows: a DataFrame, default None. Newly cleaned rows, with id and column, e.g. those returned by wpqs.update_cleaned_archive. If given, only these are tokenised (where they've changed), and questions which have left the archive stay in the cache.
+    :return: a TokenCache, and a list of the archive's ids in the order they were read (or of the ids in rows).
+    """
+    if Dictionary is None:
+        raise ImportError('Text preprocessing needs nltk and gensim. Install them with `pip install nltk gensim`.')
+    words = stop_words(extra_stop_words, stem=stem)
+    if stem:
+        # Make sure the wordnet data is downloaded before the workers need it
+        lemmatize_stemming('questions')
+    cache = TokenCache(token_cache_path(tmp, name, stem), {'column': column, 'stop_words': words, 'stem': stem})
+    archive_ids = []
+
+    def split(ids, hashes, texts, cached):
+        new = [k for k, (i, h) in enumerate(zip(ids, hashes)) if cached.get(i) != h]
+        for k in range(0, len(new), chunk_size):
+            positions = new[k:k + chunk_size]
+            yield [ids[p] for p in positions], [hashes[p] for p in positions], [texts[p] for p in positions]
+
+    if rows is not None:
+        ids = rows['id'].astype('int64').tolist()
+        texts = rows[column].tolist()
+        hashes = [text_hash(x) for x in texts]
+        archive_ids.extend(ids)
+        # Split up front, so the number of new questions is known before deciding whether a pool is worth starting
+        chunks = list(split(ids, hashes, texts, cache.hashes(ids)))
+        if processes is None and sum(len(c[0]) for c in chunks) < POOL_THRESHOLD:
+            processes = 1
+
+        def new_chunks():
+            return iter(chunks)
+    else:
+        cached = cache.hashes()
+
+        def new_chunks():
+            for df in open_cleaned_store(tmp, name, backend).iter_chunks(['id', column], chunksize=chunk_size):
+                ids = df['id'].astype('int64').tolist()
+                texts = df[column].tolist()
+                archive_ids.extend(ids)
+                yield from split(ids, [text_hash(x) for x in texts], texts, cached)
+
+    tokenised = 0
+    if processes == 1:
+        _init_worker(words, stem)
+        results = map(_tokenise_chunk, new_chunks())
+        pool = None
+    else:
+        pool = Pool(processes or os.cpu_count(), initializer=_init_worker, initargs=(words, stem))
+        results = pool.imap(_tokenise_chunk, new_chunks())
+    try:
+        for ids, hashes, tokens in tqdm(results):
+            cache.put(ids, hashes, tokens)
+            tokenised += len(ids)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    # Drop questions which have left the archive
+    if rows is None:
+        gone = set(cached) - set(archive_ids)
+        if len(gone) > 0:
+            cache.remove(gone)
+    print('Tokenised {n} new or changed questions; {c} were already cached.'.format(n=tokenised, c=len(archive_ids) - tokenised))
+    return cache, archive_ids
+
+
+def build_corpus(tmp, name='pqs_cleaned', backend='csv', stem=False, no_below=1, no_above=1.0, **kwargs):
+    """
+    Update the token cache of a cleaned archive (see update_tokens), and save a bag-of-words corpus of it for topic modelling: a gensim Dictionary and a Matrix Market corpus, {name}_corpus.dict and {name}_corpus.mm in the tmp folder ({name}_stemmed_corpus... if stemmed), with one document per question, in id order.
+    :param tmp: str, the tmp folder.
+    :param name: str, default 'pqs_cleaned'. Which cleaned archive: 'pqs_cleaned' or 'ua_pqs_cleaned'.
+    :param backend: str, default 'csv'. The cleaned archive's backend, 'csv' or 'parquet'.
+    :param stem: bool, default False. Lemmatise and stem the tokens. See tokenise.
+    :param no_below: int, default 1. Leave words which appear in fewer questions than this out of the dictionary.
+    :param no_above: float, default 1.0. Leave words which appear in more than this fraction of questions out of the dictionary.
+    :param kwargs: passed on to update_tokens, e.g. processes=4.
+    :return: see load_corpus.
+    """
+    cache, _ = update_tokens(tmp, name, backend, stem=stem, **kwargs)
+    paths = _corpus_paths(tmp, name, stem)
+
+    # Two passes over the cache, so that the tokens never have to be held in memory at once
+    id2word = Dictionary(tokens for _, tokens in cache)
+    if no_below > 1 or no_above < 1.0:
+        id2word.filter_extremes(no_below=no_below, no_above=no_above, keep_n=None)
+    ids = []
+
+    def bags():
+        for i, tokens in cache:
+            ids.append(i)
+            yield id2word.doc2bow(tokens)
+
+    MmCorpus.serialize(paths['corpus'], bags(), id2word=id2word)
+    id2word.save(paths['dictionary'])
+    with open(paths['ids'], 'w') as outfile:
+        json.dump(ids, outfile)
+    cache.close()
+    return load_corpus(tmp, name, stem=stem)
+
+
+def load_corpus(tmp, name='pqs_cleaned', ids=None, stem=False):
+    """
+    Load the bag-of-words corpus saved by build_corpus.
+    :param tmp: str, the tmp folder.
+    :param name: str, default 'pqs_cleaned'. Which cleaned archive's corpus.
+    :param ids: list, default None. Only load the documents for these WPQ ids, e.g. one month's questions. If None, load the whole corpus.
+    :param stem: bool, default False. Load the stemmed corpus.
+    :return: a list of the WPQ ids, the gensim Dictionary (id2word), and the corpus, whose documents are in the same order as the ids: a gensim MmCorpus if ids is None, otherwise a list of bags of words.
+    """
+    if Dictionary is None:
+        raise ImportError('Text preprocessing needs nltk and gensim. Install them with `pip install nltk gensim`.')
+    paths = _corpus_paths(tmp, name, stem)
+    if not os.path.exists(paths['corpus']):
+        raise FileNotFoundError('{p} not found. Run preprocessing.build_corpus first.'.format(p=paths['corpus']))
+    with open(paths['ids']) as infile:
+        corpus_ids = json.load(infile)
+    id2word = Dictionary.load(paths['dictionary'])
+    corpus = MmCorpus(paths['corpus'])
+    if ids is None:
+        return corpus_ids, id2word, corpus
+    positions = {i: k for k, i in enumerate(corpus_ids)}
+    wanted = [int(i) for i in ids if int(i) in positions]
+    return wanted, id2word, [corpus[positions[i]] for i in wanted]
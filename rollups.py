@@ -0,0 +1,247 @@
+import sqlite3
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+
+# The dimensions of the rollup cube, and the columns of the cleaned archive they come from
+DIMENSIONS = {
+    'topic': 'topic',
+    'party': 'latestPartyabbreviation',
+    'answering_body': 'answeringBodyName',
+    'house': 'house',
+    }
+
+
+class RollupCube:
+    """
+    Materialised daily counts of WPQs, kept in a SQLite file next to the cleaned archive so that the notebooks' usual aggregates (questions per department per day, topic by party, monthly top topics...) don't have to be recomputed from the whole archive.
+
+    Two tables are kept:
+    * facts - one compact row per question (id, date tabled, asking member and the DIMENSIONS), without any text. Updating a question which is already there replaces it, so changed questions are never counted twice.
+    * daily - the number of questions and of distinct asking members for every day x topic x party x answering body x house, rebuilt only for the days touched by an update.
+
+    Distinct members can't be added up across days, so counts over longer periods and rolling windows are worked out from the facts.
+    """
+
+    def __init__(self, path):
+        """
+        :param path: str, the SQLite file, e.g. 'tmp/pqs_cleaned_rollups.sqlite'. It is created if it doesn't exist.
+        """
+        self.path = str(path)
+        self.db = sqlite3.connect(self.path)
+        columns = ', '.join('{d} TEXT'.format(d=d) for d in DIMENSIONS)
+        self.db.execute('CREATE TABLE IF NOT EXISTS facts (id INTEGER PRIMARY KEY, date TEXT, member INTEGER, {c})'.format(c=columns))
+        self.db.execute('CREATE INDEX IF NOT EXISTS facts_date ON facts (date)')
+        self.db.execute('CREATE TABLE IF NOT EXISTS daily (date TEXT, {c}, questions INTEGER, members INTEGER)'.format(c=columns))
+        self.db.execute('CREATE INDEX IF NOT EXISTS daily_date ON daily (date)')
+        self.db.commit()
+
+    def __len__(self):
+        return self.db.execute('SELECT COUNT(*) FROM facts').fetchone()[0]
+
+    def update(self, cleaned):
+        """
+        Add questions to the cube, replacing any which are already in it, and recompute the daily counts for every day they touch.
+        :param cleaned: a DataFrame of cleaned WPQs, as produced by wpqs.clean_wpqs.
+        """
+        if len(cleaned) == 0:
+            return
+        facts = pd.DataFrame({
+            'id': cleaned['id'].astype('int64'),
+            'date': pd.to_datetime(cleaned['dateTabled']).dt.strftime('%Y-%m-%d'),
+            'member': cleaned['askingMemberId'],
+            })
+        for dimension, column in DIMENSIONS.items():
+            facts[dimension] = cleaned[column].astype(object) if column in cleaned.columns else None
+        # A question can turn up more than once in a batch if it changed; the last version wins
+        facts = facts.drop_duplicates(subset='id', keep='last')
+        facts = facts.astype(object).where(facts.notna(), None)
+
+        with self.db:
+            self._touch(facts['id'])
+            self.db.executemany('INSERT OR IGNORE INTO touched VALUES (?)', ((x,) for x in facts['date'].unique()))
+            self.db.executemany('INSERT OR REPLACE INTO facts VALUES ({p})'.format(p=', '.join('?' * len(facts.columns))), facts.itertuples(index=False, name=None))
+            self._recount()
+
+    def _touch(self, ids):
+        """
+        Start a fresh list of the days to recount, with the days some questions are on now.
+        """
+        self.db.execute('CREATE TEMP TABLE IF NOT EXISTS touched (date TEXT PRIMARY KEY)')
+        self.db.execute('DELETE FROM touched')
+        # The days a changed question used to be on need recounting, as well as the days it's on now
+        self.db.executemany('INSERT OR IGNORE INTO touched SELECT date FROM facts WHERE id = ?', ((int(x),) for x in ids))
+
+    def _recount(self):
+        self.db.execute('DELETE FROM daily WHERE date IN (SELECT date FROM touched)')
+        dimensions = ', '.join(DIMENSIONS)
+        self.db.execute('INSERT INTO daily SELECT date, {d}, COUNT(*), COUNT(DISTINCT member) FROM facts WHERE date IN (SELECT date FROM touched) GROUP BY date, {d}'.format(d=dimensions))
+
+    def remove(self, ids):
+        """
+        Take questions out of the cube, and recompute the daily counts for the days they were on.
+        :param ids: a list of WPQ ids.
+        """
+        with self.db:
+            self._touch(ids)
+            self.db.executemany('DELETE FROM facts WHERE id = ?', ((int(x),) for x in ids))
+            self._recount()
+
+    def rebuild(self, cleaned):
+        """
+        Replace the whole cube with the questions in cleaned.
+        """
+        with self.db:
+            self.db.execute('DELETE FROM facts')
+            self.db.execute('DELETE FROM daily')
+        self.update(cleaned)
+
+    def _where(self, start, end, filters):
+        clauses = []
+        params = []
+        if start is not None:
+            clauses.append('date >= ?')
+            params.append(pd.to_datetime(start).strftime('%Y-%m-%d'))
+        if end is not None:
+            clauses.append('date < ?')
+            params.append(pd.to_datetime(end).strftime('%Y-%m-%d'))
+        for dimension, value in filters.items():
+            if dimension not in DIMENSIONS:
+                raise ValueError("Unknown dimension '{d}'. Use any of {o}.".format(d=dimension, o=list(DIMENSIONS)))
+            if isinstance(value, (list, tuple, set)):
+                clauses.append('{d} IN ({p})'.format(d=dimension, p=', '.join('?' * len(value))))
+                params.extend(value)
+            else:
+                clauses.append('{d} = ?'.format(d=dimension))
+                params.append(value)
+        return ('WHERE ' + ' AND '.join(clauses)) if clauses else '', params
+
+    @staticmethod
+    def _check(by):
+        by = [] if by is None else [by] if isinstance(by, str) else list(by)
+        for dimension in by:
+            if dimension not in DIMENSIONS:
+                raise ValueError("Unknown dimension '{d}'. Use any of {o}.".format(d=dimension, o=list(DIMENSIONS)))
+        return by
+
+    def daily(self, by=None, start=None, end=None, **filters):
+        """
+        The number of questions on each day, straight from the materialised daily table. For distinct members per day, use counts(freq='D').
+        :param by: str or list, default None. Any of the DIMENSIONS (topic, party, answering_body, house) to break the counts down by.
+        :param start: a date, default None. Only days on or after this date.
+        :param end: a date, default None. Only days before this date.
+        :param filters: restrict any dimension to a value or list of values, e.g. house='Commons'.
+        :return: a DataFrame indexed by date (and the `by` dimensions), with a questions column.
+        """
+        by = self._check(by)
+        where, params = self._where(start, end, filters)
+        groups = ', '.join(['date'] + by)
+        df = pd.read_sql_query('SELECT {g}, SUM(questions) AS questions FROM daily {w} GROUP BY {g} ORDER BY {g}'.format(g=groups, w=where), self.db, params=params)
+        df['date'] = pd.to_datetime(df['date'])
+        return df.set_index(['date'] + by)
+
+    def counts(self, by=None, freq='M', start=None, end=None, **filters):
+        """
+        The number of questions and of distinct asking members in each period, e.g. each month.
+        :param by: str or list, default None. Any of the DIMENSIONS to break the counts down by, e.g. ['topic', 'party'].
+        :param freq: str, default 'M'. 'D' for days, 'M' for months or 'Y' for years.
+        :param start: a date, default None. Only questions tabled on or after this date.
+        :param end: a date, default None. Only questions tabled before this date.
+        :param filters: restrict any dimension to a value or list of values, e.g. house='Commons'.
+        :return: a DataFrame indexed by period (and the `by` dimensions), with columns questions and members.
+        """
+        by = self._check(by)
+        periods = {'D': 'date', 'M': 'substr(date, 1, 7)', 'Y': 'substr(date, 1, 4)'}
+        if freq not in periods:
+            raise ValueError("Unknown freq '{f}'. Use 'D', 'M' or 'Y'.".format(f=freq))
+        where, params = self._where(start, end, filters)
+        groups = ', '.join(['period'] + by)
+        sql = 'SELECT {p} AS period, {b}COUNT(*) AS questions, COUNT(DISTINCT member) AS members FROM facts {w} GROUP BY {g} ORDER BY {g}'.format(
+            p=periods[freq], b=''.join(d + ', ' for d in by), w=where, g=groups)
+        df = pd.read_sql_query(sql, self.db, params=params)
+        df['period'] = pd.PeriodIndex(df['period'], freq=freq)
+        return df.set_index(['period'] + by)
+
+    def top(self, dimension='topic', n=10, freq='M', start=None, end=None, **filters):
+        """
+        The n most asked about values of a dimension in each period, e.g. the top 10 topics each month.
+        :return: a DataFrame with columns period, the dimension, questions, members and rank (1 for the most questions).
+        """
+        df = self.counts(by=dimension, freq=freq, start=start, end=end, **filters).reset_index()
+        df = df.sort_values(['period', 'questions'], ascending=[True, False], kind='stable')
+        df['rank'] = df.groupby('period').cumcount() + 1
+        return df[df['rank'] <= n].reset_index(drop=True)
+
+    def rolling(self, window=28, by=None, start=None, end=None, **filters):
+        """
+        Rolling counts of questions and of distinct asking members over the last `window` days, for every day.
+        Members are counted exactly: someone asking several questions within a window is counted once.
+        :param window: int, default 28. The length of the window in days.
+        :param by: str or list, default None. Any of the DIMENSIONS to break the counts down by.
+        :param start: a date, default None. The first day to report. Questions from the window before it are still counted.
+        :param end: a date, default None. Only report days before this date.
+        :param filters: restrict any dimension to a value or list of values, e.g. house='Commons'.
+        :return: a DataFrame indexed by date (and the `by` dimensions), with columns questions and members.
+        """
+        by = self._check(by)
+        lookback = None if start is None else pd.to_datetime(start) - pd.Timedelta(days=window - 1)
+        where, params = self._where(lookback, end, filters)
+        # One row per member per day (per group), with the number of questions they asked
+        groups = ', '.join(['date'] + by + ['member'])
+        df = pd.read_sql_query('SELECT {g}, COUNT(*) AS questions FROM facts {w} GROUP BY {g}'.format(g=groups, w=where), self.db, params=params)
+        if len(df) == 0:
+            return pd.DataFrame(columns=['questions', 'members'], index=pd.MultiIndex.from_tuples([], names=['date'] + by) if by else pd.DatetimeIndex([], name='date'))
+        df['date'] = pd.to_datetime(df['date'])
+        # Questions with no value for a dimension are grouped together, rather than dropped by groupby
+        df[by] = df[by].fillna('n/a')
+        days = pd.date_range(df['date'].min(), df['date'].max() if end is None else pd.to_datetime(end) - pd.Timedelta(days=1), freq='D')
+
+        # Questions: a rolling sum of the daily totals
+        if by:
+            questions = df.groupby(['date'] + by)['questions'].sum().unstack(by).reindex(days, fill_value=0).fillna(0)
+        else:
+            questions = df.groupby('date')['questions'].sum().reindex(days, fill_value=0).to_frame('questions')
+        questions = questions.rolling(window, min_periods=1).sum()
+
+        # Members: each member covers the `window` days after each day they asked a question. Overlapping spans are merged into runs, and counting the runs which cover each day gives the distinct members in its window.
+        df = df.sort_values(by + ['member', 'date'])
+        key = df[by + ['member']]
+        new_key = (key != key.shift()).any(axis=1)
+        gap = df['date'].diff().dt.days
+        run_start = new_key | (gap >= window)
+        run_id = run_start.cumsum()
+        runs = df.groupby(run_id).agg(**{d: (d, 'first') for d in by}, first=('date', 'first'), last=('date', 'last'))
+        starts = runs[by + ['first']].rename(columns={'first': 'date'}).assign(change=1)
+        stops = runs[by + ['last']].rename(columns={'last': 'date'}).assign(change=-1)
+        stops['date'] = stops['date'] + pd.Timedelta(days=window)
+        changes = pd.concat([starts, stops]).groupby(['date'] + by)['change'].sum()
+        if by:
+            members = changes.unstack(by).reindex(days.union(changes.index.get_level_values('date').unique()), fill_value=0).fillna(0).cumsum().reindex(days)
+        else:
+            members = changes.reindex(days.union(changes.index.unique()), fill_value=0).cumsum().reindex(days).to_frame('members')
+
+        if by:
+            result = pd.concat({'questions': questions.stack(list(range(len(by)))), 'members': members.stack(list(range(len(by))))}, axis=1)
+            result.index.names = ['date'] + by
+            # Leave out the groups which have nothing in their window
+            result = result[(result['questions'] > 0) | (result['members'] > 0)].sort_index()
+        else:
+            result = pd.concat([questions, members], axis=1)
+            result.index.name = 'date'
+        if start is not None:
+            result = result[result.index.get_level_values('date') >= pd.to_datetime(start)]
+        return result.fillna(0).astype(np.int64)
+
+    def close(self):
+        self.db.close()
+
+
+def open_rollups(tmp, name):
+    """
+    Open the rollup cube of one of the cleaned archives, {name}_rollups.sqlite in the tmp folder.
+    :param name: str, the cleaned archive's name, e.g. 'pqs_cleaned'.
+    :return: a RollupCube
+    """
+    return RollupCube(Path(tmp) / '{n}_rollups.sqlite'.format(n=name))
@@ -0,0 +1,169 @@
+import sqlite3
+from pathlib import Path
+
+import pandas as pd
+
+
+# The text columns of the cleaned archive which are indexed for keyword search
+SEARCH_COLUMNS = ['cleanedQuestion', 'heading', 'topic']
+
+# What each grouping offered by SearchIndex.counts is computed from
+GROUPINGS = {
+    'day': 'date',
+    'month': 'substr(date, 1, 7)',
+    'party': 'party',
+    'member': 'member',
+    'house': 'house',
+    'answering_body': 'answering_body',
+    }
+
+
+def keyword_query(keyword, columns=None):
+    """
+    Turn a plain keyword or phrase into an FTS5 query which behaves like cleanedQuestion.str.contains(keyword) does in the notebooks, except that words have to match from their start:
+    the words must appear together and in order, and the last one may be cut short, so 'public charg' finds 'public charging' and 'public chargepoints'.
+    :param keyword: str, e.g. 'electric vehicle'
+    :param columns: list, default None. Only search these of SEARCH_COLUMNS. None searches them all.
+    :return: str, an FTS5 query.
+    """
+    query = '"{k}" *'.format(k=keyword.replace('"', '""'))
+    if columns is not None:
+        query = '{{{c}}} : {q}'.format(c=' '.join(columns), q=query)
+    return query
+
+
+class SearchIndex:
+    """
+    A persistent full-text index of a cleaned WPQ archive, kept in a SQLite file with an FTS5 table, so that keyword searches don't have to scan every question.
+
+    Alongside the indexed text, each question's date tabled, party, asking member, house and answering body are kept, so that counts over time or by party can be worked out without loading the archive.
+    The index is keyed on the WPQ id: updating it with a question it already holds replaces the old version.
+    """
+
+    def __init__(self, path):
+        """
+        :param path: str, the SQLite file, e.g. 'tmp/pqs_cleaned_search.sqlite'. It is created if it doesn't exist.
+        """
+        self.path = str(path)
+        self.db = sqlite3.connect(self.path)
+        self.db.execute('CREATE TABLE IF NOT EXISTS questions (id INTEGER PRIMARY KEY, date TEXT, party TEXT, member INTEGER, house TEXT, answering_body TEXT)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS questions_date ON questions (date)')
+        self.db.execute('CREATE VIRTUAL TABLE IF NOT EXISTS questions_text USING fts5({c})'.format(c=', '.join(SEARCH_COLUMNS)))
+        self.db.commit()
+
+    def __len__(self):
+        return self.db.execute('SELECT COUNT(*) FROM questions').fetchone()[0]
+
+    def update(self, cleaned):
+        """
+        Add questions to the index, replacing any which are already in it.
+        :param cleaned: a DataFrame of cleaned WPQs, as produced by wpqs.clean_wpqs.
+        """
+        if len(cleaned) == 0:
+            return
+        ids = cleaned['id'].astype('int64')
+        meta = pd.DataFrame({
+            'id': ids,
+            'date': pd.to_datetime(cleaned['dateTabled']).dt.strftime('%Y-%m-%d'),
+            'party': cleaned['latestPartyabbreviation'].astype(object) if 'latestPartyabbreviation' in cleaned.columns else None,
+            'member': cleaned['askingMemberId'],
+            'house': cleaned['house'].astype(object),
+            'answering_body': cleaned['answeringBodyName'].astype(object),
+            })
+        text = cleaned[SEARCH_COLUMNS].astype(object).where(cleaned[SEARCH_COLUMNS].notna(), '')
+        # A question can turn up more than once in a batch if it changed; the last version wins
+        keep = ~ids.duplicated(keep='last').values
+        meta = meta[keep].astype(object).where(meta[keep].notna(), None)
+        text = text[keep]
+        id_list = [int(x) for x in ids[keep]]
+
+        with self.db:
+            self.db.executemany('DELETE FROM questions_text WHERE rowid = ?', ((x,) for x in id_list))
+            self.db.executemany('INSERT OR REPLACE INTO questions VALUES (?, ?, ?, ?, ?, ?)', meta.itertuples(index=False, name=None))
+            self.db.executemany('INSERT INTO questions_text (rowid, {c}) VALUES (?, ?, ?, ?)'.format(c=', '.join(SEARCH_COLUMNS)),
+                                ((x,) + tuple(row) for x, row in zip(id_list, text.itertuples(index=False, name=None))))
+
+    def remove(self, ids):
+        """
+        Take questions out of the index.
+        :param ids: a list of WPQ ids.
+        """
+        ids = [(int(x),) for x in ids]
+        with self.db:
+            self.db.executemany('DELETE FROM questions_text WHERE rowid = ?', ids)
+            self.db.executemany('DELETE FROM questions WHERE id = ?', ids)
+
+    def rebuild(self, cleaned):
+        """
+        Replace the whole index with the questions in cleaned.
+        """
+        with self.db:
+            self.db.execute('DELETE FROM questions')
+            self.db.execute('DELETE FROM questions_text')
+        self.update(cleaned)
+
+    def _where(self, query, keyword, house, start, end):
+        clauses = ['questions_text MATCH ?']
+        params = [query if query is not None else keyword_query(keyword)]
+        if house is not None:
+            clauses.append('q.house = ?')
+            params.append(house)
+        if start is not None:
+            clauses.append('q.date >= ?')
+            params.append(pd.to_datetime(start).strftime('%Y-%m-%d'))
+        if end is not None:
+            clauses.append('q.date < ?')
+            params.append(pd.to_datetime(end).strftime('%Y-%m-%d'))
+        return ' AND '.join(clauses), params
+
+    def ids(self, keyword=None, query=None, house=None, start=None, end=None):
+        """
+        Find the questions which mention a keyword.
+        :param keyword: str, a plain keyword or phrase, e.g. 'heat pump'. See keyword_query.
+        :param query: str, default None. A raw FTS5 query, e.g. 'brexit OR "leaving the eu"', used instead of keyword.
+        :param house: str, default None. Only 'Commons' or 'Lords' questions.
+        :param start: a date, default None. Only questions tabled on or after this date.
+        :param end: a date, default None. Only questions tabled before this date.
+        :return: a sorted list of WPQ ids.
+        """
+        where, params = self._where(query, keyword, house, start, end)
+        rows = self.db.execute('SELECT q.id FROM questions_text JOIN questions q ON q.id = questions_text.rowid WHERE {w} ORDER BY q.id'.format(w=where), params)
+        return [row[0] for row in rows]
+
+    def counts(self, keyword=None, by='month', query=None, house=None, start=None, end=None):
+        """
+        Count the questions, and the distinct members asking them, which mention a keyword.
+        :param keyword: str, a plain keyword or phrase. See ids.
+        :param by: str or list, default 'month'. What to count by: any of 'day', 'month', 'party', 'member', 'house' and 'answering_body'. e.g. ['month', 'party'] gives the counts for each party in each month.
+        :param query: str, default None. A raw FTS5 query, used instead of keyword.
+        :param house: str, default None. Only 'Commons' or 'Lords' questions.
+        :param start: a date, default None. Only questions tabled on or after this date.
+        :param end: a date, default None. Only questions tabled before this date.
+        :return: a DataFrame indexed by the `by` columns, with columns questions and members.
+        """
+        by = [by] if isinstance(by, str) else list(by)
+        for group in by:
+            if group not in GROUPINGS:
+                raise ValueError("Can't count by '{g}'. Use any of {o}.".format(g=group, o=list(GROUPINGS)))
+        where, params = self._where(query, keyword, house, start, end)
+        select = ', '.join('{e} AS {g}'.format(e=GROUPINGS[g], g=g) for g in by)
+        sql = 'SELECT {s}, COUNT(*) AS questions, COUNT(DISTINCT q.member) AS members FROM questions_text JOIN questions q ON q.id = questions_text.rowid WHERE {w} GROUP BY {g} ORDER BY {g}'.format(
+            s=select, w=where, g=', '.join(by))
+        df = pd.read_sql_query(sql, self.db, params=params)
+        if 'day' in by:
+            df['day'] = pd.to_datetime(df['day'])
+        if 'month' in by:
+            df['month'] = pd.PeriodIndex(df['month'], freq='M')
+        return df.set_index(by)
+
+    def close(self):
+        self.db.close()
+
+
+def open_search_index(tmp, name):
+    """
+    Open the search index of one of the cleaned archives, {name}_search.sqlite in the tmp folder.
+    :param name: str, the cleaned archive's name, e.g. 'pqs_cleaned'.
+    :return: a SearchIndex
+    """
+    return SearchIndex(Path(tmp) / '{n}_search.sqlite'.format(n=name))
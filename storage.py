@@ -0,0 +1,338 @@
+import os
+from pathlib import Path
+
+import pandas as pd
+
+import metrics
+
+try:
+    import pyarrow.parquet as pq
+except ImportError:
+    pq = None
+
+
+# Explicit dtypes for the columns of the WPQ archives. Without these, pandas guesses the types again on every read, and the guesses for a CSV round trip don't match those for fresh API data, which stops drop_duplicates() from spotting repeated rows.
+WPQ_DTYPES = {
+    'id': 'Int64',
+    'askingMemberId': 'Int64',
+    'askingMember': 'string',
+    'house': 'string',
+    'memberHasInterest': 'boolean',
+    'uin': 'string',
+    'questionText': 'string',
+    'answeringBodyId': 'Int64',
+    'answeringBodyName': 'string',
+    'isWithdrawn': 'boolean',
+    'isNamedDay': 'boolean',
+    'answerIsHolding': 'boolean',
+    'answerIsCorrection': 'boolean',
+    'answeringMemberId': 'Int64',
+    'answeringMember': 'string',
+    'correctingMemberId': 'Int64',
+    'correctingMember': 'string',
+    'answerText': 'string',
+    'originalAnswerText': 'string',
+    'comparableAnswerText': 'string',
+    'attachmentCount': 'Int64',
+    'heading': 'string',
+    # Columns added by the cleaning stage
+    'latestPartyabbreviation': 'string',
+    'topic': 'string',
+    'year_month': 'string',
+    'cleanedQuestion': 'string',
+    'contentHash': 'int64',
+    }
+
+WPQ_DATE_COLUMNS = ['dateTabled', 'dateForAnswer', 'dateAnswered', 'dateAnswerCorrected', 'dateHoldingAnswer']
+
+
+# For compact reads of the archives (see compact_dtypes): low-cardinality text columns, which are held as categoricals
+WPQ_CATEGORICAL_COLUMNS = ['house', 'answeringBodyName', 'topic', 'heading', 'askingMember', 'answeringMember', 'correctingMember', 'latestPartyabbreviation', 'year_month']
+
+# The long free text columns, which take up most of the memory of a loaded archive
+WPQ_TEXT_COLUMNS = ['questionText', 'answerText', 'originalAnswerText', 'comparableAnswerText', 'cleanedQuestion']
+
+
+def coerce_dtypes(df, dtypes=WPQ_DTYPES, date_columns=WPQ_DATE_COLUMNS):
+    """
+    Cast the columns of a WPQ DataFrame to their explicit dtypes. Columns which aren't in the DataFrame are ignored.
+    :return: the DataFrame, with its columns cast in place.
+    """
+    for column, dtype in dtypes.items():
+        if column in df.columns:
+            if dtype == 'string':
+                # Nested objects (e.g. askingMember when the API expands it) are stored as their text, just like the CSV archive does
+                df[column] = df[column].map(lambda x: x if x is None or isinstance(x, str) or pd.isna(x) else str(x)).astype('string')
+            else:
+                df[column] = df[column].astype(dtype)
+    for column in date_columns:
+        if column in df.columns:
+            df[column] = pd.to_datetime(df[column])
+    return df
+
+
+def compact_dtypes(df):
+    """
+    Cast the columns of a WPQ DataFrame to the smallest types which hold them: categoricals for WPQ_CATEGORICAL_COLUMNS (year_month becomes a categorical of monthly Periods), the smallest integer type for ids and counts, plain bools for flags with no missing values, and the string dtype for other text (e.g. uin, which would otherwise come back from a CSV as numbers).
+    :return: the DataFrame, with its columns cast in place.
+    """
+    for column in df.columns:
+        dtype = WPQ_DTYPES.get(column)
+        if column in WPQ_CATEGORICAL_COLUMNS:
+            if not isinstance(df[column].dtype, pd.CategoricalDtype):
+                df[column] = df[column].astype('category')
+            if column == 'year_month' and not isinstance(df[column].cat.categories, pd.PeriodIndex):
+                df[column] = df[column].cat.rename_categories(pd.PeriodIndex(df[column].cat.categories.astype(str), freq='M'))
+        elif dtype == 'Int64' or (dtype == 'int64' and column != 'contentHash'):
+            # Columns with missing values stay nullable (e.g. Int16), but are still as small as the values allow. Those without are plain ints, whichever backend they were read from.
+            values = df[column].astype('Int64') if df[column].isna().any() else df[column].astype('int64')
+            df[column] = pd.to_numeric(values, downcast='integer')
+        elif dtype == 'boolean':
+            df[column] = df[column].astype('boolean')
+            if not df[column].isna().any():
+                df[column] = df[column].astype(bool)
+        elif dtype == 'string':
+            df[column] = df[column].astype('string')
+        elif column in WPQ_DATE_COLUMNS:
+            df[column] = pd.to_datetime(df[column])
+    return df
+
+
+class CsvStore:
+    """
+    The legacy archive backend: the whole archive in a single CSV file. Updates which only add rows append them to the end of the file, and anything else re-reads and rewrites it in full.
+    """
+
+    def __init__(self, path, date_column):
+        self.path = Path(path)
+        self.date_column = date_column
+
+    def exists(self):
+        return self.path.is_file()
+
+    def read(self, columns=None, start=None, end=None, compact=False):
+        """
+        Read the archive.
+        :param columns: list, default None. Only return these columns. If None, return every column.
+        :param start: a date, default None. Only return rows where date_column is on or after this date.
+        :param end: a date, default None. Only return rows where date_column is before this date.
+        :param compact: bool, default False. If True, return the columns in their most compact types (see compact_dtypes) rather than WPQ_DTYPES. Categorical columns are parsed straight into categoricals, so the full strings are never held in memory.
+        :return: a DataFrame
+        """
+        usecols = None
+        if columns is not None:
+            usecols = list(columns) + ([self.date_column] if self.date_column not in columns and (start or end) else [])
+        if compact:
+            df = compact_dtypes(pd.read_csv(self.path, usecols=usecols, dtype={c: 'category' for c in WPQ_CATEGORICAL_COLUMNS}))
+        else:
+            df = coerce_dtypes(pd.read_csv(self.path, usecols=usecols))
+        if start is not None:
+            df = df[df[self.date_column] >= pd.to_datetime(start)]
+        if end is not None:
+            df = df[df[self.date_column] < pd.to_datetime(end)]
+        if columns is not None:
+            df = df[list(columns)]
+        return df.reset_index(drop=True)
+
+    def columns(self):
+        return pd.read_csv(self.path, nrows=0).columns.tolist()
+
+    def read_rows(self, ids, columns, chunksize=100000):
+        """
+        Read some columns for just the rows with the given ids. The file is read a chunk at a time, so only the matching rows are ever held in memory.
+        :return: a DataFrame
+        """
+        ids = set(ids)
+        usecols = ['id'] + [c for c in columns if c != 'id']
+        chunks = [chunk[chunk['id'].isin(ids)] for chunk in pd.read_csv(self.path, usecols=usecols, chunksize=chunksize)]
+        return coerce_dtypes(pd.concat(chunks, ignore_index=True))
+
+    def iter_chunks(self, columns, chunksize=100000):
+        """
+        Read some columns of the whole archive a chunk of rows at a time, so that it never has to be held in memory at once.
+        :return: an iterator of DataFrames
+        """
+        for chunk in pd.read_csv(self.path, usecols=list(columns), chunksize=chunksize):
+            yield coerce_dtypes(chunk)
+
+    def count(self):
+        return len(pd.read_csv(self.path, usecols=[0]))
+
+    def max_date(self):
+        return pd.to_datetime(pd.read_csv(self.path, usecols=[self.date_column])[self.date_column]).max()
+
+    def upsert(self, df, key=None, existing=None):
+        """
+        Add new rows to the archive, dropping any rows which are already in it.
+        :param key: str, default None. If set, e.g. 'id', rows of the archive with the same key as a new row are replaced by it, rather than kept alongside it.
+        :param existing: list, default None. The keys of the new rows which are already in the archive, if the caller knows them (e.g. from reading the keys in the new rows' date range). If none of them are, the new rows are appended to the file, rather than the whole archive being read and rewritten. Only used with key.
+        :return: a DataFrame of the rows which were added.
+        """
+        df = coerce_dtypes(df.copy())
+        if key is not None and existing is not None and self.exists():
+            header = self.columns()
+            if sorted(df.columns) == sorted(header) and not df[key].isin(list(existing)).any():
+                with metrics.timer('drop_duplicates'):
+                    df = df.drop_duplicates()
+                with metrics.timer('csv_write'):
+                    df[header].to_csv(self.path, mode='a', header=False, index=False)
+                return df.reset_index(drop=True)
+        if self.exists():
+            old = self.read()
+            if key is not None:
+                old = old[~old[key].isin(df[key])].reset_index(drop=True)
+            old_length = len(old)
+            df = pd.concat([old, df], ignore_index=True)
+        else:
+            old_length = 0
+        with metrics.timer('drop_duplicates'):
+            df = df.drop_duplicates()
+        with metrics.timer('csv_write'):
+            df.to_csv(self.path, index=False, index_label=False)
+        # drop_duplicates keeps the first copy, so anything left from after the old rows is new
+        return df[df.index >= old_length].reset_index(drop=True)
+
+    def write(self, df):
+        """
+        Replace the whole archive with df.
+        """
+        with metrics.timer('csv_write'):
+            coerce_dtypes(df.copy()).to_csv(self.path, index=False, index_label=False)
+
+
+class ParquetStore:
+    """
+    An archive backend made of Parquet files partitioned by year and month of date_column, e.g. pqs/year=2022/month=1/part-0.parquet.
+
+    Updates only rewrite the partitions that new rows fall into, and reads can select columns and skip partitions (and row groups) outside a date range.
+    """
+
+    def __init__(self, path, date_column):
+        if pq is None:
+            raise ImportError('The parquet archive backend needs pyarrow. Install it with `pip install pyarrow`, or use the csv backend.')
+        self.path = Path(path)
+        self.date_column = date_column
+
+    def partitions(self):
+        """
+        :return: a sorted list of (year, month, path) for every partition in the archive.
+        """
+        found = []
+        for part in self.path.glob('year=*/month=*/part-0.parquet'):
+            year = int(part.parent.parent.name.split('=')[1])
+            month = int(part.parent.name.split('=')[1])
+            found.append((year, month, part))
+        return sorted(found)
+
+    def exists(self):
+        return len(self.partitions()) > 0
+
+    def read(self, columns=None, start=None, end=None, compact=False):
+        """
+        Read the archive. Date filters are pushed down to pyarrow, so partitions and row groups outside the range are never read.
+        :param columns: list, default None. Only return these columns. If None, return every column.
+        :param start: a date, default None. Only return rows where date_column is on or after this date.
+        :param end: a date, default None. Only return rows where date_column is before this date.
+        :param compact: bool, default False. If True, return the columns in their most compact types (see compact_dtypes) rather than WPQ_DTYPES.
+        :return: a DataFrame
+        """
+        filters = []
+        if start is not None:
+            start = pd.to_datetime(start)
+            filters += [('year', '>=', start.year), (self.date_column, '>=', start)]
+        if end is not None:
+            end = pd.to_datetime(end)
+            filters += [('year', '<=', end.year), (self.date_column, '<', end)]
+        df = pd.read_parquet(self.path, columns=columns, filters=filters or None, partitioning='hive')
+        # The partition keys are only there for pruning
+        df = df.drop(columns=['year', 'month'], errors='ignore')
+        if compact:
+            return compact_dtypes(df).reset_index(drop=True)
+        return coerce_dtypes(df).reset_index(drop=True)
+
+    def columns(self):
+        return pq.read_schema(self.partitions()[0][2]).names
+
+    def read_rows(self, ids, columns):
+        """
+        Read some columns for just the rows with the given ids. The id filter is pushed down to pyarrow.
+        :return: a DataFrame
+        """
+        usecols = ['id'] + [c for c in columns if c != 'id']
+        df = pd.read_parquet(self.path, columns=usecols, filters=[('id', 'in', [int(x) for x in ids])], partitioning='hive')
+        return coerce_dtypes(df).reset_index(drop=True)
+
+    def iter_chunks(self, columns, chunksize=None):
+        """
+        Read some columns of the whole archive a partition at a time, so that it never has to be held in memory at once.
+        :param chunksize: ignored, each chunk is one month's partition.
+        :return: an iterator of DataFrames
+        """
+        for _, _, part in self.partitions():
+            yield coerce_dtypes(pd.read_parquet(part, columns=list(columns)))
+
+    def count(self):
+        return sum(pq.ParquetFile(part).metadata.num_rows for _, _, part in self.partitions())
+
+    def max_date(self):
+        year, month, part = self.partitions()[-1]
+        return pd.read_parquet(part, columns=[self.date_column])[self.date_column].max()
+
+    def upsert(self, df, key=None, existing=None):
+        """
+        Add new rows to the archive, dropping any rows which are already in it. Only the partitions which the new rows fall into are read and rewritten.
+        :param key: str, default None. If set, e.g. 'id', rows of those partitions with the same key as a new row are replaced by it, rather than kept alongside it. A row whose date has moved it to another partition leaves its old version behind.
+        :param existing: ignored, as only the new rows' partitions are read anyway. See CsvStore.upsert.
+        :return: a DataFrame of the rows which were added.
+        """
+        df = coerce_dtypes(df.copy())
+        added = []
+        dates = df[self.date_column]
+        for (year, month), group in df.groupby([dates.dt.year, dates.dt.month]):
+            part = self.path / 'year={y}'.format(y=int(year)) / 'month={m}'.format(m=int(month)) / 'part-0.parquet'
+            part.parent.mkdir(parents=True, exist_ok=True)
+            if part.is_file():
+                old = coerce_dtypes(pd.read_parquet(part))
+                if key is not None:
+                    old = old[~old[key].isin(group[key])].reset_index(drop=True)
+                old_length = len(old)
+                group = pd.concat([old, group], ignore_index=True)
+            else:
+                old_length = 0
+            with metrics.timer('drop_duplicates'):
+                group = group.drop_duplicates()
+            added.append(group[group.index >= old_length])
+            group = group.sort_values(self.date_column, kind='stable')
+            # Write to a temporary file first, so a crash can't leave a partition half-written. Its name starts with '_', so that pyarrow's dataset readers skip it if it's left behind.
+            tmp_part = part.parent / '_{n}.tmp'.format(n=part.name)
+            with metrics.timer('parquet_write'):
+                group.to_parquet(tmp_part, index=False)
+            os.replace(tmp_part, part)
+        if len(added) == 0:
+            return df.iloc[0:0]
+        return pd.concat(added, ignore_index=True)
+
+    def write(self, df):
+        """
+        Replace the whole archive with df.
+        """
+        for _, _, part in self.partitions():
+            os.remove(part)
+        self.upsert(df)
+
+
+def open_store(tmp, name, date_column, backend='csv'):
+    """
+    Open one of the WPQ archives in the tmp folder.
+    :param tmp: str, the tmp folder.
+    :param name: str, the archive's name, e.g. 'pqs' or 'ua_pqs'.
+    :param date_column: str, the column used to partition the archive and to work out when it was last updated.
+    :param backend: str, default 'csv'. 'csv' for the legacy single-file archive ({name}.csv), or 'parquet' for an archive partitioned by year and month ({name}/).
+    :return: a CsvStore or ParquetStore
+    """
+    if backend == 'csv':
+        return CsvStore(Path(tmp) / '{n}.csv'.format(n=name), date_column)
+    elif backend == 'parquet':
+        return ParquetStore(Path(tmp) / name, date_column)
+    else:
+        raise ValueError("Unknown archive backend '{b}'. Use 'csv' or 'parquet'.".format(b=backend))
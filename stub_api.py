@@ -0,0 +1,220 @@
+"""
+A local stand-in for Parliament's members-api and writtenquestions-api, which serves synthetic (or recorded) payloads with a configurable latency, so that the pipelines can be benchmarked offline. See benchmarks.bench_pipelines.
+"""
+import hashlib
+import json
+import random
+import threading
+import time
+from datetime import date, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+
+# The base URLs of the APIs the stub stands in for
+MEMBERS_API = 'https://members-api.parliament.uk'
+WPQ_API = 'https://writtenquestions-api.parliament.uk'
+
+# The first day of the WPQ archive, as in wpqs.update_answered_pqs
+FIRST_DAY = date(2014, 5, 1)
+
+PARTIES = [(4, 'Conservative', 'Con'), (15, 'Labour', 'Lab'), (17, 'Liberal Democrat', 'LD'), (29, 'Scottish National Party', 'SNP'), (6, 'Crossbench', 'XB')]
+DEPARTMENTS = [(27, 'Department for Transport', 'transport'), (1, 'Home Office', 'the home department'), (17, 'Department of Health and Social Care', 'health and social care'),
+               (14, 'Treasury', 'the treasury'), (60, 'Department for Education', 'education')]
+HEADINGS = ['Electric Vehicles: Charging Points', 'Roads', 'NHS: Staff', 'Schools', 'Housing', 'Police: Recruitment']
+WORDS = ('what steps his department is taking to increase the number of electric vehicle charging points in rural areas '
+         'and what assessment she has made of the effect of that policy on emissions housing food business energy').split()
+
+
+class StubAPI:
+    """
+    A threaded HTTP server on localhost which answers the same requests as the real APIs:
+    /api/Members/{id}, /api/Location/Constituency/{id} and /api/writtenquestions/questions (with its tabledWhen/answeredWhen, answered, skip and take parameters).
+
+    Members exist for every id up to max_member_id except multiples of 7, and constituencies for every id up to max_constituency_id. Every day since FIRST_DAY has questions_per_day WPQs, each answered a week after it was tabled.
+    Member and constituency responses carry an ETag, and conditional requests get a 304, as the real API does.
+
+    Use it as a context manager: `with StubAPI(latency=0.05) as stub: ... stub.url ...`
+    """
+
+    def __init__(self, latency=0.02, jitter=0.5, max_member_id=5000, max_constituency_id=5000, questions_per_day=3, today=None, recorded=None, seed=0):
+        """
+        :param latency: float, default 0.02. The mean time in seconds each response is delayed by, to stand in for the network and the real API's own work.
+        :param jitter: float, default 0.5. Each delay is drawn uniformly from latency * (1 - jitter) to latency * (1 + jitter).
+        :param max_member_id: int, default 5000.
+        :param max_constituency_id: int, default 5000.
+        :param questions_per_day: int, default 3.
+        :param today: a date, default None. The last day with questions. None is today.
+        :param recorded: dict, default None. Recorded payloads to replay instead of synthetic ones, keyed by request path, e.g. {'/api/Members/172': {...}}.
+        :param seed: int, default 0. The random seed for the delays, so that runs are comparable.
+        """
+        self.latency = latency
+        self.jitter = jitter
+        self.max_member_id = max_member_id
+        self.max_constituency_id = max_constituency_id
+        self.questions_per_day = questions_per_day
+        self.today = today or date.today()
+        self.recorded = recorded or {}
+        self.requests = 0
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self._server = None
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:{p}'.format(p=self._server.server_address[1])
+
+    def start(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            # Keep-alive, so that the pipelines' connection pools work as they do against the real APIs
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                status, body = stub.respond(self.path)
+                etag = '"{h}"'.format(h=hashlib.md5(body).hexdigest()) if status == 200 and '/writtenquestions/' not in self.path else None
+                if etag is not None and self.headers.get('If-None-Match') == etag:
+                    status, body = 304, b''
+                time.sleep(stub.delay())
+                self.send_response(status)
+                self.send_header('Content-Type', 'text/plain')
+                self.send_header('Content-Length', str(len(body)))
+                if etag is not None:
+                    self.send_header('ETag', etag)
+                self.end_headers()
+                self.wfile.write(body)
+
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def overrides(self):
+        """
+        :return: a dict for http_client.override_hosts, which sends both APIs' requests to the stub.
+        """
+        return {MEMBERS_API: self.url, WPQ_API: self.url}
+
+    def delay(self):
+        with self._lock:
+            self.requests += 1
+            return self.latency * self._rng.uniform(1 - self.jitter, 1 + self.jitter)
+
+    def respond(self, path):
+        """
+        :return: the status and body of the response to a request path (including its query string).
+        """
+        parts = urlsplit(path)
+        if parts.path in self.recorded:
+            return 200, json.dumps(self.recorded[parts.path]).encode()
+        segments = parts.path.strip('/').split('/')
+        try:
+            if segments[:2] == ['api', 'Members'] and len(segments) == 3:
+                payload = self.member(int(segments[2]))
+            elif segments[:3] == ['api', 'Location', 'Constituency'] and len(segments) == 4:
+                payload = self.constituency(int(segments[3]))
+            elif parts.path == '/api/writtenquestions/questions':
+                payload = self.questions({k: v[0] for k, v in parse_qs(parts.query).items()})
+            else:
+                payload = None
+        except ValueError:
+            return 400, b''
+        if payload is None:
+            return 404, b''
+        return 200, json.dumps(payload).encode()
+
+    def member(self, n):
+        if n < 1 or n > self.max_member_id or n % 7 == 0:
+            return None
+        party_id, party_name, party_abbreviation = PARTIES[n % len(PARTIES)]
+        house = 1 if n % 3 else 2
+        return {'value': {
+            'id': n,
+            'nameListAs': 'Member{n}, {t} First{n}'.format(n=n, t=['Mr', 'Ms', 'Dr', 'Sir'][n % 4]),
+            'nameDisplayAs': 'First{n} Member{n}'.format(n=n),
+            'nameFullTitle': 'First{n} Member{n} MP'.format(n=n),
+            'nameAddressAs': None,
+            'latestParty': {'id': party_id, 'name': party_name, 'abbreviation': party_abbreviation, 'backgroundColour': '0087DC', 'foregroundColour': 'FFFFFF', 'isLordsMainParty': False, 'isLordsSpiritualParty': False, 'governmentType': None, 'isIndependentParty': False},
+            'gender': 'F' if n % 2 else 'M',
+            'latestHouseMembership': {
+                'membershipFrom': 'Constituency {c}'.format(c=n % 650) if house == 1 else 'Life peer',
+                'membershipFromId': n % 650 if house == 1 else None,
+                'house': house,
+                'membershipStartDate': '2015-05-07T00:00:00',
+                'membershipEndDate': None if n % 4 else '2019-11-06T00:00:00',
+                'membershipEndReason': None,
+                'membershipEndReasonNotes': None,
+                'membershipEndReasonId': None,
+                'membershipStatus': None,
+                },
+            'thumbnailUrl': 'https://members-api.parliament.uk/api/Members/{n}/Thumbnail'.format(n=n),
+            }, 'links': []}
+
+    def constituency(self, n):
+        if n < 0 or n > self.max_constituency_id:
+            return None
+        member = self.member(n + 1)
+        return {'value': {
+            'id': n,
+            'name': 'Constituency {n}'.format(n=n),
+            'startDate': '2010-05-06T00:00:00',
+            'endDate': None if n < 650 else '2010-05-06T00:00:00',
+            'currentRepresentation': {'member': member, 'representation': {'membershipFrom': 'Constituency {n}'.format(n=n), 'membershipFromId': n}} if n < 650 and member is not None else None,
+            }, 'links': []}
+
+    def question(self, day, k):
+        i = (day - FIRST_DAY).days * self.questions_per_day + k + 1
+        answered = day + timedelta(days=7)
+        answered = answered if answered <= self.today else None
+        body_id, body_name, addressee = DEPARTMENTS[i % len(DEPARTMENTS)]
+        rng = random.Random(i)
+        text = 'To ask the Secretary of State for {a}, {w}{e}'.format(a=addressee, w=' '.join(rng.choice(WORDS) for _ in range(rng.randint(15, 60))),
+                                                                   e=rng.choice(['?', ', with reference to the answer of 5 May 2022 to Question 1234?', ',and when.']))
+        return {
+            'id': i, 'askingMemberId': i % self.max_member_id + 1, 'askingMember': None, 'house': 'Commons' if i % 3 else 'Lords', 'memberHasInterest': False,
+            'dateTabled': day.isoformat() + 'T00:00:00', 'dateForAnswer': (day + timedelta(days=7)).isoformat() + 'T00:00:00', 'uin': str(i), 'questionText': text,
+            'answeringBodyId': body_id, 'answeringBodyName': body_name, 'isWithdrawn': False, 'isNamedDay': False, 'groupedQuestions': [],
+            'answerIsHolding': None if answered is None else False, 'answerIsCorrection': False, 'answeringMemberId': None if answered is None else i % 500 + 1, 'answeringMember': None,
+            'correctingMemberId': None, 'correctingMember': None, 'dateAnswered': None if answered is None else answered.isoformat() + 'T00:00:00',
+            'answerText': None if answered is None else '<p>Answer to question {i}.</p>'.format(i=i), 'originalAnswerText': None, 'comparableAnswerText': None,
+            'dateAnswerCorrected': None, 'dateHoldingAnswer': None, 'attachmentCount': 0, 'heading': HEADINGS[i % len(HEADINGS)], 'attachments': [], 'groupedQuestionsDates': [],
+            }
+
+    def questions(self, params):
+        # Answers come a week after tabling, so a range of answer dates is the same range of tabling dates a week earlier
+        if 'answeredWhenFrom' in params:
+            shift = timedelta(days=7)
+            first, last = date.fromisoformat(params['answeredWhenFrom'][:10]) - shift, date.fromisoformat(params['answeredWhenTo'][:10]) - shift
+        else:
+            first, last = date.fromisoformat(params['tabledWhenFrom'][:10]), date.fromisoformat(params['tabledWhenTo'][:10])
+        first, last = max(first, FIRST_DAY), min(last, self.today)
+        # Questions tabled in the last week are still unanswered
+        answered = params.get('answered', 'Any')
+        if answered == 'Answered' or 'answeredWhenFrom' in params:
+            last = min(last, self.today - timedelta(days=7))
+        elif answered == 'Unanswered':
+            first = max(first, self.today - timedelta(days=6))
+        skip, take = int(params.get('skip', 0)), int(params.get('take', 20))
+        days = max((last - first).days + 1, 0)
+        total = days * self.questions_per_day
+        results = []
+        for position in range(skip, min(skip + take, total)):
+            day, k = divmod(position, self.questions_per_day)
+            results.append({'value': self.question(first + timedelta(days=day), k), 'links': []})
+        return {'totalResults': total, 'results': results}
@@ -0,0 +1,280 @@
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+import pandas as pd
+import requests
+from tqdm import tqdm
+
+from http_client import make_session, RateLimiter
+import metrics
+
+
+def fetch_id(session, limiter, url_template, id_number, headers=None):
+    """
+    Request a single id from the API. Runs inside a worker thread.
+    :return: a tuple of (id_number, status code, decoded json or None, response headers or None). The status code is None if the request could not be made at all.
+    """
+    url = url_template.format(id=id_number)
+    limiter.wait(url)
+    try:
+        response = session.get(url, headers=headers)
+    except requests.RequestException:
+        return id_number, None, None, None
+    if response.status_code == 200:
+        with metrics.timer('json_decode'):
+            data = response.json()
+        return id_number, 200, data, response.headers
+    return id_number, response.status_code, None, response.headers
+
+
+def sweep_ids(url_template, ids, on_hit, max_workers=16, rate_limit=20, stop_after_misses=None, highest_known_id=None, session=None, conditional_headers=None, on_not_modified=None, checkpoint=None):
+    """
+    Poll an API endpoint with every id in `ids`, using a bounded pool of worker threads sharing one keep-alive session.
+
+    Successful responses are passed to `on_hit(id_number, data, headers)` in the calling thread, so the callback does not need to be thread-safe. Callbacks are made in order of completion, not in id order.
+
+    :param url_template: str, the endpoint with an {id} placeholder, e.g. 'https://members-api.parliament.uk/api/Members/{id}'
+    :param ids: a sorted list of ints to try.
+    :param on_hit: a function called with (id_number, data, response headers) for each 200 response.
+    :param max_workers: int, default 16. The number of requests in flight at once.
+    :param rate_limit: float, default 20. The maximum requests per second sent to the API host. None switches rate limiting off.
+    :param stop_after_misses: int, default None. If set, the sweep exits early once this many consecutive ids (in id order) above the highest known id have returned 404.
+    :param highest_known_id: int, default None. Misses at or below this id do not count towards `stop_after_misses`. If None, the run of misses counts from the last hit.
+    :param session: a requests.Session, default None. If None, a pooled session with retries is created for the sweep.
+    :param conditional_headers: a function, default None. Called with an id, it returns extra request headers (e.g. If-None-Match) for that id.
+    :param on_not_modified: a function, default None. Called with the id for each 304 Not Modified response. Without it, 304s are still counted as unchanged rather than failed, e.g. when a checkpoint from a refresh is replayed.
+    :param checkpoint: a checkpoint.Checkpoint, default None. If given, every id which returns 200, 304 or 404 is recorded in it, and ids it already holds are not requested again: their recorded responses are replayed to the callbacks instead.
+    :return: a dict with the number of 'hits', 'not_modified' and 'misses', the list of 'failed' ids (requests which errored or were still failing after retries), 'stopped_at', the id at which the sweep exited early (None if every id was tried), and the list of 'skipped' ids whose requests were cancelled when it did.
+    """
+    if session is None:
+        session = make_session(pool_size=max_workers)
+    limiter = RateLimiter(rate_limit)
+
+    summary = {'hits': 0, 'not_modified': 0, 'misses': 0, 'failed': [], 'stopped_at': None, 'skipped': []}
+    statuses = {}
+    # The position in `ids` up to which every request has completed. Consecutive misses are counted from here, so that early stopping doesn't depend on the order in which the threads finish.
+    frontier = 0
+    miss_run = 0
+
+    pending = set()
+    submitted = 0
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor, tqdm(total=len(ids)) as progress:
+
+        def handle(id_number, status, data, headers, replayed=False):
+            if stop_after_misses is not None:
+                statuses[id_number] = status
+            progress.update(1)
+            if status == 200:
+                summary['hits'] += 1
+                on_hit(id_number, data, headers)
+            elif status == 304:
+                summary['not_modified'] += 1
+                if on_not_modified is not None:
+                    on_not_modified(id_number)
+            elif status == 404:
+                summary['misses'] += 1
+            else:
+                summary['failed'].append(id_number)
+            if checkpoint is not None and not replayed and status in (200, 304, 404):
+                kept = {k: headers[k] for k in ('ETag', 'Last-Modified') if k in headers} if headers else None
+                checkpoint.record(id_number, [status, data, kept])
+
+        while True:
+            # Keep the pool busy, but don't queue up more work than we can cancel cheaply when stopping early.
+            # When stopping early, also don't run too far ahead of the frontier while a slow id is being retried.
+            while submitted < len(ids) and len(pending) < max_workers * 2:
+                if stop_after_misses is not None and submitted - frontier >= max_workers * 4:
+                    break
+                id_number = ids[submitted]
+                submitted += 1
+                if checkpoint is not None and id_number in checkpoint:
+                    handle(id_number, *checkpoint.result(id_number), replayed=True)
+                    continue
+                headers = conditional_headers(id_number) if conditional_headers else None
+                future = executor.submit(fetch_id, session, limiter, url_template, id_number, headers)
+                future.id_number = id_number
+                pending.add(future)
+
+            if pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    handle(*future.result())
+
+            if stop_after_misses is not None:
+                # Advance the frontier over every id that has now completed, keeping count of the current run of misses
+                while frontier < len(ids) and ids[frontier] in statuses:
+                    id_number = ids[frontier]
+                    status = statuses.pop(id_number)
+                    if status == 404:
+                        if highest_known_id is None or id_number > highest_known_id:
+                            miss_run += 1
+                    else:
+                        miss_run = 0
+                    frontier += 1
+                    if miss_run >= stop_after_misses:
+                        break
+
+                if miss_run >= stop_after_misses:
+                    summary['stopped_at'] = ids[frontier - 1]
+                    for future in pending:
+                        future.cancel()
+                    # Results which were already in flight are still collected and counted, so that no hit is thrown away, and every request is accounted for
+                    for future in pending:
+                        if future.cancelled():
+                            summary['skipped'].append(future.id_number)
+                        else:
+                            handle(*future.result())
+                    break
+
+            if not pending and submitted >= len(ids):
+                break
+
+    if summary['failed']:
+        print('{n} ids could not be fetched, even after retrying: {ids}'.format(n=len(summary['failed']), ids=sorted(summary['failed'])))
+    if summary['stopped_at'] is not None:
+        print('Stopped early at id {i} after {n} consecutive missing ids.'.format(i=summary['stopped_at'], n=stop_after_misses))
+
+    return summary
+
+
+def refresh_ids(url_template, id_range, index, on_hit, full_sweep=False, stop_after_misses=None, probe_misses=200, max_workers=16, rate_limit=20, checkpoint=None):
+    """
+    Bring an IdIndex up to date with the API, and pass the latest payload for every known id to `on_hit(id_number, data)`.
+    Freshly downloaded payloads are passed on as they arrive; the cached payloads of unchanged ids are passed on once the refresh is finished.
+
+    If the index is empty, or full_sweep is True, every id in `id_range` is swept. Otherwise only the ids already in the index are re-fetched, using conditional requests where the API supports them,
+    and new ids are probed only above the current maximum, stopping after `probe_misses` consecutive 404s.
+    Known ids which now return 404 are dropped from the index. The index is saved when the refresh finishes.
+
+    :param url_template: str, the endpoint with an {id} placeholder.
+    :param id_range: a range of ids to try on a full sweep.
+    :param index: an id_index.IdIndex
+    :param on_hit: a function called with (id_number, data) for every id in the refreshed index. data is shaped like the API's response, i.e. {'value': ...}.
+    :param full_sweep: bool, default False. If True, sweep every id in id_range even if the index already has entries.
+    :param stop_after_misses: int, default None. Passed to sweep_ids on a full sweep.
+    :param probe_misses: int, default 200. How many consecutive missing ids above the highest known id to try before assuming there are no new ids.
+    :param checkpoint: a checkpoint.Checkpoint, default None. Passed to sweep_ids, so that an interrupted refresh can be resumed without fetching the same ids again.
+    :return: a dict with the number of 'fetched', 'not_modified', 'new', 'changed' and 'removed' ids.
+    """
+    counts = {'fetched': 0, 'not_modified': 0, 'new': 0, 'changed': 0, 'removed': 0}
+    seen = set()
+    fetched = set()
+    unchecked = set()
+    known = set(index.known_ids())
+
+    def record_hit(id_number, data, headers):
+        seen.add(id_number)
+        fetched.add(id_number)
+        counts['fetched'] += 1
+        if index.update(id_number, data['value'], headers):
+            counts['new' if id_number not in known else 'changed'] += 1
+        on_hit(id_number, data)
+
+    def record_not_modified(id_number):
+        seen.add(id_number)
+        counts['not_modified'] += 1
+        # A 304 can only be for a known id, unless it was replayed from the checkpoint of an older index
+        if id_number in known:
+            index.touch(id_number)
+
+    if full_sweep or len(index) == 0:
+        print('Sweeping every id from {a} to {b}...'.format(a=id_range.start, b=id_range.stop - 1))
+        summary = sweep_ids(url_template, list(id_range), record_hit, max_workers=max_workers, rate_limit=rate_limit, stop_after_misses=stop_after_misses, on_not_modified=record_not_modified, checkpoint=checkpoint)
+        unchecked.update(summary['failed'])
+        unchecked.update(summary['skipped'])
+        if summary['stopped_at'] is not None:
+            unchecked.update(x for x in known if x > summary['stopped_at'])
+    else:
+        print('Refreshing {n} known ids...'.format(n=len(index)))
+        summary = sweep_ids(url_template, index.known_ids(), record_hit, max_workers=max_workers, rate_limit=rate_limit, conditional_headers=index.conditional_headers, on_not_modified=record_not_modified, checkpoint=checkpoint)
+        unchecked.update(summary['failed'])
+
+        highest = index.max_id()
+        print('Looking for new ids above {h}...'.format(h=highest))
+        probe = list(range(highest + 1, max(id_range.stop, highest + probe_misses + 1)))
+        summary = sweep_ids(url_template, probe, record_hit, max_workers=max_workers, rate_limit=rate_limit, stop_after_misses=probe_misses, highest_known_id=highest, checkpoint=checkpoint)
+        unchecked.update(summary['failed'])
+        unchecked.update(summary['skipped'])
+
+    # Ids which failed or weren't reached this time are kept as they were, but known ids which have gone missing are dropped
+    for id_number in known - seen - unchecked:
+        index.remove(id_number)
+        counts['removed'] += 1
+    index.save()
+
+    for id_number in index.known_ids():
+        if id_number not in fetched:
+            on_hit(id_number, {'value': index.value(id_number)})
+
+    print('{new} new, {changed} changed, {removed} removed and {nm} unchanged ids.'.format(new=counts['new'], changed=counts['changed'], removed=counts['removed'], nm=counts['not_modified'] + counts['fetched'] - counts['new'] - counts['changed']))
+    return counts
+
+
+class ResponseCollector:
+    """
+    Collects the payloads returned by a sweep in memory, sorted into buckets (e.g. 'active' and 'former'), ready to be fed to pd.json_normalize in one go.
+
+    If a spill_path is given, every record is also appended to a single JSONL file as it arrives, so that the payloads survive a crash part way through a sweep. Use ResponseCollector.recover to reload them.
+    """
+
+    def __init__(self, spill_path=None):
+        self.spill_path = spill_path
+        self.records = {}
+        self._spill = open(spill_path, 'a') if spill_path else None
+
+    def add(self, bucket, id_number, value):
+        """
+        Add a single payload to a bucket.
+        """
+        self.records.setdefault(bucket, {})[id_number] = value
+        if self._spill is not None:
+            self._spill.write(json.dumps({'bucket': bucket, 'id': id_number, 'value': value}) + '\n')
+            self._spill.flush()
+
+    def frame(self, bucket):
+        """
+        :return: a DataFrame of every payload in the bucket, flattened with pd.json_normalize, in id order.
+        """
+        records = self.records.get(bucket, {})
+        with metrics.timer('json_normalize'):
+            return pd.json_normalize([records[k] for k in sorted(records)])
+
+    def close(self, remove_spill=True):
+        """
+        Close the spill file. Once a sweep has been turned into DataFrames successfully, it is no longer needed, so it is removed by default.
+        """
+        if self._spill is not None:
+            self._spill.close()
+            self._spill = None
+            if remove_spill:
+                os.remove(self.spill_path)
+
+    @classmethod
+    def recover(cls, spill_path):
+        """
+        Rebuild a collector from the spill file left behind by an interrupted sweep. New records continue to be appended to the same file.
+        :return: a ResponseCollector
+        """
+        collector = cls()
+        if os.path.exists(spill_path):
+            with open(spill_path) as infile:
+                for line in infile:
+                    # The last line may have been cut off by the crash
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue
+                    collector.records.setdefault(record['bucket'], {})[record['id']] = record['value']
+            # Start on a fresh line, in case the last record was only partly written
+            with open(spill_path, 'rb') as infile:
+                infile.seek(0, os.SEEK_END)
+                if infile.tell() > 0:
+                    infile.seek(-1, os.SEEK_END)
+                    if infile.read(1) != b'\n':
+                        with open(spill_path, 'a') as outfile:
+                            outfile.write('\n')
+        collector.spill_path = spill_path
+        collector._spill = open(spill_path, 'a')
+        return collector
@@ -0,0 +1,78 @@
+"""
+Round trips through both archive backends, checking that a WPQ archive reads back with the same dtypes whichever backend it's in. Run with `python -m pytest`.
+"""
+import numpy as np
+import pandas as pd
+import pytest
+
+from storage import CsvStore, ParquetStore, WPQ_DTYPES, WPQ_DATE_COLUMNS, WPQ_CATEGORICAL_COLUMNS, coerce_dtypes
+
+
+def sample_wpqs(n=20):
+    """
+    :return: a DataFrame of n rows with every column of WPQ_DTYPES and WPQ_DATE_COLUMNS, including missing values where the API has them.
+    """
+    ids = np.arange(1, n + 1)
+    df = pd.DataFrame({column: ['text {i}'.format(i=i) for i in ids] for column, dtype in WPQ_DTYPES.items() if dtype == 'string'})
+    for column, dtype in WPQ_DTYPES.items():
+        if dtype in ('Int64', 'int64'):
+            df[column] = ids * 1000
+        elif dtype == 'boolean':
+            df[column] = ids % 2 == 0
+    df['uin'] = [str(100000 + i) for i in ids]
+    df['year_month'] = ['2022-0{m}'.format(m=i % 3 + 1) for i in ids]
+    df['house'] = ['Commons' if i % 3 else 'Lords' for i in ids]
+    # Some of the columns which the API often leaves empty
+    df['answeringMemberId'] = [None if i % 4 == 0 else i for i in ids]
+    df['answerIsHolding'] = [None if i % 5 == 0 else i % 2 == 0 for i in ids]
+    df['answerText'] = [None if i % 4 == 0 else 'answer {i}'.format(i=i) for i in ids]
+    for column in WPQ_DATE_COLUMNS:
+        df[column] = pd.date_range('2022-01-01', periods=n, freq='3D')
+    df['dateHoldingAnswer'] = pd.NaT
+    return coerce_dtypes(df)
+
+
+@pytest.fixture(params=['csv', 'parquet'])
+def store(request, tmp_path):
+    if request.param == 'csv':
+        store = CsvStore(tmp_path / 'pqs.csv', 'dateTabled')
+    else:
+        store = ParquetStore(tmp_path / 'pqs', 'dateTabled')
+    store.write(sample_wpqs())
+    return store
+
+
+def test_read_applies_every_dtype(store):
+    df = store.read()
+    for column, dtype in WPQ_DTYPES.items():
+        assert str(df[column].dtype) == dtype, column
+    for column in WPQ_DATE_COLUMNS:
+        assert str(df[column].dtype) == 'datetime64[ns]', column
+    assert df['uin'].tolist() == sample_wpqs()['uin'].tolist()
+
+
+def test_compact_read_dtypes(store):
+    df = store.read(compact=True)
+    for column, dtype in WPQ_DTYPES.items():
+        if column in WPQ_CATEGORICAL_COLUMNS:
+            assert isinstance(df[column].dtype, pd.CategoricalDtype), column
+        elif dtype == 'string':
+            assert str(df[column].dtype) == 'string', column
+        elif dtype == 'boolean':
+            assert str(df[column].dtype) in ('bool', 'boolean'), column
+        else:
+            assert pd.api.types.is_integer_dtype(df[column].dtype), column
+    assert isinstance(df['year_month'].cat.categories, pd.PeriodIndex)
+    assert df['uin'].tolist() == sample_wpqs()['uin'].tolist()
+
+
+@pytest.mark.parametrize('compact', [False, True])
+def test_backends_agree(tmp_path, compact):
+    csv_store = CsvStore(tmp_path / 'pqs.csv', 'dateTabled')
+    parquet_store = ParquetStore(tmp_path / 'pqs', 'dateTabled')
+    for store in (csv_store, parquet_store):
+        store.write(sample_wpqs())
+    csv_df = csv_store.read(compact=compact)
+    parquet_df = parquet_store.read(compact=compact)
+    assert csv_df.columns.tolist() == parquet_df.columns.tolist()
+    assert csv_df.dtypes.astype(str).to_dict() == parquet_df.dtypes.astype(str).to_dict()
@@ -0,0 +1,99 @@
+"""
+Checks that clean_questions gives the same output as question_cleaner did before it was rewritten around QUESTION_REPLACEMENTS. Run with `python -m pytest`.
+"""
+import re
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from wpqs import clean_questions, RECORD_SEPARATOR
+
+
+# A frozen copy of question_cleaner as it was before the rewrite rules were moved into QUESTION_REPLACEMENTS, which the batched cleaner has to match. Don't change it to keep up with wpqs.
+def baseline_question_cleaner(question):
+    q = re.sub(r',(?=\S)|:', ', ', question)
+    q = q.replace("to ask her majesty's government ", "to ask her majesty's government, ").replace("to ask her majesty’s government ", "to ask her majesty's government, ")
+    q = q.replace(', and', ' and').replace('foreign, commonwealth and development affairs', 'foreign commonwealth and development affairs').replace('digital, culture, media', 'digital culture media').replace('business, energy and industrial', 'business energy and industrial')
+    q = q.replace('levelling up, housing and', 'levelling up housing and').replace('environment, food and rural affairs', 'environment food and rural affairs').replace('culture, media and sport', 'culture media and sport').replace('business, innovation and skills', 'business innovation and skills')
+    q = q.replace('digital, culture, media and sport', 'digital culture media and sport')
+    q = q.replace('housing, communities and local government', 'housing communities and local government')
+    q = q.replace(', representing the church commissioners', ' representing the church commissioners, ')
+    q = q.replace('to ask the chairman of committees ', 'to ask the chairman of committees, ')
+    q = q.replace('to ask the leader of the house ', 'to ask the leader of the house, ')
+    q = q.replace("to ask her majesty’s government", "to ask her majesty's government, ")
+    q = q.replace("to ask the senior deputy speaker ", "to ask the senior deputy speaker, ")
+    q = q.replace("her majesty's government ", "her majesty's government, ")
+    q = q.replace("to ask the secretary of state for education ", "to ask the secretary of state for education, ")
+    q = q.replace("to ask the secretary of state for defence ", "to ask the secretary of state for defence, ")
+    q = q.replace("to ask the secretary of state for work and pensions ", "to ask the secretary of state for work and pensions, ")
+    q = q.replace("to ask the secretary of state for environment food and rural affairs ", "to ask the secretary of state for environment food and rural affairs, ")
+    q = q.replace("to ask the secretary of state for health ", "to ask the secretary of state for health, ")
+    q = q.replace("foreign and commonwealth affairs ", "foreign and commonwealth affairs, ")
+    q = q.replace("foreign commonwealth and development affairs ", "foreign commonwealth and development affairs, ")
+    q = q.replace("the senior deputy speaker ", "the senior deputy speaker, ")
+    q = q.replace("secretary of state for the home department,", "secretary of state for the home department, ")
+    q = q.replace("to ask mr chancellor of the exchequer ", "to ask mr chancellor of the exchequer, ")
+    q = q.replace("to ask the minister of the cabinet office ", "to ask the minister of the cabinet office, ")
+    q = q.replace("to ask the minister for the cabinet office ", "to ask the minister for the cabinet office, ")
+    q = q.replace("to ask the secretary of state for communities and local government ", "to ask the secretary of state for communities and local government, ")
+    q = ' '.join(q.split(', ')[1:])
+    cleaned_question = q
+    return cleaned_question
+
+
+EDGE_CASES = [
+    "to ask her majesty's government what plans they have for the roads?",
+    "to ask her majesty’s government what assessment they have made of café prices?",
+    "to ask her majesty’s governmentwhether they will publish the report?",
+    'to ask the secretary of state for environment, food and rural affairs what steps she is taking on flooding, and when?',
+    'to ask the secretary of state for digital, culture, media and sport, what plans she has for the bbc?',
+    'to ask the secretary of state for foreign, commonwealth and development affairs whether he has met his counterpart in zürich?',
+    'to ask the lord privy seal, representing the church commissioners what the budget is?',
+    'to ask the secretary of state for the home department,what steps she is taking on policing?',
+    'to ask the secretary of state for transport: what the budget is for roads,',
+    'to ask the secretary of state for transport, what the budget is for roads:',
+    'to ask the secretary of state for transport, what the budget is for roads, ',
+    'to ask the secretary of state for health, what the waiting times are in łódź and 東京?',
+    'to ask the secretary of state for health, what the waiting times are,and why?',
+    'to ask the secretary of state for transport, ',
+    'to ask the secretary of state for transport,',
+    ':',
+    ',',
+    ', ',
+    'no preamble at all',
+    '',
+    'to ask the secretary of state for transport, what{s}the budget is?'.format(s=RECORD_SEPARATOR),
+    'to ask the secretary of state for transport,{s}what the budget is?'.format(s=RECORD_SEPARATOR),
+    RECORD_SEPARATOR,
+    ]
+
+
+def test_edge_cases_match_baseline():
+    expected = [baseline_question_cleaner(q) for q in EDGE_CASES]
+    assert clean_questions(EDGE_CASES).tolist() == expected
+
+
+@pytest.mark.parametrize('question', EDGE_CASES)
+def test_each_edge_case_on_its_own_matches_baseline(question):
+    # Each question alone, and between two ordinary questions, so that it's cleaned both at the edges of a chunk and in the middle of one
+    ordinary = 'to ask the secretary of state for education, what plans she has for schools?'
+    assert clean_questions([question]).tolist() == [baseline_question_cleaner(question)]
+    assert clean_questions([ordinary, question, ordinary]).tolist() == [baseline_question_cleaner(q) for q in [ordinary, question, ordinary]]
+
+
+def test_missing_questions_stay_missing():
+    questions = pd.Series(['to ask the secretary of state for transport, what the budget is?', np.nan, None, ''], index=[10, 11, 12, 13])
+    cleaned = clean_questions(questions)
+    assert cleaned.index.tolist() == [10, 11, 12, 13]
+    assert cleaned[10] == baseline_question_cleaner(questions[10])
+    assert cleaned[[11, 12]].isna().all()
+    assert cleaned[13] == ''
+
+
+def test_synthetic_corpus_matches_baseline():
+    from benchmarks import synthetic_questions
+    questions = synthetic_questions(5000) + EDGE_CASES
+    # A small chunk size, so that the edge cases land on chunk boundaries as well as inside chunks
+    for chunk_size in [1, 7, 1000]:
+        assert clean_questions(questions, chunk_size=chunk_size).tolist() == [baseline_question_cleaner(q) for q in questions]
@@ -0,0 +1,181 @@
+import json
+import sqlite3
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+from tqdm import tqdm
+
+from preprocessing import TokenCache, build_corpus, text_hash, token_cache_path, update_tokens
+
+try:
+    from gensim.models import LdaMulticore
+except ImportError:
+    LdaMulticore = None
+
+
+class TopicModel:
+    """
+    A persistent LDA topic model of a cleaned WPQ archive, and the topic distribution of every question in it.
+
+    The model is only trained from scratch when train() is called. After that, update() folds each day's new questions into the saved model with an online update, and works out their topic distributions in one batch, which takes seconds rather than a full retrain.
+    The model's vocabulary is fixed when it is trained: words which first turn up in later questions are ignored until the next full retrain.
+
+    The model is saved in {name}_lda/ in the tmp folder, and the topic distributions in {name}_topics.sqlite, one row per question with a column per topic.
+    """
+
+    def __init__(self, tmp, name='pqs_cleaned', backend='csv', stem=None, extra_stop_words=None):
+        """
+        :param tmp: str, the tmp folder.
+        :param name: str, default 'pqs_cleaned'. Which cleaned archive to model: 'pqs_cleaned' or 'ua_pqs_cleaned'.
+        :param backend: str, default 'csv'. The cleaned archive's backend, 'csv' or 'parquet'.
+        :param stem: bool, default None. Model lemmatised and stemmed tokens. See preprocessing.tokenise. None uses the setting the saved model was trained with, or False if there isn't one.
+        :param extra_stop_words: list, default None. Words to drop on top of preprocessing.stop_words(stem=stem). None likewise uses the saved model's.
+        """
+        if LdaMulticore is None:
+            raise ImportError('The topic model needs gensim. Install it with `pip install gensim`.')
+        self.tmp = tmp
+        self.name = name
+        self.backend = backend
+        self.model_path = Path(tmp) / '{n}_lda'.format(n=name) / 'lda.model'
+        # The tokens of new questions have to be made the same way as those the model was trained on
+        self.settings_path = self.model_path.parent / 'settings.json'
+        saved = {}
+        if self.settings_path.is_file():
+            with open(self.settings_path) as infile:
+                saved = json.load(infile)
+        self.stem = stem if stem is not None else saved.get('stem', False)
+        self.extra_stop_words = extra_stop_words if extra_stop_words is not None else saved.get('extra_stop_words')
+        self.model = LdaMulticore.load(str(self.model_path)) if self.model_path.is_file() else None
+        self.db = sqlite3.connect(str(Path(tmp) / '{n}_topics.sqlite'.format(n=name)))
+
+    @property
+    def num_topics(self):
+        return self.model.num_topics if self.model is not None else None
+
+    def _columns(self):
+        return ['topic_{t}'.format(t=t) for t in range(self.num_topics)]
+
+    def _reset_table(self):
+        with self.db:
+            self.db.execute('DROP TABLE IF EXISTS doc_topics')
+            self.db.execute('CREATE TABLE doc_topics (id INTEGER PRIMARY KEY, hash TEXT, {c})'.format(c=', '.join('{t} REAL'.format(t=t) for t in self._columns())))
+
+    def _assign(self, ids, hashes, bows):
+        """
+        Work out the topic distributions of a batch of questions in one pass, and store them.
+        """
+        gamma, _ = self.model.inference(bows)
+        theta = gamma / gamma.sum(axis=1, keepdims=True)
+        with self.db:
+            self.db.executemany('INSERT OR REPLACE INTO doc_topics VALUES ({p})'.format(p=', '.join('?' * (self.num_topics + 2))),
+                                ((int(i), h) + tuple(float(x) for x in row) for i, h, row in zip(ids, hashes, theta)))
+
+    def _save(self):
+        self.model_path.parent.mkdir(parents=True, exist_ok=True)
+        self.model.save(str(self.model_path))
+        with open(self.settings_path, 'w') as outfile:
+            json.dump({'stem': self.stem, 'extra_stop_words': self.extra_stop_words}, outfile)
+
+    def train(self, num_topics=20, passes=1, workers=None, no_below=1, no_above=1.0, processes=None, chunk_size=10000, **kwargs):
+        """
+        Train the model from scratch over the whole archive (as the topic modelling notebook did), save it, and work out the topic distribution of every question.
+        :param num_topics: int, default 20.
+        :param passes: int, default 1. Passes over the corpus while training.
+        :param workers: int, default None. LdaMulticore's worker processes. None uses one fewer than the number of CPUs.
+        :param no_below: int, default 1. Leave words which appear in fewer questions than this out of the model's vocabulary.
+        :param no_above: float, default 1.0. Leave words which appear in more than this fraction of questions out of the model's vocabulary.
+        :param processes: int, default None. Processes used to tokenise new questions. See preprocessing.update_tokens.
+        :param chunk_size: int, default 10000. The number of questions whose topics are worked out at a time.
+        :param kwargs: passed on to gensim's LdaMulticore, e.g. random_state.
+        """
+        ids, id2word, corpus = build_corpus(self.tmp, self.name, self.backend, stem=self.stem, no_below=no_below, no_above=no_above,
+                                            extra_stop_words=self.extra_stop_words, processes=processes)
+        print('Training a {k} topic model on {n} questions...'.format(k=num_topics, n=len(ids)))
+        self.model = LdaMulticore(corpus=corpus, id2word=id2word, num_topics=num_topics, passes=passes, workers=workers, **kwargs)
+        self._save()
+
+        self._reset_table()
+        cache = TokenCache(token_cache_path(self.tmp, self.name, self.stem), None)
+        hashes = cache.hashes()
+        cache.close()
+        batch = []
+        for i, bow in zip(tqdm(ids), corpus):
+            batch.append((i, bow))
+            if len(batch) == chunk_size:
+                self._assign([i for i, _ in batch], [hashes.get(i) for i, _ in batch], [b for _, b in batch])
+                batch = []
+        if len(batch) > 0:
+            self._assign([i for i, _ in batch], [hashes.get(i) for i, _ in batch], [b for _, b in batch])
+
+    def update(self, fold_in=True, processes=None, cleaned=None):
+        """
+        Bring the model up to date with the cleaned archive: tokenise the questions which are new (or have changed) since the last update, fold them into the model with an online update, and work out their topic distributions.
+        :param fold_in: bool, default True. If False, the new questions' topics are worked out but the model itself is left as it is.
+        :param processes: int, default None. Processes used to tokenise new questions. See preprocessing.update_tokens.
+        :param cleaned: a DataFrame, default None. The rows just cleaned, as returned by wpqs.update_cleaned_archive. If given, only these are looked at, rather than reading and hashing the whole cleaned archive, and questions which have left it keep their topics.
+        :return: a DataFrame of the new questions' topic distributions, indexed by id.
+        :raises RuntimeError: if the model hasn't been trained yet.
+        """
+        if self.model is None:
+            raise RuntimeError('There is no topic model in {p} yet. Run TopicModel.train first.'.format(p=self.model_path.parent))
+        cache, ids = update_tokens(self.tmp, self.name, self.backend, stem=self.stem, extra_stop_words=self.extra_stop_words, processes=processes, rows=cleaned)
+        if cleaned is None:
+            hashes = cache.hashes()
+            known = dict(self.db.execute('SELECT id, hash FROM doc_topics'))
+            gone = set(known) - set(hashes)
+        else:
+            hashes = dict(zip(ids, (text_hash(x) for x in cleaned['cleanedQuestion'])))
+            known = {}
+            for k in range(0, len(ids), 500):
+                batch = ids[k:k + 500]
+                known.update(self.db.execute('SELECT id, hash FROM doc_topics WHERE id IN ({p})'.format(p=', '.join('?' * len(batch))), batch))
+            gone = set()
+        new = sorted(i for i, h in hashes.items() if known.get(i) != h)
+        if len(gone) > 0:
+            with self.db:
+                self.db.executemany('DELETE FROM doc_topics WHERE id = ?', ((i,) for i in gone))
+
+        if len(new) > 0:
+            bows = [self.model.id2word.doc2bow(tokens) for tokens in cache.tokens(new)]
+            if fold_in:
+                # Questions with no words in the model's vocabulary have nothing to teach it
+                self.model.update([bow for bow in bows if len(bow) > 0])
+                self._save()
+            self._assign(new, [hashes[i] for i in new], bows)
+        cache.close()
+        print('Assigned topics to {n} new or changed questions{f}.'.format(n=len(new), f=' and folded them into the model' if fold_in and len(new) > 0 else ''))
+        return self.distributions(new)
+
+    def distributions(self, ids=None):
+        """
+        :param ids: list, default None. Only these WPQ ids. If None, every question.
+        :return: a DataFrame of topic distributions, indexed by id, with a column per topic (topic_0, topic_1...).
+        """
+        if ids is None:
+            df = pd.read_sql_query('SELECT * FROM doc_topics ORDER BY id', self.db)
+        else:
+            ids = [int(i) for i in ids]
+            # SQLite limits the number of parameters in a query
+            chunks = [pd.read_sql_query('SELECT * FROM doc_topics WHERE id IN ({p})'.format(p=', '.join('?' * len(ids[k:k + 500]))), self.db, params=ids[k:k + 500])
+                      for k in range(0, len(ids), 500)]
+            df = pd.concat(chunks) if len(chunks) > 0 else pd.read_sql_query('SELECT * FROM doc_topics LIMIT 0', self.db)
+        return df.drop(columns='hash').astype({'id': 'int64'}).set_index('id')
+
+    def dominant_topics(self, ids=None):
+        """
+        :return: a DataFrame indexed by id, with each question's most likely topic (an int) and its probability.
+        """
+        df = self.distributions(ids)
+        values = df.to_numpy()
+        best = values.argmax(axis=1) if len(df) > 0 else np.array([], dtype=int)
+        return pd.DataFrame({'topic': best, 'probability': values[np.arange(len(df)), best]}, index=df.index)
+
+    def describe(self, num_words=10):
+        """
+        :return: a DataFrame with the top words of each topic, as lda_model.print_topics() showed in the notebook.
+        """
+        return pd.DataFrame([{'topic': t, 'words': ', '.join(word for word, _ in self.model.show_topic(t, topn=num_words))} for t in range(self.num_topics)]).set_index('topic')
+
+    def close(self):
+        self.db.close()
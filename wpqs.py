@@ -7,89 +7,446 @@ from dateutil.relativedelta import relativedelta
 from pathlib import Path
 from tqdm import tqdm
 import re
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from storage import open_store, WPQ_TEXT_COLUMNS
+from http_client import get_session
+from members import get_member_table
+from checkpoint import Checkpoint
+from search import open_search_index
+from rollups import open_rollups
+import metrics
 tqdm.pandas()
 
+# The rewrite rules used to clean up question text, in the order they're applied. 
+# Most of them put a comma after the preamble ("to ask the secretary of state for ...") or take the commas out of department names, so that splitting on ', ' separates the preamble from the question itself.
+# The order matters: some rules only match the output of earlier ones (e.g. 'environment, food and rural affairs' has to lose its commas before the secretary of state for it gets one).
+QUESTION_REPLACEMENTS = [
+    ("to ask her majesty's government ", "to ask her majesty's government, "),
+    ("to ask her majesty’s government ", "to ask her majesty's government, "),
+    (', and', ' and'),
+    ('foreign, commonwealth and development affairs', 'foreign commonwealth and development affairs'),
+    ('digital, culture, media', 'digital culture media'),
+    ('business, energy and industrial', 'business energy and industrial'),
+    ('levelling up, housing and', 'levelling up housing and'),
+    ('environment, food and rural affairs', 'environment food and rural affairs'),
+    ('culture, media and sport', 'culture media and sport'),
+    ('business, innovation and skills', 'business innovation and skills'),
+    ('digital, culture, media and sport', 'digital culture media and sport'),
+    ('housing, communities and local government', 'housing communities and local government'),
+    (', representing the church commissioners', ' representing the church commissioners, '),
+    ('to ask the chairman of committees ', 'to ask the chairman of committees, '),
+    ('to ask the leader of the house ', 'to ask the leader of the house, '),
+    ("to ask her majesty’s government", "to ask her majesty's government, "),
+    ("to ask the senior deputy speaker ", "to ask the senior deputy speaker, "),
+    ("her majesty's government ", "her majesty's government, "),
+    ("to ask the secretary of state for education ", "to ask the secretary of state for education, "),
+    ("to ask the secretary of state for defence ", "to ask the secretary of state for defence, "),
+    ("to ask the secretary of state for work and pensions ", "to ask the secretary of state for work and pensions, "),
+    ("to ask the secretary of state for environment food and rural affairs ", "to ask the secretary of state for environment food and rural affairs, "),
+    ("to ask the secretary of state for health ", "to ask the secretary of state for health, "),
+    ("foreign and commonwealth affairs ", "foreign and commonwealth affairs, "),
+    ("foreign commonwealth and development affairs ", "foreign commonwealth and development affairs, "),
+    ("the senior deputy speaker ", "the senior deputy speaker, "),
+    ("secretary of state for the home department,", "secretary of state for the home department, "),
+    ("to ask mr chancellor of the exchequer ", "to ask mr chancellor of the exchequer, "),
+    ("to ask the minister of the cabinet office ", "to ask the minister of the cabinet office, "),
+    ("to ask the minister for the cabinet office ", "to ask the minister for the cabinet office, "),
+    ("to ask the secretary of state for communities and local government ", "to ask the secretary of state for communities and local government, "),
+    ]
+
+# Commas followed by something other than whitespace, and colons, both become ', '
+PUNCTUATION_RE = re.compile(r',(?=\S)|:')
+COMMA_RE = re.compile(r',(?=\S)')
+
+# Used to join a batch of questions into one string. It counts as whitespace to PUNCTUATION_RE (like the end of a question does), and none of the rewrite rules contain it, so no match can run from one question into the next.
+RECORD_SEPARATOR = '\x1e'
+
+
 # A function to clean up question text
 def question_cleaner(question):
-    q = re.sub(r',(?=\S)|:', ', ', question)
-    q = q.replace("to ask her majesty's government ", "to ask her majesty's government, ").replace("to ask her majesty’s government ", "to ask her majesty's government, ")
-    q = q.replace(', and', ' and').replace('foreign, commonwealth and development affairs', 'foreign commonwealth and development affairs').replace('digital, culture, media', 'digital culture media').replace('business, energy and industrial', 'business energy and industrial')
-    q = q.replace('levelling up, housing and', 'levelling up housing and').replace('environment, food and rural affairs', 'environment food and rural affairs').replace('culture, media and sport', 'culture media and sport').replace('business, innovation and skills', 'business innovation and skills')
-    q = q.replace('digital, culture, media and sport', 'digital culture media and sport')
-    q = q.replace('housing, communities and local government', 'housing communities and local government')
-    q = q.replace(', representing the church commissioners', ' representing the church commissioners, ') 
-    q = q.replace('to ask the chairman of committees ', 'to ask the chairman of committees, ')
-    q = q.replace('to ask the leader of the house ', 'to ask the leader of the house, ')
-    q = q.replace("to ask her majesty’s government", "to ask her majesty's government, ")
-    q = q.replace("to ask the senior deputy speaker ", "to ask the senior deputy speaker, ")
-    q = q.replace("her majesty's government ", "her majesty's government, ")
-    q = q.replace("to ask the secretary of state for education ", "to ask the secretary of state for education, ")
-    q = q.replace("to ask the secretary of state for defence ", "to ask the secretary of state for defence, ")
-    q = q.replace("to ask the secretary of state for work and pensions ", "to ask the secretary of state for work and pensions, ")
-    q = q.replace("to ask the secretary of state for environment food and rural affairs ", "to ask the secretary of state for environment food and rural affairs, ")
-    q = q.replace("to ask the secretary of state for health ", "to ask the secretary of state for health, ")
-    q = q.replace("foreign and commonwealth affairs ", "foreign and commonwealth affairs, ")
-    q = q.replace("foreign commonwealth and development affairs ", "foreign commonwealth and development affairs, ")
-    q = q.replace("the senior deputy speaker ", "the senior deputy speaker, ")
-    q = q.replace("secretary of state for the home department,", "secretary of state for the home department, ")
-    q = q.replace("to ask mr chancellor of the exchequer ", "to ask mr chancellor of the exchequer, ")
-    q = q.replace("to ask the minister of the cabinet office ", "to ask the minister of the cabinet office, ")
-    q = q.replace("to ask the minister for the cabinet office ", "to ask the minister for the cabinet office, ")
-    q = q.replace("to ask the secretary of state for communities and local government ", "to ask the secretary of state for communities and local government, ")
+    q = PUNCTUATION_RE.sub(', ', question)
+    for old, new in QUESTION_REPLACEMENTS:
+        q = q.replace(old, new)
     q = ' '.join(q.split(', ')[1:])
     cleaned_question = q
     return cleaned_question
 
 
-# A function that will download WPQs for a given range of dates. (NB this will crash if the date range is too wide)
+def _clean_chunk(chunk):
+    """
+    Clean a list of questions by joining them into one string, running each rewrite rule over it once, and splitting it back up.
+    :return: a list of cleaned questions.
+    """
+    batch = RECORD_SEPARATOR.join(chunk)
+    if batch.count(RECORD_SEPARATOR) != len(chunk) - 1:
+        # A question contains the separator itself, so fall back to cleaning one at a time
+        return [question_cleaner(x) for x in chunk]
+
+    # Same as PUNCTUATION_RE, but quicker: colons become ', ' first, and the commas this adds are followed by a space, so the regex leaves them alone
+    batch = COMMA_RE.sub(', ', batch.replace(':', ', '))
+    for old, new in QUESTION_REPLACEMENTS:
+        batch = batch.replace(old, new)
+
+    # Drop everything up to the first ', ' (the preamble), and turn the remaining ', ' into spaces
+    cleaned = []
+    for q in batch.split(RECORD_SEPARATOR):
+        preamble, sep, rest = q.partition(', ')
+        cleaned.append(rest.replace(', ', ' ') if sep else '')
+    return cleaned
+
+
+def clean_questions(questions, chunk_size=1000):
+    """
+    Clean a whole batch of (lower case) question texts at once, giving exactly the same output as applying question_cleaner to each one.
+
+    Rather than running every rewrite rule on every question in turn, questions are joined into chunks of one long string, each rule runs once over the whole chunk, and the result is split back up.
+    Chunks are kept small enough to stay in the CPU cache, and plain ASCII questions are chunked separately from the rest, because a single curly quote would make Python store (and search) the whole chunk at two or four bytes per character.
+    :param questions: a pandas Series (or list) of question texts. Missing values stay missing.
+    :param chunk_size: int, default 1000. The number of questions joined together at a time.
+    :return: a pandas Series of cleaned questions, with the same index as the input.
+    """
+    questions = pd.Series(questions)
+    present = questions.notna()
+    texts = questions[present].tolist()
+    cleaned = pd.Series(np.nan, index=questions.index, dtype=object)
+    if len(texts) == 0:
+        return cleaned
+
+    results = [None] * len(texts)
+    ascii_positions = [i for i, x in enumerate(texts) if x.isascii()]
+    other_positions = [i for i, x in enumerate(texts) if not x.isascii()]
+    for positions in (ascii_positions, other_positions):
+        for i in range(0, len(positions), chunk_size):
+            chunk_positions = positions[i:i+chunk_size]
+            for position, q in zip(chunk_positions, _clean_chunk([texts[j] for j in chunk_positions])):
+                results[position] = q
+
+    cleaned[present] = results
+    return cleaned
+
+
+WPQ_URL = 'https://writtenquestions-api.parliament.uk/api/writtenquestions/questions'
+
+
+def iter_wpqs(params, date_from, date_to, date_param='tabledWhen', page_size=1000, max_page_seconds=30, max_page_bytes=20000000, max_window_results=20000):
+    """
+    Page through the WPQs in a date range, yielding them one at a time, so that memory use is bounded by the page size rather than the width of the date range.
+
+    The first page of a window says how many WPQs it holds. If a window of more than a day holds more than max_window_results, that page is thrown away, and the window is split into as many equal parts as it needs, each paged through separately. Otherwise paging carries on after the first page, so most windows (e.g. the single days of a daily update) cost no more requests than they have pages.
+    If a page is too slow or too large, it is kept, and the rest of the window is paged in smaller pages instead.
+
+    :param params: dict, any other query parameters, e.g. {'answered': 'Answered'}
+    :param date_from: str 'yyyy-mm-dd', the first day of the range.
+    :param date_to: str 'yyyy-mm-dd', the last day of the range.
+    :param date_param: str, default 'tabledWhen'. Which date the range applies to: 'tabledWhen' or 'answeredWhen'.
+    :param page_size: int, default 1000. The number of WPQs requested per page.
+    :param max_page_seconds: float, default 30. A page which takes longer than this to download counts as too slow.
+    :param max_page_bytes: int, default 20MB. A page bigger than this counts as too large.
+    :param max_window_results: int, default 20000. Windows of more than a day holding more WPQs than this are split up, as the API slows down when paging deep into a window.
+    :return: a generator of WPQs expressed in dictionaries.
+    """
+    session = get_session()
+
+    def fetch(skip, take):
+        page_params = dict(params)
+        page_params.update({date_param+'From': date_from, date_param+'To': date_to, 'skip': skip, 'take': take})
+        started = time.monotonic()
+        r = session.get(WPQ_URL, params=page_params)
+        r.raise_for_status()
+        too_big = time.monotonic() - started > max_page_seconds or len(r.content) > max_page_bytes
+        with metrics.timer('json_decode'):
+            return r.json(), too_big
+
+    data, too_big = fetch(0, page_size)
+    if too_big and page_size > 50:
+        page_size = page_size // 2
+    if data['totalResults'] > max_window_results and date_from < date_to:
+        # Nothing from this window has been yielded yet, so it's safe to split it up. A single day can't be split.
+        first = pd.to_datetime(date_from).normalize()
+        days = (pd.to_datetime(date_to).normalize() - first).days + 1
+        parts = min(days, -(-data['totalResults'] // max_window_results))
+        for i in range(parts):
+            start = first + relativedelta(days=days * i // parts)
+            end = first + relativedelta(days=days * (i + 1) // parts - 1)
+            yield from iter_wpqs(params, start.strftime('%Y-%m-%d'), end.strftime('%Y-%m-%d'), date_param, page_size, max_page_seconds, max_page_bytes, max_window_results)
+        return
+
+    skip = 0
+    while True:
+        for x in data['results']:
+            yield x['value']
+        skip += len(data['results'])
+        if len(data['results']) == 0 or skip >= data['totalResults']:
+            return
+        data, too_big = fetch(skip, page_size)
+        if too_big and page_size > 50:
+            page_size = page_size // 2
+
+
+# A function that will download WPQs for a given range of dates.
 def get_wpqs_by_answered(answeredWhenFrom, answeredWhenTo, answered=None):
     """
-    Download WPQs answered between a given range (recommended not to specify longer than 1 month). Dates should be in the format 'yyyy-mm-dd'.
-    :param: tabledWhenFrom str 'yyyy-mm-dd'
-    :param: tabledWhenTo str 'yyyy-mm-dd'
+    Download WPQs answered between a given range. Dates should be in the format 'yyyy-mm-dd'. The WPQs are downloaded a page at a time, so any range is safe, but for very wide ranges consider iterating over iter_wpqs instead of building a list.
+    :param: answeredWhenFrom str 'yyyy-mm-dd'
+    :param: answeredWhenTo str 'yyyy-mm-dd'
     :param: answered bool default None. If True, the function only downloads answered PQs. If False, only unanswered. If None, all are downloaded.  
     :return: a list of WQPs expressed in dictionaries. 
     """
-    url = 'https://writtenquestions-api.parliament.uk/api/writtenquestions/questions'
-    if answered:
-        params = {
-            # 'askingMemberId':  4663,
-            'answeredWhenFrom': answeredWhenFrom,
-            'answeredWhenTo': answeredWhenTo,
-            'take':1000000,
-            'answered': 'Answered'
-            }
-    elif not answered:
-        params = {
-            # 'askingMemberId':  4663,
-            'answeredWhenFrom': answeredWhenFrom,
-            'answeredWhenTo': answeredWhenTo,
-            'take':1000000,
-            'answered': 'Unanswered'
-            }
-    elif answered is None:
-        params = {
-            # 'askingMemberId':  4663,
-            'answeredWhenFrom': answeredWhenFrom,
-            'answeredWhenTo': answeredWhenTo,
-            'take':1000000,
-            # 'answered': 'Unanswered'
-            }
-
-    headers = {'Accept': 'text/plain'}
-
-
-    r = requests.get(url=url, params = params, headers=headers)
-    data = [x['value'] for x in r.json()['results']]
-    return data
-
-
-def update_answered_pqs(tmp = '/Users/ben/Documents/blog/UKParliament/tmp'):
+    if answered is None:
+        params = {'answered': 'Any'}
+    elif answered:
+        params = {'answered': 'Answered'}
+    else:
+        params = {'answered': 'Unanswered'}
+    return list(iter_wpqs(params, answeredWhenFrom, answeredWhenTo, date_param='answeredWhen'))
+
+
+def fetch_date_windows(fetch, windows, max_workers=8, checkpoint=None):
+    """
+    Download WPQs for many date windows (e.g. one per month) in parallel.
+    :param fetch: a function which takes the start and end of a window, and returns a list of WPQs, e.g. a lambda wrapping get_wpqs_by_date.
+    :param windows: a list of (from, to) tuples.
+    :param max_workers: int, default 8. The number of windows downloaded at once.
+    :param checkpoint: a checkpoint.Checkpoint, default None. If given, each window's WPQs are recorded in it as soon as the window is downloaded, and windows it already holds are taken from it rather than downloaded again.
+    :return: a list of WPQs expressed in dictionaries, in the same order as the windows, whatever order they finished downloading in. 
+    """
+    results = [None] * len(windows)
+    todo = list(range(len(windows)))
+    if checkpoint is not None:
+        for i, window in enumerate(windows):
+            if window in checkpoint:
+                results[i] = checkpoint.result(window)
+        todo = [i for i in todo if results[i] is None]
+
+    def fetch_window(a, b):
+        wpqs = fetch(a, b)
+        # Record the window from the worker thread, so that it is kept even if another window fails
+        if checkpoint is not None:
+            checkpoint.record((a, b), wpqs)
+        return wpqs
+
+    n_pqs = sum(len(results[i]) for i in range(len(windows)) if results[i] is not None)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor, tqdm(total=len(windows), initial=len(windows) - len(todo), leave=False, unit='month') as progress:
+        futures = {executor.submit(fetch_window, *windows[i]): i for i in todo}
+        for future in as_completed(futures):
+            results[futures[future]] = future.result()
+            # One bar for all the workers, counting windows done and PQs downloaded so far
+            n_pqs += len(results[futures[future]])
+            progress.set_postfix(pqs=n_pqs)
+            progress.update(1)
+    return [x for window in results for x in window]
+
+
+def open_checkpoint(tmp, name, resume=True):
+    """
+    Open the journal of months downloaded so far for a full archive download, {name}_checkpoint.jsonl in the tmp folder.
+    :param resume: bool, default True. If False, any journal left by an earlier run is discarded.
+    :return: a checkpoint.Checkpoint
+    """
+    path = str(Path(tmp) / '{n}_checkpoint.jsonl'.format(n=name))
+    if not resume and Path(path).exists():
+        Path(path).unlink()
+    return Checkpoint(path)
+
+
+def clean_wpqs(wpqs, tmp, members=None):
+    """
+    Add the cleaned and derived columns (party, lower case text, topic, year_month and cleanedQuestion) to a DataFrame of raw WPQs.
+    :param wpqs: a DataFrame of WPQs, as stored in the archive.
+    :param tmp: str, the tmp folder, where active_members.csv and former_members.csv are looked for.
+    :param members: a members.MemberTable, default None. If None, the tmp folder's shared table is used (see members.get_member_table).
+    :return: the cleaned DataFrame.
+    """
+    wpqs = wpqs.copy()
+    wpqs['dateTabled'] = pd.to_datetime(wpqs.dateTabled)
+    wpqs['heading'] = wpqs.heading.fillna('')
+    # wpqs = wpqs[['id', 'askingMemberId', 'askingMember', 'house', 'dateTabled', 'questionText', 'answeringBodyName', 'heading']]
+
+    # Populate a column with party appreviation in the WPQs database, if the source data is available. 
+    if members is None:
+        try:
+            members = get_member_table(tmp)
+        except FileNotFoundError as e:
+            print('{e} The latestPartyabbreviation column has not been added.'.format(e=e))
+    if members is not None:
+        wpqs = members.enrich(wpqs, on='askingMemberId', attributes=['party'])
+
+    # Make some of the string fields lower case to improve comparability and searchability
+    wpqs['heading'] = wpqs.heading.str.lower()
+    wpqs['questionText'] = wpqs.questionText.str.lower()
+
+    # Sometime the heading is a generic topic, other times it's specified by a ":" symbol. We'll extract this into a 'topic' column.
+    wpqs['topic'] = wpqs.heading.str.split(':').str[0]
+
+    wpqs['year_month'] = wpqs.dateTabled.dt.to_period('M')
+    wpqs['cleanedQuestion'] = clean_questions(wpqs.questionText)
+    return wpqs
+
+
+def content_hash(wpqs):
+    """
+    Hash the content of each row of raw WPQs, so that the cleaning stage can tell which rows it has already seen.
+    :return: a Series of int64 hashes, with the same index as wpqs.
+    """
+    columns = sorted(c for c in wpqs.columns if c != 'contentHash')
+    return pd.util.hash_pandas_object(wpqs[columns], index=False).astype('int64')
+
+
+@metrics.instrumented('update_cleaned_archive')
+def update_cleaned_archive(store, new_pqs, tmp, name, backend='csv', search_index=True, rollups=True, topics=True):
+    """
+    The cleaning stage of the WPQ pipelines. Rows are keyed on their id and a hash of their raw content, and only rows which aren't in the cleaned archive yet are cleaned and added to it, so an update costs work in proportion to the new PQs rather than the whole archive.
+    A PQ whose content has changed replaces its old version, in the cleaned archive, the search index and the rollup cube alike.
+    If there's no cleaned archive yet (or it predates the content hashes), the whole raw archive is cleaned.
+
+    Cleaned CSV archives are saved in the working directory, as they always have been, and Parquet ones in the tmp folder.
+    :param store: the raw archive, from storage.open_store
+    :param new_pqs: a DataFrame of the rows just added to the raw archive.
+    :param tmp: str, the tmp folder.
+    :param name: str, the cleaned archive's name, e.g. 'pqs_cleaned'.
+    :param backend: str, default 'csv'. The cleaned archive's backend, 'csv' or 'parquet'.
+    :param search_index: bool, default True. Keep the keyword search index ({name}_search.sqlite in the tmp folder, see search.SearchIndex) up to date with the newly cleaned PQs. If there is no index yet, it is built from the whole cleaned archive.
+    :param rollups: bool, default True. Likewise keep the daily rollup cube ({name}_rollups.sqlite in the tmp folder, see rollups.RollupCube) up to date.
+    :param topics: bool, default True. If a topic model of this archive has been trained ({name}_lda/ in the tmp folder, see topics.TopicModel), fold the newly cleaned PQs into it and tag them with their topics.
+    :return: a DataFrame of the PQs cleaned by this update (the whole archive, if it was rebuilt), or an empty DataFrame if there were none. Load the whole cleaned archive with load_cleaned_archive.
+    """
+    cleaned = None
+    rebuilt = False
+    cleaned_store = open_store('.' if backend == 'csv' else tmp, name, date_column=store.date_column, backend=backend)
+
+    if cleaned_store.exists() and 'contentHash' in cleaned_store.columns():
+        new_pqs = new_pqs.copy()
+        new_pqs['contentHash'] = content_hash(new_pqs)
+        # A row with the same content has the same date, so only the date range of the new rows needs checking
+        dates = new_pqs[store.date_column]
+        if len(new_pqs) > 0:
+            seen = cleaned_store.read(columns=['id', 'contentHash'], start=dates.min(), end=dates.max() + pd.Timedelta(days=1))
+            keys = pd.MultiIndex.from_frame(new_pqs[['id', 'contentHash']])
+            new_pqs = new_pqs[~keys.isin(pd.MultiIndex.from_frame(seen))]
+            # PQs which are in the archive already, with different content
+            changed = seen['id'][seen['id'].isin(new_pqs['id'])].tolist()
+        print('Cleaning {n} new or changed PQs...'.format(n=len(new_pqs)))
+        if len(new_pqs) > 0:
+            with metrics.timer('cleaning'):
+                cleaned = clean_wpqs(new_pqs, tmp)
+            metrics.increment('rows_cleaned', len(cleaned))
+            cleaned['year_month'] = cleaned.year_month.astype(str)
+            # Merged on id, so that the old version of a changed PQ is dropped rather than kept alongside the new one. If none have changed, a CSV archive is just appended to.
+            cleaned_store.upsert(cleaned, key='id', existing=changed)
+    else:
+        wpqs = store.read()
+        wpqs['contentHash'] = content_hash(wpqs)
+        print('Cleaning the full archive of {n} PQs...'.format(n=len(wpqs)))
+        with metrics.timer('cleaning'):
+            cleaned = clean_wpqs(wpqs, tmp)
+        metrics.increment('rows_cleaned', len(cleaned))
+        cleaned['year_month'] = cleaned.year_month.astype(str)
+        cleaned_store.write(cleaned)
+        rebuilt = True
+
+    # The whole cleaned archive is only needed to build the search index or rollup cube from scratch, and after a rebuild it's what was just cleaned
+    wpqs = cleaned if rebuilt else None
+
+    if search_index:
+        index = open_search_index(tmp, name)
+        if rebuilt or len(index) == 0:
+            print('Building the search index...')
+            if wpqs is None:
+                wpqs = cleaned_store.read()
+            index.rebuild(wpqs)
+        elif cleaned is not None:
+            # Take out the old versions of changed PQs first, so they can't be counted twice
+            index.remove(cleaned['id'])
+            index.update(cleaned)
+        index.close()
+
+    if rollups:
+        cube = open_rollups(tmp, name)
+        if rebuilt or len(cube) == 0:
+            print('Building the rollup cube...')
+            if wpqs is None:
+                wpqs = cleaned_store.read()
+            cube.rebuild(wpqs)
+        elif cleaned is not None:
+            cube.remove(cleaned['id'])
+            cube.update(cleaned)
+        cube.close()
+
+    if topics and cleaned is not None and (Path(tmp) / '{n}_lda'.format(n=name) / 'lda.model').is_file():
+        # Imported here, as the topic model needs gensim, and its preprocessing reads the cleaned archive through this module
+        from topics import TopicModel
+        model = TopicModel(tmp, name, backend)
+        # After an incremental update, only the rows just cleaned need looking at
+        model.update(cleaned=None if rebuilt else cleaned)
+        model.close()
+
+    if cleaned is None:
+        return pd.DataFrame()
+    cleaned['year_month'] = pd.PeriodIndex(cleaned.year_month, freq='M')
+    return cleaned
+
+
+# The date column each cleaned archive is partitioned by, as for the raw archive it was cleaned from
+CLEANED_DATE_COLUMNS = {'pqs_cleaned': 'dateAnswered', 'ua_pqs_cleaned': 'dateTabled'}
+
+
+def open_cleaned_store(tmp, name='pqs_cleaned', backend='csv'):
+    """
+    Open one of the cleaned archives written by update_cleaned_archive.
+    :return: a storage.CsvStore or storage.ParquetStore
+    """
+    return open_store('.' if backend == 'csv' else tmp, name, date_column=CLEANED_DATE_COLUMNS[name], backend=backend)
+
+
+def load_cleaned_archive(tmp, name='pqs_cleaned', backend='csv', text=False, columns=None, start=None, end=None):
+    """
+    Load a cleaned archive in a compact form, for analysis. Low-cardinality columns (house, answeringBodyName, topic, heading, askingMember, latestPartyabbreviation, year_month...) are categoricals,
+    ids and counts are the smallest integer type that fits, and the long text columns (questionText, answerText, cleanedQuestion...) are left out unless asked for. This takes a fraction of the memory of pd.read_csv.
+    :param tmp: str, the tmp folder.
+    :param name: str, default 'pqs_cleaned'. Which cleaned archive to load: 'pqs_cleaned' or 'ua_pqs_cleaned'.
+    :param backend: str, default 'csv'. The cleaned archive's backend, 'csv' or 'parquet'.
+    :param text: bool or list, default False. Which text columns to load as well: False for none, True for all of them, or a list, e.g. ['cleanedQuestion']. See also load_text.
+    :param columns: list, default None. Only load these of the other columns. If None, load all of them (except contentHash, which is only used for updates).
+    :param start: a date, default None. Only load rows where the archive's date column is on or after this date.
+    :param end: a date, default None. Only load rows where the archive's date column is before this date.
+    :return: a DataFrame
+    """
+    store = open_cleaned_store(tmp, name, backend)
+    available = store.columns()
+    if columns is None:
+        columns = [c for c in available if c not in WPQ_TEXT_COLUMNS and c != 'contentHash']
+    if text is True:
+        text = WPQ_TEXT_COLUMNS
+    elif text is False:
+        text = []
+    columns = list(columns) + [c for c in text if c in available and c not in columns]
+    return store.read(columns=columns, start=start, end=end, compact=True)
+
+
+def load_text(tmp, ids, name='pqs_cleaned', backend='csv', columns=('cleanedQuestion',)):
+    """
+    Load text columns for just some rows of a cleaned archive, e.g. those picked out by filtering the compact frame from load_cleaned_archive.
+    :param tmp: str, the tmp folder.
+    :param ids: a list of WPQ ids.
+    :param columns: list, default ('cleanedQuestion',). The text columns to load.
+    :return: a DataFrame of the text columns, indexed by id.
+    """
+    return open_cleaned_store(tmp, name, backend).read_rows(ids, list(columns)).set_index('id')
+
+
+@metrics.instrumented('update_answered_pqs')
+def update_answered_pqs(tmp = '/Users/ben/Documents/blog/UKParliament/tmp', backend='csv', max_workers=8, resume=True):
     """
     A function that downloads an archive of all answered WPQs. It looks for an archive, and then downloads WQPs using date as an input, making monthly calls to Parliament's API starting with the earliest date for which data is available. 
 
     If there is an archive, it checks when it was last updated, and looks for WPQs which have been answered since the last update, and appends them to the database. 
-    :return: a pandas Dataframe of all answered WPQs. 
+    :param tmp: str, the folder the archive is kept in.
+    :param backend: str, default 'csv'. How the archive is stored: 'csv' for the legacy single file (pqs.csv), or 'parquet' for Parquet files partitioned by year and month of dateAnswered (pqs/), which only rewrites the months that new PQs fall into.
+    :param max_workers: int, default 8. When downloading the full archive, how many months to download at once.
+    :param resume: bool, default True. When downloading the full archive, each month is journalled in pqs_checkpoint.jsonl in the tmp folder as it completes. If a previous download died part way through, only the months it didn't finish are downloaded. If False, the journal is discarded.
+    :return: a pandas Dataframe of the answered WPQs cleaned by this update (all of them, if the cleaned archive was rebuilt). Load the whole archive with load_cleaned_archive(tmp).
     """
     # Declare some datetime variables
     # We use these to generate the complete archive since 2014-05, when the digital record begins. 
@@ -101,15 +458,14 @@ def update_answered_pqs(tmp = '/Users/ben/Documents/blog/UKParliament/tmp'):
     next_month = today + relativedelta(months=1)
     next_month_str = next_month.strftime("%Y-%m-%d")
 
-    # Check if there's already a file downloaded. If yes, download questions tabled since last update. If not, download alles.
-    if Path(tmp+'/pqs.csv', index_col=0).is_file():
-        pqs = pd.read_csv(Path(tmp+'/pqs.csv'))
-        pqs['dateAnswered'] = pd.to_datetime(pqs.dateAnswered)
-        pqs = pqs.drop_duplicates()
-        no_pqs = pqs.shape[0]
-        start_date = pqs.dateAnswered.max()#.strftime("%Y-%m-%d")
+    store = open_store(tmp, 'pqs', date_column='dateAnswered', backend=backend)
+
+    # Check if there's already an archive. If yes, download questions answered since last update. If not, download alles.
+    if store.exists():
+        no_pqs = store.count()
+        start_date = store.max_date()
         # start_date = pd.to_datetime('2022-01-15')
-        print("File pqs.csv found with {n} answered PQs in, last updated {d}. Looking for new PQs...".format(n=no_pqs, d=start_date.strftime("%Y-%m-%d")))
+        print("Archive found with {n} answered PQs in, last updated {d}. Looking for new PQs...".format(n=no_pqs, d=start_date.strftime("%Y-%m-%d")))
 
         date_list = pd.date_range(start_date, today, freq='D').strftime('%Y-%m-%d').tolist()
         # print(date_list)
@@ -126,25 +482,13 @@ def update_answered_pqs(tmp = '/Users/ben/Documents/blog/UKParliament/tmp'):
                 pass
 
         n_pqs = pd.DataFrame(master_wpqs)
-        n_pqs.drop(columns=['attachments', 'groupedQuestions', 'groupedQuestionsDates'], inplace=True)
-        n_pqs['dateAnswered'] = pd.to_datetime(n_pqs.dateAnswered)
-        n_pqs = n_pqs.drop_duplicates()
 
-        new_pqs = pd.concat([pqs, n_pqs])
-        new_pqs['dateAnswered'] = pd.to_datetime(new_pqs.dateAnswered)
-        new_pqs = new_pqs.drop_duplicates()
-
-        new_pqs.to_csv(Path(tmp+'/pqs.csv'), index=False, index_label=False)
+        metrics.increment('rows', len(n_pqs))
+        n_pqs.drop(columns=['attachments', 'groupedQuestions', 'groupedQuestionsDates'], inplace=True)
 
-        # This is an embarrassingly bad fix for a problem with dropping duplicates. 
-        # Essentially, mixed datatypes prevented drop_duplicates() from working... that meant that I couldn't get an accurate read on how many extra PQs were being downloaded. 
-        # This is a poor fix... oh well. 
-        pqs = pd.read_csv(Path(tmp+'/pqs.csv'))
-        pqs = pqs.drop_duplicates()
-        pqs.to_csv(Path(tmp+'/pqs.csv'), index=False, index_label=False)
-        new_length = pqs.shape[0]
-        pqs_added = new_length - no_pqs
-        print("Downloaded {n} new PQs, which have been added to the archive.".format(n=pqs_added))
+        # The store casts the new PQs to the archive's dtypes before dropping duplicates, so there's no need to re-read the archive to get an accurate count
+        added = store.upsert(n_pqs)
+        print("Downloaded {n} new PQs, which have been added to the archive.".format(n=len(added)))
 
 
 
@@ -156,54 +500,21 @@ def update_answered_pqs(tmp = '/Users/ben/Documents/blog/UKParliament/tmp'):
         max_date_list = pd.date_range(start_date, next_month, freq='M').strftime('%Y-%m-%d').tolist()
         # max_date_list.append(next_month_str)
 
-        # List for all the PQS to go in:
-        master_wpqs = []
-
-        # Iterate through idx, get unanswered wpqs from each month and append to the master_wpqs list
-        for i, e in enumerate(tqdm(max_date_list, leave=False)):
-            lst_wpqs = get_wpqs_by_answered(answeredWhenFrom=min_date_list[i], answeredWhenTo=max_date_list[i], answered=True)
-            for x in lst_wpqs:
-                master_wpqs.append(x) 
+        # Get the answered wpqs from each month, several months at a time, into one list in date order
+        checkpoint = open_checkpoint(tmp, 'pqs', resume)
+        master_wpqs = fetch_date_windows(lambda a, b: get_wpqs_by_answered(answeredWhenFrom=a, answeredWhenTo=b, answered=True), list(zip(min_date_list, max_date_list)), max_workers=max_workers, checkpoint=checkpoint)
 
         # Convert to DataFrame
         pqs = pd.DataFrame(master_wpqs)
-        pqs['dateAnswered'] = pd.to_datetime(pqs.dateAnswered)
+        metrics.increment('rows', len(pqs))
         pqs.drop(columns=['attachments', 'groupedQuestions', 'groupedQuestionsDates'], inplace=True)
-        pqs.drop_duplicates(inplace=True)
-        pqs.to_csv(Path(tmp+'/pqs.csv'), index=False, index_label=False)
-        print('Full archive downloaded up to {d}. To ensure your archive is completely up-to-date, it is recommended to call this function once more.'.format(d=pqs.dateAnswered.max().strftime('%Y-%m-%d')))
+        added = store.upsert(pqs)
+        checkpoint.finish()
+        print('Full archive downloaded up to {d}. To ensure your archive is completely up-to-date, it is recommended to call this function once more.'.format(d=store.max_date().strftime('%Y-%m-%d')))
 
     print('Cleaning data...')
-
-    wpqs = pd.read_csv(Path(tmp+'/pqs.csv'))
-    wpqs['dateTabled'] = pd.to_datetime(wpqs.dateTabled)
-    wpqs['heading'] = wpqs.heading.fillna('')
-    # wpqs = wpqs[['id', 'askingMemberId', 'askingMember', 'house', 'dateTabled', 'questionText', 'answeringBodyName', 'heading']]
-
-    # Populate a column with party appreviation in the WPQs database, if the source data is available. 
-    try:
-        active_p = pd.read_csv(Path(tmp+'/active_members.csv'))
-        former_p = pd.read_csv(Path(tmp+'/former_members.csv'))
-
-        all_p = pd.concat([active_p, former_p])
-        all_p = all_p[['id', 'nameListAs', 'gender', 'latestPartyabbreviation']]
-
-        id_party_dict = dict(zip(all_p.id, all_p.latestPartyabbreviation))
-        wpqs['latestPartyabbreviation'] = wpqs.askingMemberId.progress_apply(lambda x: id_party_dict[x] if x in id_party_dict.keys() else 'n/a')
-    except:
-        pass
-
-    # Make some of the string fields lower case to improve comparability and searchability
-    wpqs['heading'] = wpqs.heading.progress_apply(lambda x: x.lower())
-    wpqs['questionText'] = wpqs.questionText.progress_apply(lambda x: x.lower())
-
-    # Sometime the heading is a generic topic, other times it's specified by a ":" symbol. We'll extract this into a 'topic' column.
-    wpqs['topic'] = wpqs.heading.progress_apply(lambda x: x.split(':')[0])
-
-    wpqs['year_month'] = wpqs.dateTabled.dt.to_period('M')
-    wpqs['cleanedQuestion'] = wpqs.questionText.progress_apply(lambda x: question_cleaner(x))
-    wpqs.to_csv('pqs_cleaned.csv', index=False, index_label=False)
-    print('Cleaning done. Output saved in ')
+    wpqs = update_cleaned_archive(store, added, tmp, name='pqs_cleaned', backend=backend)
+    print('Cleaning done. Output saved in pqs_cleaned.')
 
     return wpqs
     
@@ -216,29 +527,24 @@ This section contains two functions, which when used together will download an a
 # A useful function that will download WPQs for a given range of dates the question is tabled
 def get_wpqs_by_date(tabledWhenFrom, tabledWhenTo):
     """
-    Download WPQs tabled between a given range (recommended not to specify longer than 1 month). Dates should be in the format 'yyyy-mm-dd'.
+    Download WPQs tabled between a given range, answered or not. Dates should be in the format 'yyyy-mm-dd'. The WPQs are downloaded a page at a time, so any range is safe.
     :param: tabledWhenFrom str 'yyyy-mm-dd'
     :param: tabledWhenTo str 'yyyy-mm-dd'
-    :param: answered bool default None. If True, the function only downloads answered PQs. If False, only unanswered. If None, all are downloaded.  
     :return: a list of WQPs expressed in dictionaries. 
     """
-    url = 'https://writtenquestions-api.parliament.uk/api/writtenquestions/questions'
-
-    params = {
-        'tabledWhenFrom': tabledWhenFrom,
-        'tabledWhenTo': tabledWhenTo,
-        'take':1000000,
-        'answered': 'Any'
-        }
+    return list(iter_wpqs({'answered': 'Any'}, tabledWhenFrom, tabledWhenTo, date_param='tabledWhen'))
 
-    headers = {'Accept': 'text/plain'}
 
-    r = requests.get(url=url, params = params, headers=headers)
-    data = [x['value'] for x in r.json()['results']]
-    return data
-
-
-def download_ua_pqs(tmp = '/Users/ben/Documents/blog/pqs/tmp'):
+@metrics.instrumented('download_ua_pqs')
+def download_ua_pqs(tmp = '/Users/ben/Documents/blog/pqs/tmp', backend='csv', max_workers=8, resume=True):
+    """
+    A function that downloads an archive of all tabled WPQs, answered or not, without their answers. Like update_answered_pqs, it downloads the full archive month by month if there isn't one, and otherwise appends the WPQs tabled since the last update.
+    :param tmp: str, the folder the archive is kept in.
+    :param backend: str, default 'csv'. How the archive is stored: 'csv' for the legacy single file (ua_pqs.csv), or 'parquet' for Parquet files partitioned by year and month of dateTabled (ua_pqs/).
+    :param max_workers: int, default 8. When downloading the full archive, how many months to download at once.
+    :param resume: bool, default True. As for update_answered_pqs, with the journal in ua_pqs_checkpoint.jsonl.
+    :return: a pandas Dataframe of the tabled WPQs cleaned by this update (all of them, if the cleaned archive was rebuilt). Load the whole archive with load_cleaned_archive(tmp, 'ua_pqs_cleaned').
+    """
 
     # Declare some datetime variables
     # We use these to generate the complete archive since 2014-05, when the digital record begins. 
@@ -250,14 +556,13 @@ def download_ua_pqs(tmp = '/Users/ben/Documents/blog/pqs/tmp'):
     next_month = today + relativedelta(months=1)
     next_month_str = next_month.strftime("%Y-%m-%d")
 
+    store = open_store(tmp, 'ua_pqs', date_column='dateTabled', backend=backend)
 
-    if Path(tmp+'/ua_pqs.csv', index_col=0).is_file():
-        pqs = pd.read_csv(Path(tmp+'/ua_pqs.csv'))
-        no_pqs = pqs.shape[0]
-        pqs['dateTabled'] = pd.to_datetime(pqs.dateTabled)
-        start_date = pqs.dateTabled.max()#.strftime("%Y-%m-%d")
+    if store.exists():
+        no_pqs = store.count()
+        start_date = store.max_date()
         # start_date = pd.to_datetime('2022-01-15')
-        print("File ua_pqs.csv found with {n} unanswered PQs in, last updated {d}. Looking for new PQs...".format(n=no_pqs, d=start_date.strftime("%Y-%m-%d")))
+        print("Archive found with {n} unanswered PQs in, last updated {d}. Looking for new PQs...".format(n=no_pqs, d=start_date.strftime("%Y-%m-%d")))
 
         date_list = pd.date_range(start_date, today, freq='D').strftime('%Y-%m-%d').tolist()
         
@@ -273,6 +578,7 @@ def download_ua_pqs(tmp = '/Users/ben/Documents/blog/pqs/tmp'):
             except IndexError:
                 pass
         n_pqs = pd.DataFrame(master_wpqs)
+        metrics.increment('rows', len(n_pqs))
         try:
             n_pqs.drop(columns=['attachments', 'groupedQuestions', 'groupedQuestionsDates'], inplace=True)
             n_pqs.drop(columns=[
@@ -295,15 +601,8 @@ def download_ua_pqs(tmp = '/Users/ben/Documents/blog/pqs/tmp'):
         except KeyError:
             pass
 
-        old_length = pqs.shape[0]
-        new_pqs = pd.concat([pqs, n_pqs])
-        
-        new_pqs['dateTabled'] = pd.to_datetime(new_pqs.dateTabled)
-        new_pqs = new_pqs.drop_duplicates()
-        new_length = new_pqs.shape[0]
-        pqs_added = new_length - old_length
-        print("Downloaded {n} new PQs, which have been added to the archive.".format(n=pqs_added))
-        new_pqs.to_csv(Path(tmp+'/ua_pqs.csv'), index=False, index_label=False)
+        added = store.upsert(n_pqs)
+        print("Downloaded {n} new PQs, which have been added to the archive.".format(n=len(added)))
         # print("All done, be on your merry way.")
 
 
@@ -315,17 +614,13 @@ def download_ua_pqs(tmp = '/Users/ben/Documents/blog/pqs/tmp'):
         max_date_list = pd.date_range(start_date, next_month, freq='M').strftime('%Y-%m-%d').tolist()
         # max_date_list.append(next_month_str)
 
-        # List for all the PQS to go in:
-        master_wpqs = []
-
-        # Iterate through idx, get unanswered wpqs from each month and append to the master_wpqs list
-        for i, e in enumerate(tqdm(max_date_list, leave=False)):
-            lst_wpqs = get_wpqs_by_date(tabledWhenFrom=min_date_list[i], tabledWhenTo=max_date_list[i])
-            for x in lst_wpqs:
-                master_wpqs.append(x) 
+        # Get the wpqs tabled in each month, several months at a time, into one list in date order
+        checkpoint = open_checkpoint(tmp, 'ua_pqs', resume)
+        master_wpqs = fetch_date_windows(lambda a, b: get_wpqs_by_date(tabledWhenFrom=a, tabledWhenTo=b), list(zip(min_date_list, max_date_list)), max_workers=max_workers, checkpoint=checkpoint)
 
         # Convert to DataFrame
         pqs = pd.DataFrame(master_wpqs)
+        metrics.increment('rows', len(pqs))
         pqs.drop(columns=['attachments', 'groupedQuestions', 'groupedQuestionsDates'], inplace=True)
         pqs.drop(columns=[
                 'isWithdrawn',
@@ -347,41 +642,13 @@ def download_ua_pqs(tmp = '/Users/ben/Documents/blog/pqs/tmp'):
 
         pqs['dateTabled'] = pd.to_datetime(pqs.dateTabled)
         pqs['dateTabled'] = pqs.dateTabled.apply(lambda x: today if x > today else x)
-        # pqs.drop_duplicates(inplace=True)
-        pqs.to_csv(Path(tmp+'/ua_pqs.csv'), index=False, index_label=False)
+        added = store.upsert(pqs)
+        checkpoint.finish()
         print('Full archive downloaded up to {d}. To ensure your archive is up-to-date, it is recommended to call this function once more.'.format(d=pqs.dateTabled.max().strftime('%Y-%m-%d')))
 
 
     print('Cleaning data...')
+    wpqs = update_cleaned_archive(store, added, tmp, name='ua_pqs_cleaned', backend=backend)
+    print('Cleaning done. Output saved in ua_pqs_cleaned.')
 
-    wpqs = pd.read_csv(Path(tmp+'/ua_pqs.csv'))
-    wpqs['dateTabled'] = pd.to_datetime(wpqs.dateTabled)
-    wpqs['heading'] = wpqs.heading.fillna('')
-    # wpqs = wpqs[['id', 'askingMemberId', 'askingMember', 'house', 'dateTabled', 'questionText', 'answeringBodyName', 'heading']]
-
-    # Populate a column with party appreviation in the WPQs database, if the source data is available. 
-    try:
-        active_p = pd.read_csv(Path(tmp+'/active_members.csv'))
-        former_p = pd.read_csv(Path(tmp+'/former_members.csv'))
-
-        all_p = pd.concat([active_p, former_p])
-        all_p = all_p[['id', 'nameListAs', 'gender', 'latestPartyabbreviation']]
-
-        id_party_dict = dict(zip(all_p.id, all_p.latestPartyabbreviation))
-        wpqs['latestPartyabbreviation'] = wpqs.askingMemberId.progress_apply(lambda x: id_party_dict[x] if x in id_party_dict.keys() else 'n/a')
-    except:
-        pass
-
-    # Make some of the string fields lower case to improve comparability and searchability
-    wpqs['heading'] = wpqs.heading.progress_apply(lambda x: x.lower())
-    wpqs['questionText'] = wpqs.questionText.progress_apply(lambda x: x.lower())
-
-    # Sometime the heading is a generic topic, other times it's specified by a ":" symbol. We'll extract this into a 'topic' column.
-    wpqs['topic'] = wpqs.heading.progress_apply(lambda x: x.split(':')[0])
-
-    wpqs['year_month'] = wpqs.dateTabled.dt.to_period('M')
-    wpqs['cleanedQuestion'] = wpqs.questionText.progress_apply(lambda x: question_cleaner(x))
-    wpqs.to_csv('ua_pqs_cleaned.csv', index=False, index_label=False)
-    print('Cleaning done. Output saved in ')
-
-    return wpqs
\ No newline at end of file
+    return wpqs